@@ -42,6 +42,8 @@ argparser.add_argument('--debug-graph-group-by', default='command', choices=['co
 argparser.add_argument('--debug-graph-pretty', '--no-debug-graph-pretty', default=True, action=common.FlagBooleanAction, help="Pretty or raw output for debug graph.")
 argparser.add_argument('--debug-graph-output-filename', help="The generated DOT graph filename. Defaults to 'dmake-services.debug.{group_by}.gv'")
 argparser.add_argument('--debug-graph-output-format', default='png', help="The generated DOT graph format (`png`, `svg`, `pdf`, ...).")
+argparser.add_argument('--profile', default=False, action='store_true', help="Report the plan generation wall time per phase, and the subprocesses it ran, grouped by command.")
+argparser.add_argument('--profile-pstats', metavar='PSTATS_FILE', help="Also write the cProfile statistics of the plan generation to this file.")
 
 subparsers = argparser.add_subparsers(dest='cmd', title='Commands')
 subparsers.required = True
@@ -55,6 +57,7 @@ parser_deploy  = subparsers.add_parser('deploy', help="Deploy specified apps and
 parser_release = subparsers.add_parser('release', help="Create a release of the app on Github.")
 parser_graph   = subparsers.add_parser('graph', help="Generate a visual graph of the app services dependencies (dot/graphviz format).")
 parser_generate_doc = subparsers.add_parser('generate-doc', help="Generate DMake documentation.")
+parser_link_pool = subparsers.add_parser('link-pool', help="Inspect or purge the warm pool of docker links containers reused across local executions (enabled with DMAKE_LINK_POOL=1).")
 
 
 # "service" argument
@@ -82,6 +85,9 @@ parser_release.add_argument('-t', '--tag', nargs='?', help="The release tag from
 
 parser_generate_doc.add_argument("kind", choices=['usage', 'format', 'example'])
 
+parser_link_pool.add_argument("action", nargs='?', default='list', choices=['list', 'purge'], help="List the pooled containers, or remove the idle ones.")
+parser_link_pool.add_argument('--all', default=False, action='store_true', help="With purge: also remove the containers in use.")
+
 parser_graph.add_argument('--output', default='dmake-services.gv', help="The generated DOT graph filename.")
 parser_graph.add_argument('--format', default='png', help="The generated DOT graph format (`png`, `svg`, `pdf`, ...).")
 
@@ -94,6 +100,7 @@ parser_deploy.set_defaults(func=core.make)
 parser_release.set_defaults(func=commands.release.entry_point)
 parser_graph.set_defaults(func=commands.graph.entry_point)
 parser_generate_doc.set_defaults(func=commands.generate_doc.entry_point)
+parser_link_pool.set_defaults(func=commands.link_pool.entry_point)
 
 
 
@@ -2,3 +2,4 @@ from . import stop
 from . import release
 from . import graph
 from . import generate_doc
+from . import link_pool
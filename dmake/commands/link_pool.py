@@ -0,0 +1,32 @@
+import time
+
+import dmake.common as common
+import dmake.link_pool as link_pool
+
+
+def entry_point(options):
+    now = time.time()
+    with link_pool.locked_pool() as pool:
+        if options.action == 'purge':
+            # all idle containers are expired
+            removed = link_pool.purge(pool, now, -1, link_pool.get_max_size(), purge_all=options.all)
+            common.logger.info('Removed %d pooled link containers.' % len(removed))
+            if not options.all:
+                in_use = [container_id for container_id, entry in pool.items() if link_pool.is_in_use(entry)]
+                if in_use:
+                    common.logger.info('%d containers are still in use, use --all to remove them too.' % len(in_use))
+            return
+
+        if len(pool) == 0:
+            common.logger.info('The link pool is empty.')
+            return
+        print('%-14s %-20s %-30s %-10s %s' % ('CONTAINER ID', 'LINK NAME', 'IMAGE', 'IDLE', 'STATUS'))
+        for container_id, entry in sorted(pool.items(), key=lambda item: item[1]['last_used']):
+            if link_pool.is_in_use(entry):
+                status = 'in use'
+            elif link_pool.is_container_running(container_id):
+                status = 'idle'
+            else:
+                status = 'dead'
+            idle = '-' if status == 'in use' else '%ds' % (now - entry['last_used'])
+            print('%-14s %-20s %-30s %-10s %s' % (container_id[:12], entry['link_name'], entry['image'], idle, status))
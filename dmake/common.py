@@ -11,11 +11,19 @@ from ruamel.yaml import YAML
 from ruamel.yaml.emitter import Emitter as YAML_Emitter
 import uuid
 
+from dmake.profiler import Profiler
+
 # Set logger
 logger = logging.getLogger("dmake")
 logger.setLevel(logging.INFO) #TODO configurable
 logger.addHandler(logging.StreamHandler())
 
+# Lockable resources labels of the parallel builders: CPU and memory units, and their capacity environment variables
+PARALLEL_BUILDERS_CAPACITY_VARIABLES = {
+    'PARALLEL_BUILDERS': 'DMAKE_PARALLEL_BUILDERS_CAPACITY',
+    'PARALLEL_BUILDERS_MEMORY': 'DMAKE_PARALLEL_BUILDERS_MEMORY_CAPACITY',
+}
+
 ###############################################################################
 
 class ShellError(Exception):
@@ -72,8 +80,17 @@ class YAMLEmitterNoVersionDirective(YAML_Emitter):
         # disable emitting version directive (%YAML 1.1)
         pass
 
+# record the plan executions (see dmake.trace): set by `init()`
+execution_trace = False
+
+# 'ruamel' (pure Python), or 'libyaml' (C, through PyYAML: see dmake.yaml_libyaml)
+yaml_backend = 'ruamel'
+
 def yaml_ordered_load(stream, all=False):
     try:
+        if yaml_backend == 'libyaml':
+            import dmake.yaml_libyaml as yaml_libyaml
+            return yaml_libyaml.load(stream, all=all)
         yaml = YAML(typ='safe', pure=True)
         # kubectl and everyone else uses yaml 1.1
         yaml.version = (1, 1)
@@ -87,6 +104,10 @@ def yaml_ordered_dump(data, stream=None, default_flow_style=False, all=False, no
     if stream is None:
         stream = io.StringIO()
         return_string = True
+    if yaml_backend == 'libyaml' and not normalize_indent:
+        import dmake.yaml_libyaml as yaml_libyaml
+        yaml_libyaml.dump(data, stream, all=all)
+        return stream.getvalue() if return_string else None
     yaml = YAML(pure=True)
     # simplify concatenating yaml files
     yaml.explicit_start = True
@@ -117,7 +138,9 @@ def append_command(commands, cmd, prepend = False, **args):
     elif cmd == "stage_end":
         check_cmd(args, [])
     elif cmd == "parallel":
-        check_cmd(args, [])
+        check_cmd(args, [], optional = ['background'])
+        if 'background' not in args:
+            args['background'] = False
     elif cmd == "parallel_end":
         check_cmd(args, [])
     elif cmd == "parallel_branch":
@@ -140,6 +163,10 @@ def append_command(commands, cmd, prepend = False, **args):
         check_cmd(args, ['what'])
     elif cmd == "catch_end":
         check_cmd(args, [])
+    elif cmd == "trace_begin":
+        check_cmd(args, ['name', 'category'])
+    elif cmd == "trace_end":
+        check_cmd(args, ['name', 'category'])
     elif cmd == "echo":
         check_cmd(args, ['message'])
     elif cmd == "sh":
@@ -152,12 +179,22 @@ def append_command(commands, cmd, prepend = False, **args):
         check_cmd(args, ['var', 'value'])
     elif cmd == "git_tag":
         check_cmd(args, ['tag'])
+    elif cmd == "tests_results":
+        check_cmd(args, ['reports'], optional = ['allow_missing'])
+        if 'allow_missing' not in args:
+            args['allow_missing'] = False
     elif cmd == "junit":
-        check_cmd(args, ['report', 'service_name', 'mount_point'])
+        check_cmd(args, ['report', 'service_name', 'mount_point'], optional = ['shards'])
+        if 'shards' not in args:
+            args['shards'] = [None]
     elif cmd == "cobertura":
-        check_cmd(args, ['report', 'service_name', 'mount_point'])
+        check_cmd(args, ['report', 'service_name', 'mount_point'], optional = ['shard'])
+        if 'shard' not in args:
+            args['shard'] = None
     elif cmd == "publishHTML":
-        check_cmd(args, ['directory', 'index', 'title', 'service_name', 'mount_point'])
+        check_cmd(args, ['directory', 'index', 'title', 'service_name', 'mount_point'], optional = ['shard'])
+        if 'shard' not in args:
+            args['shard'] = None
     else:
         raise DMakeException("Unknown command %s" % cmd)
     cmd = (cmd, args)
@@ -183,17 +220,18 @@ def run_shell_command(commands, ignore_error=False, additional_env=None, stdin=N
     # don't trace shell execution when run from dmake process: it would be detected as an error otherwise
     env.pop('DMAKE_DEBUG', None)
 
-    prev_stdout = subprocess.PIPE if stdin else None
-    for cmd in commands:
-        cmd = ['bash', '-c', cmd]
-        p = subprocess.Popen(cmd, stdin=prev_stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-        prev_stdout = p.stdout
+    with Profiler.subprocess(commands[0]):
+        prev_stdout = subprocess.PIPE if stdin else None
+        for cmd in commands:
+            cmd = ['bash', '-c', cmd]
+            p = subprocess.Popen(cmd, stdin=prev_stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            prev_stdout = p.stdout
 
-    # python3 compatibility
-    if sys.version_info >= (3, 0) and stdin is not None:
-        stdin = stdin.encode('utf-8')
+        # python3 compatibility
+        if sys.version_info >= (3, 0) and stdin is not None:
+            stdin = stdin.encode('utf-8')
 
-    stdout, stderr = p.communicate(stdin)
+        stdout, stderr = p.communicate(stdin)
 
     if len(stderr) > 0 and not ignore_error and not raise_on_return_code:
         raise ShellError(stderr.decode())
@@ -235,7 +273,8 @@ def eval_str_in_env(value, env=None, strict=False, source=None):
     if source:
         cmd += 'source %s && ' % (source)
     cmd += 'echo %s' % wrap_cmd(value)
-    return run_shell_command(cmd, additional_env=env).strip()
+    with Profiler.phase('env evaluation'):
+        return run_shell_command(cmd, additional_env=env).strip()
 
 def eval_values_in_env(d, env=None, strict=False, source=None):
     for key in d:
@@ -266,6 +305,12 @@ def sanitize_name(name, mode='kubernetes'):
         assert False, 'Invalid sanitize mode'
     return name
 
+def get_shard_service_name(service_name, shard):
+    """The name of a test shard run (see `tests.shards`), or of the whole test run if `shard` is None."""
+    if shard is None:
+        return service_name
+    return '%s.shard-%d' % (service_name, shard)
+
 def sanitize_name_unique(name, mode):
     sanitized_name = sanitize_name(name, mode)
     if sanitized_name == name:
@@ -411,6 +456,15 @@ def init(_options, early_exit=False):
     global session_timestamp
     global change_detection, change_detection_override_dirs
     global parallel_execution
+    global docker_bake
+    global grouped_readiness_probes
+    global link_pool
+    global test_cache
+    global local_resources_lock, parallel_builders_capacity
+    global kubernetes_live_dry_run
+    global kubernetes_rollout_monitor, kubernetes_rollout_timeout
+    global yaml_backend
+    global execution_trace
 
     options = _options
     command = _options.cmd
@@ -434,6 +488,8 @@ def init(_options, early_exit=False):
         change_detection_override_dirs = os.getenv('DMAKE_CHANGE_DETECTION_OVERRIDE_DIRS').split(',')
 
     parallel_execution = os.getenv('DMAKE_PARALLEL_EXECUTION', '0') != '0'
+    docker_bake = os.getenv('DMAKE_DOCKER_BAKE', '0') != '0'
+    grouped_readiness_probes = os.getenv('DMAKE_GROUPED_READINESS_PROBES', '0') != '0'
 
     try:
         root_dir, sub_dir = find_repo_root()
@@ -463,6 +519,37 @@ def init(_options, early_exit=False):
     # Make sure DMAKE_ON_BUILD_SERVER is correctly configured
     is_local = os.getenv('DMAKE_ON_BUILD_SERVER', 0) != "1"
 
+    # Warm pool of docker links containers: local only
+    link_pool = is_local and os.getenv('DMAKE_LINK_POOL', '0') != '0'
+
+    # Replay the results of tests which already passed with the same inputs
+    test_cache = os.getenv('DMAKE_TEST_CACHE', '0') != '0'
+
+    # Parallel builders resources: locked by weight between concurrent local executions too (see `dmake_resources_lock`)
+    local_resources_lock = is_local and os.getenv('DMAKE_LOCAL_RESOURCES_LOCK', '0') != '0'
+    # lock quantities are capped to the declared capacities: a branch bigger than the agent would wait forever
+    parallel_builders_capacity = {label: int(os.getenv(variable)) for label, variable in PARALLEL_BUILDERS_CAPACITY_VARIABLES.items() if os.getenv(variable)}
+
+    # Kubernetes manifests are validated offline; also validate them with the cluster (`kubectl apply --dry-run`)
+    kubernetes_live_dry_run = os.getenv('DMAKE_K8S_LIVE_DRY_RUN', '0') != '0'
+    # Parallel execution: the Kubernetes rollouts of the deploy height are waited for together (see `dmake_k8s_rollout_monitor`)
+    kubernetes_rollout_monitor = parallel_execution and os.getenv('DMAKE_K8S_ROLLOUT_MONITOR', '1') != '0'
+    kubernetes_rollout_timeout = int(os.getenv('DMAKE_K8S_ROLLOUT_TIMEOUT', '1800'))
+
+    # Execution trace of the plan (nodes, commands and lock waits timings) in `.dmake/trace.json`
+    execution_trace = os.getenv('DMAKE_TRACE', '1') != '0'
+
+    # Faster YAML load and dump of the same data: needs PyYAML built with libyaml
+    yaml_backend = os.getenv('DMAKE_YAML_BACKEND', 'ruamel')
+    if yaml_backend not in ['ruamel', 'libyaml']:
+        raise DMakeException("Invalid DMAKE_YAML_BACKEND '%s': expecting 'ruamel' or 'libyaml'" % (yaml_backend))
+    if yaml_backend == 'libyaml':
+        try:
+            import dmake.yaml_libyaml  # noqa: F401
+        except (ImportError, AttributeError):
+            logger.warning("DMAKE_YAML_BACKEND=libyaml needs PyYAML built with libyaml: falling back to the ruamel backend")
+            yaml_backend = 'ruamel'
+
     # Set skip test variable
     skip_tests = os.getenv('DMAKE_SKIP_TESTS', "false") in ["1", "true"]
 
@@ -1,11 +1,20 @@
+import hashlib
 import os
 import subprocess
 import sys
 import uuid
 
 import dmake.common as common
+import dmake.trace as trace
 from dmake.common import DMakeException, SharedVolumeNotFoundException, append_command
 from dmake.deepobuild import DMakeFile
+from dmake.docker_image import DockerBake
+from dmake.docker_push import DockerPush
+from dmake.docker_pull import DockerPrefetch
+from dmake.data_volumes import DataVolumes
+from dmake.kubernetes_rollout import KubernetesRollouts
+from dmake.kubernetes_validation import KubernetesManifests
+from dmake.profiler import Profiler
 
 tag_push_error_msg = "Unauthorized to push the current state of deployment to git server. If the repository belongs to you, please check that the credentials declared in the DMAKE_JENKINS_SSH_AGENT_CREDENTIALS and DMAKE_JENKINS_HTTP_CREDENTIALS allow you to write to the repository."
 
@@ -302,6 +311,121 @@ def activate_service(loaded_files, service_providers, service_dependencies, comm
 
 ###############################################################################
 
+def generate_docker_bake(commands):
+    """All the `build_docker` nodes images are built at once from a single bake file."""
+    bake_file = DockerBake.write(common.tmp_dir)
+    common.logger.info("- docker buildx bake: {}".format(', '.join(DockerBake.targets.keys())))
+    append_command(commands, 'echo', message = '- Running docker buildx bake')
+    append_command(commands, 'sh', shell = 'dmake_build_docker_bake "%s"' % (bake_file))
+
+def generate_push_images(commands):
+    """All the images to deploy are pushed at once before deploying."""
+    images_file = DockerPush.write(common.tmp_dir)
+    common.logger.info("- push: {}".format(', '.join(DockerPush.images.keys())))
+    append_command(commands, 'echo', message = '- Pushing docker images')
+    append_command(commands, 'sh', shell = 'dmake_push_docker_images "%s"' % (images_file))
+
+def generate_pull_images(commands):
+    """All the external images needed by the plan are pulled at once."""
+    images_file = DockerPrefetch.write(common.tmp_dir)
+    digest_cache_file = os.path.join(common.cache_dir, 'docker_pull_digests.json')
+    common.logger.info("- pull: {}".format(', '.join(DockerPrefetch.images.keys())))
+    append_command(commands, 'sh', shell = 'dmake_pull_docker_images "%s" "%s"' % (images_file, digest_cache_file))
+
+def generate_sync_data_volumes(commands):
+    """All the remote data volumes needed by the plan are synced at once, each source only once."""
+    sources_file = DataVolumes.write(common.tmp_dir)
+    common.logger.info("- sync: {}".format(', '.join(DataVolumes.sources.keys())))
+    append_command(commands, 'sh', shell = 'dmake_sync_data_volumes "%s"' % (sources_file))
+
+def generate_prefetch(commands):
+    """The external images and data volumes needed by the plan are fetched concurrently, at the start of the plan."""
+    steps = []
+    if len(DockerPrefetch.images) > 0:
+        steps.append(('images', generate_pull_images))
+    if len(DataVolumes.sources) > 0:
+        steps.append(('data volumes', generate_sync_data_volumes))
+    if len(steps) == 0:
+        return
+    common.logger.info("## Prefetching ##")
+    append_command(commands, 'stage', name = 'Prefetching')
+    if len(steps) == 1:
+        steps[0][1](commands)
+    else:
+        append_command(commands, 'parallel')
+        for name, generate in steps:
+            append_command(commands, 'parallel_branch', name = name)
+            generate(commands)
+            append_command(commands, 'parallel_branch_end')
+        append_command(commands, 'parallel_end')
+    append_command(commands, 'stage_end')
+
+def generate_readiness_probes(commands, readiness_probes):
+    """
+    Run concurrently the readiness probes [(service_name, container_name, probe_cmd)]
+    of daemons started at the same dependency level, in a single step.
+    """
+    lines = ['#!/bin/bash',
+             'test "${DMAKE_DEBUG}" = "1" && set -x',
+             'set -o pipefail',
+             'PIDS=( )',
+             'NAMES=( )']
+    for service_name, container_name, probe_cmd in readiness_probes:
+        lines.append('dmake_exec_docker "%s" %s 2>&1 | sed "s|^|[%s] |" &' % (container_name, probe_cmd, service_name))
+        lines.append('PIDS+=( $! ); NAMES+=( "%s" )' % (service_name))
+    lines += ['FAILED=( )',
+              'for I in "${!PIDS[@]}"; do',
+              '    wait ${PIDS[$I]} || FAILED+=( "${NAMES[$I]}" )',
+              'done',
+              'if [ ${#FAILED[@]} -gt 0 ]; then',
+              '    echo "Readiness probe failed for: ${FAILED[*]}"',
+              '    exit 1',
+              'fi']
+    script = '\n'.join(lines) + '\n'
+    script_file = os.path.join(common.tmp_dir, 'readiness_probes_%s.sh' % (hashlib.md5(script.encode('utf-8')).hexdigest()[:10]))
+    with open(script_file, 'w') as f:
+        f.write(script)
+    common.logger.info("- readiness probes: {}".format(', '.join(service_name for service_name, _, _ in readiness_probes)))
+    append_command(commands, 'echo', message = '- Waiting for {}'.format(', '.join(service_name for service_name, _, _ in readiness_probes)))
+    append_command(commands, 'sh', shell = 'bash "%s"' % (script_file))
+
+def is_gpu_released_with_node(node):
+    """Daemons (`run`, `run_link` nodes) keep their GPUs until the end of the plan: the other nodes release them when they are done."""
+    return node[0] not in ['run', 'run_link']
+
+def get_gpu_lock_scope(nodes_groups, nodes_need_gpu):
+    """
+    Return: (index of the first group of `nodes_groups` starting a GPU daemon, number of GPUs locked from there),
+    or (None, 0). This lock is held until the end of the plan, shared by all the following nodes;
+    the GPU nodes before it lock their own GPUs.
+    """
+    for index, nodes in enumerate(nodes_groups):
+        if any(nodes_need_gpu.get(node) and not is_gpu_released_with_node(node) for node in nodes):
+            quantity = max(int(nodes_need_gpu.get(node, 0)) for group in nodes_groups[index:] for node in group)
+            return index, quantity
+    return None, 0
+
+def generate_gpu_lock(commands, quantity):
+    append_command(commands, 'lock', label='GPUS', quantity=quantity, variable='DMAKE_GPU')
+
+def generate_resources_locks(commands, resources):
+    """
+    Lock the parallel builders resources {label: quantity} taken by a plan node, capped to the declared capacities.
+    Return: the number of locks to close.
+    """
+    locks = 0
+    # always in the same order: no deadlock between branches
+    for label in sorted(common.PARALLEL_BUILDERS_CAPACITY_VARIABLES):
+        quantity = resources.get(label, 0)
+        if label in common.parallel_builders_capacity:
+            quantity = min(quantity, common.parallel_builders_capacity[label])
+        if quantity > 0:
+            append_command(commands, 'lock', label=label, quantity=quantity)
+            locks += 1
+    return locks
+
+###############################################################################
+
 def display_command_node(node):
     command, service, service_customization = node
     # daemon name: <app_name>/<service_name><optional_unique_suffix>; service already contains "<app_name>/"
@@ -353,8 +477,9 @@ def load_dmake_file(loaded_files, blocklist, service_providers, service_dependen
         return
 
     # Load YAML and check version
-    with open(file, 'r') as stream:
-        data = common.yaml_ordered_load(stream)
+    with Profiler.phase('YAML load'):
+        with open(file, 'r') as stream:
+            data = common.yaml_ordered_load(stream)
     if 'dmake_version' not in data:
         raise DMakeException("Missing field 'dmake_version' in %s" % file)
     version = str(data['dmake_version'])
@@ -363,7 +488,8 @@ def load_dmake_file(loaded_files, blocklist, service_providers, service_dependen
 
     # Load appropriate version (TODO: versionning)
     if version == '0.1':
-        dmake_file = DMakeFile(file, data)
+        with Profiler.phase('validation'):
+            dmake_file = DMakeFile(file, data)
     loaded_files[file] = dmake_file
 
     # Blocklist should be on child file because they are loaded this way
@@ -478,14 +604,27 @@ def order_dependencies(dependencies, leaves):
 
 ###############################################################################
 
-def make_path_unique_per_variant(path, service_name):
-    """If multi variant: prefix filename with `<variant>-`"""
+def make_path_unique_per_variant(path, service_name, shard=None):
+    """If multi variant: prefix filename with `<variant>-`; if test shard: prefix it with `shard-<index>-`"""
+    head, tail = os.path.split(path)
+    if shard is not None:
+        tail = 'shard-%d-%s' % (shard, tail)
     service_name_parts = service_name.split(':')
     if len(service_name_parts) == 2:
         variant = service_name_parts[1]
-        head, tail = os.path.split(path)
-        path = os.path.join(head, '%s-%s' % (variant, tail))
-    return path
+        tail = '%s-%s' % (variant, tail)
+    return os.path.join(head, tail)
+
+def generate_collect_tests_results(entries, allow_missing):
+    """`entries`: [(test run name, container path, host path)], see `dmake_collect_tests_results`"""
+    args = ' '.join(['"%s" "%s" "%s"' % entry for entry in entries])
+    return 'dmake_collect_tests_results %s%s' % ('--allow-missing ' if allow_missing else '', args)
+
+def generate_merge_junit_reports(merged_report, shards_reports, allow_missing):
+    cmd = 'dmake_merge_junit_reports "%s" %s' % (merged_report, ' '.join(['"%s"' % shard_report for shard_report in shards_reports]))
+    if allow_missing:
+        cmd += ' || echo "No junit report to merge"'
+    return cmd
 
 ###############################################################################
 
@@ -500,9 +639,22 @@ def generate_command_pipeline(file, cmds):
     if common.build_description is not None:
         write_line("currentBuild.description = '%s'" % common.build_description.replace("'", "\\'"))
     write_line("def dmake_echo(message) { sh(script: \"echo '${message}'\", label: message) }")
+    if common.execution_trace:
+        # the events are kept in memory, and written at the end (see dmake.trace)
+        write_line("DMAKE_TRACE_EVENTS = []")
+        write_line('def dmake_trace(fields) { DMAKE_TRACE_EVENTS << "{\\"ts\\": ${System.currentTimeMillis() * 1000}, ${fields}}".toString() }')
     write_line('try {')
     indent_level += 1
 
+    # name of the opened parallel branches (one trace track per branch), and stages
+    trace_branches = []
+    trace_stages = []
+
+    def write_trace(phase, category, name):
+        if common.execution_trace:
+            fields = trace.get_event_fields(phase, category, trace.get_track(trace_branches), name)
+            write_line("dmake_trace('%s')" % fields.replace('\\', '\\\\').replace("'", "\\'"))
+
     cobertura_tests_results_dir = os.path.join(common.relative_cache_dir, 'cobertura_tests_results')
     emit_cobertura = False
 
@@ -520,7 +672,10 @@ def generate_command_pipeline(file, cmds):
             write_line('')
             write_line("stage('%s') {" % name)
             indent_level += 1
+            trace_stages.append(kwargs['name'])
+            write_trace('B', 'stage', kwargs['name'])
         elif cmd == "stage_end":
+            write_trace('E', 'stage', trace_stages.pop())
             indent_level -= 1
             write_line("}")
         elif cmd == "parallel":
@@ -541,7 +696,9 @@ def generate_command_pipeline(file, cmds):
             name = kwargs['name'].replace("'", "\\'")
             write_line("'%s': {" % name)
             indent_level += 1
+            trace_branches.append(kwargs['name'])
         elif cmd == "parallel_branch_end":
+            trace_branches.pop()
             indent_level -= 1
             write_line("},")
         elif cmd == "lock":
@@ -549,8 +706,12 @@ def generate_command_pipeline(file, cmds):
                 kwargs['quantity'] = 1
             if 'variable' not in kwargs:
                 kwargs['variable'] = ""  # empty variable is accepted by the lock step as "'variable' not set"
+            # lock wait, apart from the execution
+            wait_name = 'lock {label} x{quantity}'.format(**kwargs)
+            write_trace('B', 'lock', wait_name)
             write_line("lock(label: '{label}', quantity: {quantity}, variable: '{variable}') {{".format(**kwargs))
             indent_level += 1
+            write_trace('E', 'lock', wait_name)
         elif cmd == "lock_end":
             indent_level -= 1
             write_line("}")
@@ -582,9 +743,13 @@ def generate_command_pipeline(file, cmds):
             commands = kwargs['shell']
             if isinstance(commands, str):
                 commands = [commands]
-            commands = [common.escape_cmd(c) for c in commands]
             if len(commands) == 0:
                 return
+            name = trace.get_command_name(commands[0])
+            if len(commands) > 1:
+                name = '%d parallel commands: %s' % (len(commands), name)
+            commands = [common.escape_cmd(c) for c in commands]
+            write_trace('B', 'command', name)
             if len(commands) == 1:
                 write_line('sh("%s")' % commands[0])
             else:
@@ -594,12 +759,20 @@ def generate_command_pipeline(file, cmds):
                     commands_list.append("cmd%d: { sh('%s') }" % c)
                 write_line(','.join(commands_list))
                 write_line(')')
+            write_trace('E', 'command', name)
         elif cmd == "read_sh":
             file_output = os.path.join(common.cache_dir, "output_%s" % uuid.uuid4())
+            name = trace.get_command_name(kwargs['shell'])
+            write_trace('B', 'command', name)
             write_line("sh('%s > %s')" % (kwargs['shell'], file_output))
+            write_trace('E', 'command', name)
             write_line("env.%s = readFile '%s'" % (kwargs['var'], file_output))
             if kwargs['fail_if_empty']:
                 write_line("sh('if [ -z \"${%s}\" ]; then exit 1; fi')" % kwargs['var'])
+        elif cmd == "trace_begin":
+            write_trace('B', kwargs['category'], kwargs['name'])
+        elif cmd == "trace_end":
+            write_trace('E', kwargs['category'], kwargs['name'])
         elif cmd == "env":
             write_line('env.%s = "%s"' % (kwargs['var'], kwargs['value']))
         elif cmd == "git_tag":
@@ -628,26 +801,53 @@ def generate_command_pipeline(file, cmds):
                 write_line('} catch(error) {')
                 write_line("""  sh('echo "%s"')""" % error_msg.replace("'", "\\'"))
                 write_line('}')
-        elif cmd == "junit":
-            container_report = os.path.join(kwargs['mount_point'], kwargs['report'])
-            host_report = os.path.join(common.relative_cache_dir, 'tests_results', str(uuid.uuid4()), kwargs['service_name'].replace(':', '-'), kwargs['report'])
-            write_line('''sh('dmake_test_get_results "%s" "%s" "%s"')''' % (kwargs['service_name'], container_report, host_report))
-            write_line("junit keepLongStdio: true, testResults: '%s'" % host_report)
-            write_line('''sh('rm -rf "%s"')''' % host_report)
-        elif cmd == "cobertura":
-            container_report = os.path.join(kwargs['mount_point'], kwargs['report'])
-            host_report = os.path.join(cobertura_tests_results_dir, str(uuid.uuid4()), kwargs['service_name'].replace(':', '-'), kwargs['report'])
-            if not host_report.endswith('.xml'):
-                raise DMakeException("`cobertura_report` must end with '.xml' in service '%s'" % kwargs['service_name'])
-            write_line('''sh('dmake_test_get_results "%s" "%s" "%s"')''' % (kwargs['service_name'], container_report, host_report))
-            # coberturaPublisher plugin only supports one step, so we delay generating it, and make it get all reports
-            emit_cobertura = True
-        elif cmd == "publishHTML":
-            container_html_directory = os.path.join(kwargs['mount_point'], kwargs['directory'])
-            host_html_directory = os.path.join(common.cache_dir, 'tests_results', str(uuid.uuid4()), kwargs['service_name'].replace(':', '-'), kwargs['directory'])
-            write_line('''sh('dmake_test_get_results "%s" "%s" "%s"')''' % (kwargs['service_name'], container_html_directory, host_html_directory.rstrip('/')))
-            write_line("publishHTML(target: [allowMissing: false, alwaysLinkToLastBuild: false, keepAll: true, reportDir: '%s', reportFiles: '%s', reportName: '%s'])" % (host_html_directory, kwargs['index'], kwargs['title'].replace("'", "\'")))
-            write_line('''sh('rm -rf "%s"')''' % host_html_directory)
+        elif cmd == "tests_results":
+            # all the results are collected at once, then published
+            allow_missing = kwargs['allow_missing']
+            entries = []
+            merges = []
+            publishers = []
+            to_remove = []
+            for report_cmd, report in kwargs['reports']:
+                if report_cmd == "junit":
+                    container_report = os.path.join(report['mount_point'], report['report'])
+                    host_dir = os.path.join(common.relative_cache_dir, 'tests_results', str(uuid.uuid4()), report['service_name'].replace(':', '-'))
+                    host_report = os.path.join(host_dir, report['report'])
+                    if report['shards'] == [None]:
+                        entries.append((report['service_name'], container_report, host_report))
+                        to_remove.append(host_report)
+                    else:
+                        shards_reports = [os.path.join(host_dir, 'shard-%d' % shard, report['report']) for shard in report['shards']]
+                        entries += [(common.get_shard_service_name(report['service_name'], shard), container_report, shard_report) for shard, shard_report in zip(report['shards'], shards_reports)]
+                        merges.append((host_report, shards_reports))
+                        to_remove.append(host_dir)
+                    publishers.append("junit %skeepLongStdio: true, testResults: '%s'" % ('allowEmptyResults: true, ' if allow_missing else '', host_report))
+                elif report_cmd == "cobertura":
+                    container_report = os.path.join(report['mount_point'], report['report'])
+                    host_report = os.path.join(cobertura_tests_results_dir, str(uuid.uuid4()), report['service_name'].replace(':', '-'), report['report'])
+                    if not host_report.endswith('.xml'):
+                        raise DMakeException("`cobertura_report` must end with '.xml' in service '%s'" % report['service_name'])
+                    # the coverage reports of the shards are merged by the coverage plugin
+                    entries.append((common.get_shard_service_name(report['service_name'], report['shard']), container_report, host_report))
+                    # coberturaPublisher plugin only supports one step, so we delay generating it, and make it get all reports
+                    emit_cobertura = True
+                elif report_cmd == "publishHTML":
+                    container_html_directory = os.path.join(report['mount_point'], report['directory'])
+                    host_html_directory = os.path.join(common.cache_dir, 'tests_results', str(uuid.uuid4()), report['service_name'].replace(':', '-'), report['directory'])
+                    entries.append((common.get_shard_service_name(report['service_name'], report['shard']), container_html_directory, host_html_directory.rstrip('/')))
+                    publishers.append("publishHTML(target: [allowMissing: %s, alwaysLinkToLastBuild: false, keepAll: true, reportDir: '%s', reportFiles: '%s', reportName: '%s'])" % ('true' if allow_missing else 'false', host_html_directory, report['index'], report['title'].replace("'", "\'")))
+                    to_remove.append(host_html_directory)
+                else:
+                    raise DMakeException("Unknown tests results command %s" % report_cmd)
+            write_trace('B', 'command', 'tests results')
+            write_line('''sh('%s')''' % generate_collect_tests_results(entries, allow_missing))
+            for merged_report, shards_reports in merges:
+                write_line('''sh('%s')''' % generate_merge_junit_reports(merged_report, shards_reports, allow_missing))
+            for publisher in publishers:
+                write_line(publisher)
+            for path in to_remove:
+                write_line('''sh('rm -rf "%s"')''' % path)
+            write_trace('E', 'command', 'tests results')
         else:
             raise DMakeException("Unknown command %s" % cmd)
 
@@ -674,6 +874,19 @@ def generate_command_pipeline(file, cmds):
         write_line("  dmake_echo 'Late cobertura_report test result collection failed, it may be because the test steps were not reached (earlier error: check logs/steps above/before), or because the cobertura_report is misconfigured (check the path config).'")
         write_line("}")
 
+    if common.execution_trace:
+        events_file = os.path.join(common.relative_cache_dir, trace.EVENTS_DIR, 'events.jsonl')
+        trace_file = os.path.join(common.relative_cache_dir, trace.TRACE_FILE)
+        write_line("try {")
+        indent_level += 1
+        write_line("writeFile(file: '%s', text: DMAKE_TRACE_EVENTS.join('\\n') + '\\n')" % (events_file))
+        write_line("sh('dmake_trace_export %s %s')" % (events_file, trace_file))
+        write_line("archiveArtifacts(artifacts: '%s', allowEmptyArchive: true)" % (trace_file))
+        indent_level -= 1
+        write_line("} catch (error) {")
+        write_line("  dmake_echo 'Execution trace export failed, the build result is not affected.'")
+        write_line("}")
+
     write_line('sh("dmake_clean")')
     indent_level -= 1
     write_line('}')
@@ -722,6 +935,44 @@ function ignoreErrors()
     set +e
 }
 
+""")
+
+    background_parallel_stack = []
+    # name of the opened background parallel branches
+    parallel_branch_stack = []
+    # label of the opened locks which are not ignored
+    lock_stack = []
+    # name of the opened parallel branches (one trace track per branch), and stages
+    trace_branches = []
+    trace_stages = []
+
+    def write_trace(phase, category, name):
+        if common.execution_trace:
+            fields = trace.get_event_fields(phase, category, trace.get_track(trace_branches), name)
+            write_line("dmake_trace '%s'" % fields.replace("'", "'\\''"))
+
+    if common.execution_trace:
+        # the events are exported when the plan exits, whatever its result (see dmake.trace)
+        events_dir = os.path.join(common.cache_dir, trace.EVENTS_DIR)
+        write_line('DMAKE_TRACE_EVENTS_FILE="%s/events-$$.jsonl"' % (events_dir))
+        write_line('DMAKE_TRACE_FILE="%s"' % (os.path.join(common.cache_dir, trace.TRACE_FILE)))
+        write_line('mkdir -p "%s"' % (events_dir))
+        write_line("""
+function dmake_trace()
+{
+    # microseconds, without forking from bash 5; `date +%N` is not portable (BSD/macOS)
+    local ts=${EPOCHREALTIME/[.,]/}
+    if [ -z "${ts}" ]; then ts=$(python3 -c 'import time; print(int(time.time() * 1e6))'); fi
+    echo "{\\"ts\\": ${ts}, $1}" >> "${DMAKE_TRACE_EVENTS_FILE}"
+}
+
+function dmake_trace_exit()
+{
+    local exit_code=$?
+    dmake_trace_export "${DMAKE_TRACE_EVENTS_FILE}" "${DMAKE_TRACE_FILE}" && rm -f "${DMAKE_TRACE_EVENTS_FILE}" || echo "Execution trace export failed"
+    exit ${exit_code}
+}
+trap dmake_trace_exit EXIT
 """)
 
     write_line('set -e')
@@ -730,24 +981,54 @@ function ignoreErrors()
             write_line("")
             write_line("{ echo -e '\n## %s ##'" % kwargs['name'])
             indent_level += 1
+            trace_stages.append(kwargs['name'])
+            write_trace('B', 'stage', kwargs['name'])
         elif cmd == "stage_end":
+            write_trace('E', 'stage', trace_stages.pop())
             indent_level -= 1
             write_line("}")
         elif cmd == "parallel":
-            # parallel not supported with bash, fallback to running sequentially
-            pass
+            # only `background` parallel blocks are run in parallel with bash (as background jobs), the other ones fallback to running sequentially
+            background_parallel_stack.append(kwargs['background'])
+            if background_parallel_stack[-1]:
+                write_line("DMAKE_PARALLEL_PIDS_%d=()" % len(background_parallel_stack))
+                write_line("DMAKE_PARALLEL_NAMES_%d=()" % len(background_parallel_stack))
         elif cmd == "parallel_end":
-            pass
+            if background_parallel_stack[-1]:
+                # wait for all the branches, then report all the failed ones
+                depth = len(background_parallel_stack)
+                write_line("DMAKE_PARALLEL_FAILED_%d=()" % depth)
+                write_line('for i in "${!DMAKE_PARALLEL_PIDS_%d[@]}"; do wait ${DMAKE_PARALLEL_PIDS_%d[$i]} || DMAKE_PARALLEL_FAILED_%d+=("${DMAKE_PARALLEL_NAMES_%d[$i]}"); done' % (depth, depth, depth, depth))
+                write_line('if [ ${#DMAKE_PARALLEL_FAILED_%d[@]} -ne 0 ]; then echo "Failed parallel branches:"; printf -- "- %%s\\n" "${DMAKE_PARALLEL_FAILED_%d[@]}"; exit 1; fi' % (depth, depth))
+            background_parallel_stack.pop()
         elif cmd == "parallel_branch":
-            # parallel_branch not supported with bash, fallback to running sequentially
-            pass
+            trace_branches.append(kwargs['name'])
+            if background_parallel_stack[-1]:
+                parallel_branch_stack.append(kwargs['name'])
+                write_line("(")
+                indent_level += 1
         elif cmd == "parallel_branch_end":
-            pass
+            trace_branches.pop()
+            if background_parallel_stack[-1]:
+                indent_level -= 1
+                write_line(") &")
+                write_line("DMAKE_PARALLEL_PIDS_%d+=($!)" % len(background_parallel_stack))
+                write_line("DMAKE_PARALLEL_NAMES_%d+=('%s')" % (len(background_parallel_stack), parallel_branch_stack.pop().replace("'", "'\\''")))
         elif cmd == "lock":
-            # lock not supported with bash, fallback to ignoring locks
-            pass
+            # only the parallel builders resources are locked with bash, between concurrent local executions; fallback to ignoring the other locks
+            if kwargs['label'] in common.PARALLEL_BUILDERS_CAPACITY_VARIABLES:
+                # lock wait, apart from the execution
+                wait_name = 'lock %s x%s' % (kwargs['label'], kwargs.get('quantity', 1))
+                write_trace('B', 'lock', wait_name)
+                write_line("dmake_resources_lock acquire %s %s $$" % (kwargs['label'], kwargs.get('quantity', 1)))
+                write_trace('E', 'lock', wait_name)
+                lock_stack.append(kwargs['label'])
+            else:
+                lock_stack.append(None)
         elif cmd == "lock_end":
-            pass
+            label = lock_stack.pop()
+            if label is not None:
+                write_line("dmake_resources_lock release %s $$" % (label))
         elif cmd == "timeout":
             # timeout not supported with bash, fallback to ignoring timeouts
             pass
@@ -777,25 +1058,57 @@ function ignoreErrors()
             if isinstance(commands, str):
                 commands = [commands]
             for c in commands:
+                name = trace.get_command_name(c)
+                write_trace('B', 'command', name)
                 write_line("%s" % c)
+                write_trace('E', 'command', name)
         elif cmd == "read_sh":
+            name = trace.get_command_name(kwargs['shell'])
+            write_trace('B', 'command', name)
             write_line("%s=`%s`" % (kwargs['var'], kwargs['shell']))
+            write_trace('E', 'command', name)
             if kwargs['fail_if_empty']:
                 write_line("if [ -z \"${%s}\" ]; then exit 1; fi" % kwargs['var'])
+        elif cmd == "trace_begin":
+            write_trace('B', kwargs['category'], kwargs['name'])
+        elif cmd == "trace_end":
+            write_trace('E', kwargs['category'], kwargs['name'])
         elif cmd == "env":
             write_line('%s="%s"' % (kwargs['var'], kwargs['value'].replace('"', '\\"')))
             write_line('export %s' % kwargs['var'])
         elif cmd == "git_tag":
             write_line('git tag --force %s' % kwargs['tag'])
             write_line('git push --force %s refs/tags/%s || echo %s' % (common.remote, kwargs['tag'], tag_push_error_msg))
-        elif cmd == "junit" or cmd == "cobertura":
-            container_report = os.path.join(kwargs['mount_point'], kwargs['report'])
-            host_report = make_path_unique_per_variant(kwargs['report'], kwargs['service_name'])
-            write_line('dmake_test_get_results "%s" "%s" "%s"' % (kwargs['service_name'], container_report, host_report))
-        elif cmd == "publishHTML":
-            container_html_directory = os.path.join(kwargs['mount_point'], kwargs['directory'])
-            host_html_directory = make_path_unique_per_variant(kwargs['directory'], kwargs['service_name'])
-            write_line('dmake_test_get_results "%s" "%s" "%s"' % (kwargs['service_name'], container_html_directory, host_html_directory))
+        elif cmd == "tests_results":
+            allow_missing = kwargs['allow_missing']
+            entries = []
+            merges = []
+            for report_cmd, report in kwargs['reports']:
+                if report_cmd == "junit":
+                    container_report = os.path.join(report['mount_point'], report['report'])
+                    host_report = make_path_unique_per_variant(report['report'], report['service_name'])
+                    if report['shards'] == [None]:
+                        entries.append((report['service_name'], container_report, host_report))
+                    else:
+                        shards_reports = [make_path_unique_per_variant(report['report'], report['service_name'], shard) for shard in report['shards']]
+                        entries += [(common.get_shard_service_name(report['service_name'], shard), container_report, shard_report) for shard, shard_report in zip(report['shards'], shards_reports)]
+                        merges.append((host_report, shards_reports))
+                elif report_cmd == "cobertura":
+                    container_report = os.path.join(report['mount_point'], report['report'])
+                    host_report = make_path_unique_per_variant(report['report'], report['service_name'], report['shard'])
+                    entries.append((common.get_shard_service_name(report['service_name'], report['shard']), container_report, host_report))
+                elif report_cmd == "publishHTML":
+                    container_html_directory = os.path.join(report['mount_point'], report['directory'])
+                    host_html_directory = make_path_unique_per_variant(report['directory'].rstrip('/'), report['service_name'], report['shard'])
+                    entries.append((common.get_shard_service_name(report['service_name'], report['shard']), container_html_directory, host_html_directory))
+                else:
+                    raise DMakeException("Unknown tests results command %s" % report_cmd)
+            write_trace('B', 'command', 'tests results')
+            write_line(generate_collect_tests_results(entries, allow_missing))
+            for merged_report, shards_reports in merges:
+                write_line(generate_merge_junit_reports(merged_report, shards_reports, allow_missing))
+                write_line('rm -f %s' % ' '.join(['"%s"' % shard_report for shard_report in shards_reports]))
+            write_trace('E', 'command', 'tests results')
         else:
             raise DMakeException("Unknown command %s" % cmd)
 
@@ -854,6 +1167,7 @@ def make(options, parse_files_only=False):
         auto_complete = True
 
     # Load build files
+    Profiler.set_phase('discovery')
     build_files = load_dmake_files_list()
     if len(build_files) == 0:
         raise DMakeException('No dmake.yml file found !')
@@ -870,6 +1184,7 @@ def make(options, parse_files_only=False):
         return loaded_files
 
     # Register all apps and services in the repo
+    Profiler.set_phase('graph building')
     docker_links = {}
     services = {}
     for file, dmake_file in loaded_files.items():
@@ -1014,12 +1329,17 @@ def make(options, parse_files_only=False):
         if not common.is_pr:
             ordered_build_files.append(('Deploying', list(deploy)))
 
+    Profiler.set_phase('command generation')
     common.logger.info("Here is the plan:")
     # Generate the list of command to run
     common.logger.info("Generating commands...")
     all_commands = []
     nodes_commands = {}
     nodes_need_gpu = {}
+    nodes_resources = {}
+    nodes_readiness_probes = {}
+    docker_bake_commands = []
+    push_images_commands = []
 
     init_commands = []
     append_command(init_commands, 'env', var = "REPO", value = common.repo)
@@ -1040,6 +1360,11 @@ def make(options, parse_files_only=False):
         append_command(all_commands, 'stage', name = stage)
 
         stage_commands = []
+        # readiness probes of the already started daemons, grouped until a node depends on one of them
+        pending_readiness_probes = {}
+        # nodes with commands, and where their commands start in stage_commands: for the GPU daemons lock
+        stage_nodes = []
+        stage_nodes_index = {}
         for node, order in commands:
             # Sanity check
             sub_task_orders = [build_files_order[a] for a in service_dependencies[node]]
@@ -1052,7 +1377,12 @@ def make(options, parse_files_only=False):
             app_name = dmake_file.get_app_name()
             links = docker_links[app_name]
 
+            if any(dependency in pending_readiness_probes for dependency in service_dependencies[node]):
+                generate_readiness_probes(stage_commands, sum(pending_readiness_probes.values(), []))
+                pending_readiness_probes = {}
+
             step_commands = []
+            readiness_probes = [] if common.grouped_readiness_probes else None
             # temporarily reset need_gpu to isolate which step triggers it, for potential later parallel execution
             restore_need_gpu = common.need_gpu
             common.need_gpu = False
@@ -1066,7 +1396,7 @@ def make(options, parse_files_only=False):
                 elif command == "test":
                     dmake_file.generate_test(step_commands, service, links)
                 elif command == "run":
-                    dmake_file.generate_run(step_commands, service, links, service_customization)
+                    dmake_file.generate_run(step_commands, service, links, service_customization, readiness_probes)
                 elif command == "run_link":
                     dmake_file.generate_run_link(step_commands, service, links)
                 elif command == "build_docker":
@@ -1075,33 +1405,69 @@ def make(options, parse_files_only=False):
                     dmake_file.generate_deploy(step_commands, service)
                 else:
                     raise Exception("Unknown command '%s'" % command)
+                nodes_resources[node] = dmake_file.get_node_resources(command, service, links)
             except DMakeException as e:
                 print(('ERROR in file %s:\n' % file) + str(e))
                 sys.exit(1)
 
             nodes_commands[node] = step_commands
             nodes_need_gpu[node] = common.need_gpu
+            if readiness_probes:
+                nodes_readiness_probes[node] = readiness_probes
+                pending_readiness_probes[node] = readiness_probes
             common.need_gpu = restore_need_gpu
 
             if len(step_commands) > 0:
+                # GPU resource lock around the node only, unless a GPU daemon already holds GPUs until the end of the stage
+                lock_gpu = nodes_need_gpu[node] and get_gpu_lock_scope([stage_nodes + [node]], nodes_need_gpu)[0] is None
+                stage_nodes.append(node)
+                stage_nodes_index[node] = len(stage_commands)
                 node_display_str = display_command_node(node)
                 common.logger.info("- {}".format(node_display_str))
+                if lock_gpu:
+                    generate_gpu_lock(stage_commands, nodes_need_gpu[node])
+                # concurrent local executions share the machine: same resources locks as the parallel branches
+                resources_locks = generate_resources_locks(stage_commands, nodes_resources[node]) if common.local_resources_lock and command != 'deploy' else 0
                 append_command(stage_commands, 'echo', message = '- Running {}'.format(node_display_str))
+                append_command(stage_commands, 'trace_begin', name=node_display_str, category='node')
                 stage_commands += step_commands
-
-        # GPU resource lock
-        # `common.need_gpu` is set during Testing commands generations: need to delay adding commands to all_commands to create the gpu lock if needed around the Testing stage
-        lock_gpu = (stage == "Running App") and common.need_gpu
-        if lock_gpu:
-            append_command(all_commands, 'lock', label='GPUS', variable='DMAKE_GPU')
+                append_command(stage_commands, 'trace_end', name=node_display_str, category='node')
+                for _ in range(resources_locks):
+                    append_command(stage_commands, 'lock_end')
+                if lock_gpu:
+                    append_command(stage_commands, 'lock_end')
+
+        if pending_readiness_probes:
+            generate_readiness_probes(stage_commands, sum(pending_readiness_probes.values(), []))
+
+        # GPU daemons lock: from the first GPU daemon until the end of the stage
+        gpu_lock_index, gpu_lock_quantity = get_gpu_lock_scope([[node] for node in stage_nodes], nodes_need_gpu)
+        if gpu_lock_index is not None:
+            gpu_lock_commands = []
+            generate_gpu_lock(gpu_lock_commands, gpu_lock_quantity)
+            stage_commands[stage_nodes_index[stage_nodes[gpu_lock_index]]:stage_nodes_index[stage_nodes[gpu_lock_index]]] = gpu_lock_commands
+            append_command(stage_commands, 'lock_end')
+
+        if stage == 'Building App' and common.docker_bake and len(DockerBake.targets) > 0:
+            generate_docker_bake(docker_bake_commands)
+            stage_commands += docker_bake_commands
+
+        if stage == 'Deploying' and len(DockerPush.images) > 0:
+            generate_push_images(push_images_commands)
+            stage_commands = push_images_commands + stage_commands
 
         all_commands += stage_commands
 
-        if lock_gpu:
-            append_command(all_commands, 'lock_end')
-
         append_command(all_commands, 'stage_end')
 
+    # Validate the rendered Kubernetes manifests of all the deployments together
+    with Profiler.phase('validation'):
+        KubernetesManifests.validate()
+
+    # Prefetch the external images and data volumes needed by the plan, once all of them are known
+    prefetch_commands = []
+    generate_prefetch(prefetch_commands)
+    all_commands[len(init_commands):len(init_commands)] = prefetch_commands
 
     # Parallel execution?
     if common.parallel_execution:
@@ -1110,6 +1476,7 @@ def make(options, parse_files_only=False):
         # Parallel execution: drop all_commands, start again (but reuse already computed nodes_commands)
         all_commands = []
         all_commands += init_commands
+        all_commands += prefetch_commands
 
         # group nodes by height
         #   iterate on ordered_build_files instead of directly build_files_order to reuse common.is_pr filtering
@@ -1130,58 +1497,99 @@ def make(options, parse_files_only=False):
                     nodes_by_height[height] = []
                 nodes_by_height[height].append(node)
 
+        # docker bake: all `build_docker` nodes are built together, at a dedicated height after all base images, and before all the other nodes
+        docker_bake_height = None
+        if docker_bake_commands:
+            base_heights = [height for height, nodes in nodes_by_height.items() if any(node[0] == 'base' for node in nodes)]
+            docker_bake_height = max(base_heights, default=-1) + 1
+            nodes_by_height_bake = {}
+            for height, nodes in nodes_by_height.items():
+                for node in nodes:
+                    if node[0] == 'base':
+                        node_height = height
+                    elif node[0] == 'build_docker':
+                        node_height = docker_bake_height
+                    else:
+                        node_height = docker_bake_height + 1 + height
+                    nodes_by_height_bake.setdefault(node_height, []).append(node)
+            nodes_by_height = nodes_by_height_bake
+            max_height = max(nodes_by_height.keys())
+
         # inject back the deploy nodes as an extra height
         deploy_height = max_height + 1
         if deploy_nodes:
             nodes_by_height[deploy_height] = deploy_nodes
 
+        # GPU daemons lock: from the first height starting a GPU daemon until the end of the plan
+        heights = sorted(nodes_by_height.keys())
+        gpu_lock_index, gpu_lock_quantity = get_gpu_lock_scope([[node for node in nodes_by_height[height] if len(nodes_commands[node]) > 0] for height in heights], nodes_need_gpu)
+        gpu_lock_height = heights[gpu_lock_index] if gpu_lock_index is not None else None
+
         # generate parallel by height
-        gpu_locked = False
         for height, nodes in sorted(nodes_by_height.items()):
             common.logger.info("## height: %s ##" % (height))
 
             height_commands = []
-            height_need_gpu = False
+            height_readiness_probes = []
             for node in nodes:
                 step_commands = nodes_commands[node]
+                height_readiness_probes += nodes_readiness_probes.get(node, [])
 
                 if len(step_commands) == 0:
                     continue
 
-                height_need_gpu |= nodes_need_gpu[node]
+                # GPU resource lock around the node only, outside PARALLEL_BUILDERS: waiting for GPUs doesn't hold a builder
+                lock_gpu = nodes_need_gpu[node] and (gpu_lock_height is None or height < gpu_lock_height)
 
                 node_display_str = display_command_node(node)
                 common.logger.info("- {}".format(node_display_str))
 
                 append_command(height_commands, 'parallel_branch', name=node_display_str)
+                if lock_gpu:
+                    generate_gpu_lock(height_commands, nodes_need_gpu[node])
+                resources_locks = 0
                 if height != deploy_height:
                     # don't lock PARALLEL_BUILDERS on deploy height, it could lead to deployment deadlock if there is a deployment runtime dependancy between services
-                    append_command(height_commands, 'lock', label='PARALLEL_BUILDERS')
+                    # branches are packed by weight against the builders capacity
+                    resources_locks = generate_resources_locks(height_commands, nodes_resources[node])
 
                 append_command(height_commands, 'echo', message = '- Running {}'.format(node_display_str))
+                append_command(height_commands, 'trace_begin', name=node_display_str, category='node')
                 height_commands += step_commands
+                append_command(height_commands, 'trace_end', name=node_display_str, category='node')
 
-                if height != deploy_height:
-                    # don't lock PARALLEL_BUILDERS on deploy height, it could lead to deployment deadlock if there is a deployment runtime dependancy between services
+                for _ in range(resources_locks):
+                    append_command(height_commands, 'lock_end')
+                if lock_gpu:
                     append_command(height_commands, 'lock_end')
                 append_command(height_commands, 'parallel_branch_end')
 
-            if len(height_commands) == 0:
-                continue
+            if height == gpu_lock_height:
+                generate_gpu_lock(all_commands, gpu_lock_quantity)
 
-            if height_need_gpu and not gpu_locked:
-                append_command(all_commands, 'lock', label='GPUS', variable='DMAKE_GPU')
-                gpu_locked = True
+            if len(height_commands) == 0 and height != docker_bake_height:
+                continue
 
             append_command(all_commands, 'stage', name = "height {}".format(height))
-            append_command(all_commands, 'parallel')
-
-            all_commands += height_commands
-
-            append_command(all_commands, 'parallel_end')
+            if height == deploy_height:
+                all_commands += push_images_commands
+            if len(height_commands) > 0:
+                append_command(all_commands, 'parallel')
+
+                all_commands += height_commands
+
+                append_command(all_commands, 'parallel_end')
+            if height == deploy_height:
+                # all the services are applied: wait for their rollouts together
+                KubernetesRollouts.generate_monitor(all_commands)
+            if height_readiness_probes:
+                # all the daemons of this height are started: probe them together
+                generate_readiness_probes(all_commands, height_readiness_probes)
+            if height == docker_bake_height:
+                all_commands += docker_bake_commands
             append_command(all_commands, 'stage_end')
 
-        if gpu_locked:
+        if gpu_lock_height is not None:
             append_command(all_commands, 'lock_end')
 
     # end parallel_execution
@@ -1193,12 +1601,15 @@ def make(options, parse_files_only=False):
         append_command(all_commands, 'git_tag', tag = get_tag_name())
 
     # Generate output
+    Profiler.set_phase('output')
     if common.is_local:
         file_to_generate = os.path.join(common.tmp_dir, "DMakefile")
     else:
         file_to_generate = "DMakefile"
     generate_command(file_to_generate, all_commands)
     common.logger.info("Commands have been written to %s" % file_to_generate)
+    # the plan execution is not profiled
+    Profiler.stop()
 
     if common.command == "deploy" and common.is_local:
         r = input("Careful ! Are you sure you want to deploy ? [y/N]  ")
@@ -1211,6 +1622,8 @@ def make(options, parse_files_only=False):
         common.logger.info("===============")
         common.logger.info("Executing plan...")
         result = subprocess.call('bash %s' % file_to_generate, shell=True)
+        if common.execution_trace:
+            common.logger.info("Execution trace written to %s: open it with https://ui.perfetto.dev" % os.path.join(common.cache_dir, trace.TRACE_FILE))
         # Do not clean for the 'run' command
         do_clean = common.command not in ['build_docker', 'run']
         if result != 0 and common.command in ['shell', 'test']:
@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import dmake.common as common
+from dmake.common import DMakeException
+
+# beside the synced directory: it is mounted in the containers
+MANIFEST_SUFFIX = '.dmake_manifest.json'
+# `aws s3 sync` filters per command, to keep the command lines short
+S3_SYNC_MAX_KEYS = 200
+
+###############################################################################
+
+class DataVolumes(object):
+    """
+    Collect the remote data volumes sources needed by a plan: each source is
+    synced once, whatever the number of services mounting it, in a prefetch
+    step at the start of the plan (see `dmake_sync_data_volumes`).
+    """
+    SOURCES_FILE_NAME = 'data_volumes.txt'
+
+    # source URL to local path
+    sources = dict()
+
+    @staticmethod
+    def reset():
+        DataVolumes.sources = dict()
+
+    @staticmethod
+    def register(source, config_dir):
+        """Return: the local path of the synced `source`."""
+        scheme, path = source.split('://', 1)
+        local_path = os.path.join(config_dir, 'data_volumes', scheme, path.lstrip('/'))
+        DataVolumes.sources[source] = local_path
+        return local_path
+
+    @staticmethod
+    def write(tmp_dir):
+        sources_file = os.path.join(tmp_dir, DataVolumes.SOURCES_FILE_NAME)
+        with open(sources_file, 'w') as f:
+            for source, local_path in DataVolumes.sources.items():
+                f.write('%s %s\n' % (source, local_path))
+        return sources_file
+
+###############################################################################
+
+def escape_s3_filter(key):
+    """Return: the `aws s3` filter pattern matching exactly `key`."""
+    return key.replace('[', '[[]').replace('*', '[*]').replace('?', '[?]')
+
+
+class S3Backend(object):
+    def list_objects(self, source):
+        """Return: {key relative to the source prefix: ETag}."""
+        bucket, _, prefix = source[len('s3://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        output = subprocess.check_output(['aws', 's3api', 'list-objects-v2', '--bucket', bucket, '--prefix', prefix,
+                                          '--query', 'Contents[].[Key, ETag]', '--output', 'json'], universal_newlines=True)
+        return {key[len(prefix):]: etag.strip('"') for key, etag in (json.loads(output) or []) if not key.endswith('/')}
+
+    def sync(self, source, local_path, keys):
+        """Fetch only the `keys` objects, with `aws s3 sync` include filters."""
+        for index in range(0, len(keys), S3_SYNC_MAX_KEYS):
+            filters = ['--exclude', '*']
+            for key in keys[index:index + S3_SYNC_MAX_KEYS]:
+                filters += ['--include', escape_s3_filter(key)]
+            subprocess.check_call(['aws', 's3', 'sync', '--only-show-errors'] + filters + [source, local_path])
+
+
+class FileBackend(object):
+    """Local stand-in of a remote bucket, for tests: `file:///some/dir`."""
+    def list_objects(self, source):
+        root = source[len('file://'):]
+        objects = {}
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                with open(file_path, 'rb') as f:
+                    objects[os.path.relpath(file_path, root)] = hashlib.md5(f.read()).hexdigest()
+        return objects
+
+    def sync(self, source, local_path, keys):
+        root = source[len('file://'):]
+        for key in keys:
+            destination = os.path.join(local_path, key)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(os.path.join(root, key), destination)
+
+
+BACKENDS = {
+    's3': S3Backend,
+    'file': FileBackend,
+}
+
+
+def get_backend(source):
+    """
+    Return: (backend, backend source). With DMAKE_DATA_VOLUMES_S3_STANDIN_DIR,
+    s3://bucket/prefix is served by the local file://<dir>/bucket/prefix instead.
+    """
+    scheme, path = source.split('://', 1)
+    standin_dir = os.getenv('DMAKE_DATA_VOLUMES_S3_STANDIN_DIR')
+    if scheme == 's3' and standin_dir:
+        scheme = 'file'
+        source = 'file://' + os.path.join(standin_dir, path)
+    if scheme not in BACKENDS:
+        raise DMakeException("Unsupported data volume source '%s'" % (source))
+    return BACKENDS[scheme](), source
+
+###############################################################################
+
+def read_sources_file(sources_file):
+    sources = []
+    with open(sources_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            source, local_path = line.split(' ', 1)
+            sources.append((source, local_path))
+    return sources
+
+
+def get_manifest_path(local_path):
+    return local_path.rstrip('/') + MANIFEST_SUFFIX
+
+
+def read_manifest(local_path):
+    try:
+        with open(get_manifest_path(local_path), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_manifest(local_path, manifest):
+    with open(get_manifest_path(local_path), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def sync_source(source, local_path, max_age, now):
+    """
+    Sync `source` into `local_path`, according to the ETags manifest of the
+    previous sync: only changed objects are fetched, and nothing is listed if
+    the previous sync is more recent than `max_age` seconds.
+    Return: the list of fetched objects keys.
+    """
+    manifest = read_manifest(local_path)
+    if manifest is not None and manifest['source'] == source and now - manifest['synced_at'] < max_age:
+        common.logger.info("Data volume %s: synced %ds ago, skipping" % (source, now - manifest['synced_at']))
+        return []
+    backend, backend_source = get_backend(source)
+    objects = backend.list_objects(backend_source)
+    previous_objects = manifest['objects'] if manifest is not None and manifest['source'] == source else {}
+    changed = sorted(key for key, etag in objects.items()
+                     if previous_objects.get(key) != etag or not os.path.isfile(os.path.join(local_path, key)))
+    os.makedirs(local_path, exist_ok=True)
+    if changed:
+        common.logger.info("Data volume %s: syncing %d changed objects" % (source, len(changed)))
+        backend.sync(backend_source, local_path, changed)
+    else:
+        common.logger.info("Data volume %s: up to date" % (source))
+    write_manifest(local_path, {'source': source, 'synced_at': now, 'objects': objects})
+    return changed
+
+
+def sync_sources(sources, max_age, pool_size):
+    """
+    Sync all `sources` [(source, local_path)] concurrently.
+    Return: {source: fetched objects keys}.
+    """
+    if len(sources) == 0:
+        return {}
+    now = time.time()
+    pool = ThreadPool(min(pool_size, len(sources)))
+    try:
+        changed = pool.map(lambda source_path: sync_source(source_path[0], source_path[1], max_age, now), sources)
+    finally:
+        pool.close()
+    return {source: keys for (source, _), keys in zip(sources, changed)}
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Sync the data volumes listed in SOURCES_FILE ('<source> <local path>' lines).")
+    parser.add_argument("sources_file", help="Sources file")
+    args = parser.parse_args(argv)
+
+    max_age = int(os.getenv('DMAKE_DATA_VOLUMES_MAX_AGE', '0'))
+    pool_size = int(os.getenv('DMAKE_DATA_VOLUMES_PARALLELISM', '4'))
+    try:
+        sync_sources(read_sources_file(args.sources_file), max_age, pool_size)
+    except (DMakeException, subprocess.CalledProcessError) as e:
+        common.logger.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
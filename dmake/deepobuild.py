@@ -1,16 +1,22 @@
 import os
 import copy
 import functools
+import hashlib
 import json
 import uuid
 import importlib
 import re
-from string import Template
 from dmake.serializer import ValidationError, FieldSerializer, YAML2PipelineSerializer, SerializerType
 import dmake.common as common
 from dmake.common import DMakeException, SharedVolumeNotFoundException, append_command
 import dmake.kubernetes as k8s_utils
-from dmake.docker_image import DockerImageFieldSerializer
+from dmake.docker_image import DockerImageFieldSerializer, DockerBake, ExternalDockerImage
+from dmake.docker_push import DockerPush
+from dmake.docker_pull import DockerPrefetch
+from dmake.data_volumes import DataVolumes
+from dmake.kubernetes_rollout import KubernetesRollouts
+from dmake.kubernetes_validation import KubernetesManifests
+import dmake.tests_cache as tests_cache
 
 ###############################################################################
 
@@ -27,7 +33,7 @@ def generate_env_file(tmp_dir, env, name):
 
 ###############################################################################
 
-def get_docker_run_gpu_cmd_prefix(need_gpu, service_type, service_name):
+def get_docker_run_gpu_cmd_prefix(need_gpu, service_type, service_name, gpu_count=1):
     prefix = ''
     if need_gpu:
         if common.no_gpu:
@@ -35,7 +41,8 @@ def get_docker_run_gpu_cmd_prefix(need_gpu, service_type, service_name):
             prefix = 'DMAKE_DOCKER_RUN_WITH_GPU=none '
             pass
         else:
-            common.need_gpu = True
+            # number of GPUs to lock for the current plan node
+            common.need_gpu = max(int(common.need_gpu), gpu_count)
             prefix = 'DMAKE_DOCKER_RUN_WITH_GPU=yes '
     return prefix
 
@@ -196,6 +203,15 @@ class VolumeMountSerializer(YAML2PipelineSerializer):
         return result
 
 
+class ResourcesSerializer(YAML2PipelineSerializer):
+    cpu    = FieldSerializer("int", default = 1, example = 8, help_text = "CPU units taken from the `PARALLEL_BUILDERS` lockable resources while the plan node runs, with parallel execution.")
+    memory = FieldSerializer("int", default = 0, example = 4, help_text = "Memory units (GB) taken from the `PARALLEL_BUILDERS_MEMORY` lockable resources while the plan node runs, with parallel execution. 0: not locked.")
+
+    def get_units(self, factor=1):
+        """Return: {lockable resources label: quantity}."""
+        return {'PARALLEL_BUILDERS': self.cpu * factor,
+                'PARALLEL_BUILDERS_MEMORY': self.memory * factor}
+
 class DockerBaseSerializer(YAML2PipelineSerializer):
     name                 = FieldSerializer("string", help_text = "Base image name. If no docker user (namespace) is indicated, the image will be kept locally, otherwise it will be pushed.")
     variant              = FieldSerializer("string", optional = True, help_text = "When multiple base_image are defined, this names the base_image variant.", example = "tf")
@@ -206,6 +222,8 @@ class DockerBaseSerializer(YAML2PipelineSerializer):
     python_requirements  = FieldSerializer("file", default = "", child_path_only = True, help_text = "Path to python requirements.txt.", example = "")
     python3_requirements = FieldSerializer("file", default = "", child_path_only = True, help_text = "Path to python requirements.txt.", example = "requirements.txt")
     copy_files           = FieldSerializer("array", child = FieldSerializer("path", child_path_only = True), default = [], help_text = "Files to copy. Will be copied before scripts are ran. Paths need to be sub-paths to the build file to preserve MD5 sum-checking (which is used to decide if we need to re-build docker base image). A file 'foo/bar' will be copied in '/base/user/foo/bar'.", example = ["some/relative/file/to/copy"])
+    layered_build        = FieldSerializer("bool", default = False, help_text = "If true, build the base image with `docker build` from generated Dockerfiles, with one cached layer per install script (in order). Each layer is tagged with a digest chained from its predecessors, so only the changed install script and the ones after it are re-executed. Layers are pushed like the base image. Requires BuildKit; the SSH agent is forwarded with `--ssh default`.")
+    resources            = ResourcesSerializer(help_text = "Resources taken by the base image build.")
 
     def __init__(self, *args, **kwargs):
         self.serializer_version = kwargs.pop('version', 2)
@@ -223,10 +241,6 @@ class DockerBaseSerializer(YAML2PipelineSerializer):
         return result
 
     def _serialize_(self, commands, path_dir):
-        # lazy import for faster cli
-        import requests.exceptions
-        import dmake.docker_registry as docker_registry
-
         # Make the temporary directory
         tmp_dir = common.make_tmp_dir('base_image_{name}'.format(name=common.sanitize_name(self.name)))
 
@@ -281,9 +295,19 @@ class DockerBaseSerializer(YAML2PipelineSerializer):
                 template_files.append("install_pip.sh")
             if self.python3_requirements:
                 template_files.append("install_pip3.sh")
+        template_files = [os.path.join(template_dir, template_file) for template_file in template_files]
+        if self.layered_build and not self.raw_root_image:
+            template_files.remove(os.path.join(template_dir, "make_base.sh"))
+            template_files += [os.path.join("docker-base-layered", "prepare_base.sh"), os.path.join("docker-base-layered", "clean_base.sh")]
 
         for template_file in template_files:
-            md5s[template_file] = common.run_shell_command('%s dmake_copy_template %s %s' % (local_env, os.path.join(template_dir, template_file), os.path.join(tmp_dir, template_file)))
+            template_name = os.path.basename(template_file)
+            md5s[template_name] = common.run_shell_command('%s dmake_copy_template %s %s' % (local_env, template_file, os.path.join(tmp_dir, template_name)))
+
+        if self.layered_build:
+            # Layered build: no monolithic `make_base.sh` run, the tag comes from the chained layers digests
+            self._serialize_layered_(commands, tmp_dir, md5s)
+            return
 
         # Compute md5 `dmake_digest`
         #  Version 2
@@ -303,6 +327,36 @@ class DockerBaseSerializer(YAML2PipelineSerializer):
                 common.run_shell_command('cp %s %s' % (common.key_file, os.path.join(tmp_dir, 'key')))
 
         # Get root_image digest
+        root_image_digest = self._get_root_image_digest()
+
+        # Generate base image tag
+        self.tag = self._get_base_image_tag(root_image_digest, dmake_digest)
+        if '/' in self.name:
+            # content-addressed tag: only pulled if not present, before building it if it does not exist in the registry
+            DockerPrefetch.register(self.get_docker_image(), mutable=False)
+        tag_v1 = self._get_base_image_tag(root_image_digest, dmake_digest_v1, version=1)
+
+        # Never push locally-built base_image from local machines
+        push_image = "0" if common.is_local else "1"
+
+        # Append Docker Base build command
+        program = 'dmake_build_base_docker'
+        args = [tmp_dir,
+                self.root_image,
+                root_image_digest,
+                self.name,
+                self.tag,
+                tag_v1,
+                dmake_digest,
+                push_image]
+        cmd = '%s %s' % (program, ' '.join(map(common.wrap_cmd, args)))
+        append_command(commands, 'sh', shell = cmd)
+
+    def _get_root_image_digest(self):
+        # lazy import for faster cli
+        import requests.exceptions
+        import dmake.docker_registry as docker_registry
+
         try:
             root_image_digest = docker_registry.get_image_digest(self.root_image)
         except requests.exceptions.ConnectionError as e:
@@ -318,29 +372,87 @@ class DockerBaseSerializer(YAML2PipelineSerializer):
                 common.logger.info('Failed to find {} locally with the following error:'.format(self.root_image))
                 raise e
 
-        # Generate base image tag
-        self.tag = self._get_base_image_tag(root_image_digest, dmake_digest)
-        tag_v1 = self._get_base_image_tag(root_image_digest, dmake_digest_v1, version=1)
+        return root_image_digest
+
+    def _serialize_layered_(self, commands, tmp_dir, md5s):
+        root_image_digest = self._get_root_image_digest()
+        layers = self._generate_layers_(md5s)
+
+        # Chain the layers digests: a layer digest depends on its Dockerfile, the files it adds, and its predecessors
+        digest = root_image_digest
+        with open(os.path.join(tmp_dir, 'layers.txt'), 'w') as f:
+            for index, (files, dockerfile) in enumerate(layers):
+                dockerfile_name = 'Dockerfile.%d' % index
+                with open(os.path.join(tmp_dir, dockerfile_name), 'w') as d:
+                    d.write(dockerfile)
+                layer_md5 = hashlib.md5(digest.encode('utf-8'))
+                layer_md5.update(dockerfile.encode('utf-8'))
+                for file in files:
+                    layer_md5.update(('%s %s\n' % (file, md5s[file])).encode('utf-8'))
+                digest = layer_md5.hexdigest()
+                f.write('%s %s\n' % (dockerfile_name, self._get_base_image_tag(root_image_digest, digest, version='layered')))
+
+        self.tag = self._get_base_image_tag(root_image_digest, digest, version='layered')
+        if '/' in self.name:
+            DockerPrefetch.register(self.get_docker_image(), mutable=False)
 
         # Never push locally-built base_image from local machines
         push_image = "0" if common.is_local else "1"
 
-        # Append Docker Base build command
-        program = 'dmake_build_base_docker'
+        # Append Docker Base layered build command
+        program = 'dmake_build_base_docker_layered'
         args = [tmp_dir,
                 self.root_image,
                 root_image_digest,
                 self.name,
-                self.tag,
-                tag_v1,
-                dmake_digest,
                 push_image]
         cmd = '%s %s' % (program, ' '.join(map(common.wrap_cmd, args)))
         append_command(commands, 'sh', shell = cmd)
 
+    def _generate_layers_(self, md5s):
+        """
+        Return the list of layers to build in order, as `(files, dockerfile)`
+        tuples: `files` are the `md5s` keys of the files added by the layer.
+        The first layer is built on the root image, each next layer on the
+        previous one, passed as the `BASE_IMAGE` build arg.
+        """
+        def layer(files, copies, run=None):
+            dockerfile = 'ARG BASE_IMAGE\nFROM ${BASE_IMAGE}\n'
+            for src, dst in copies:
+                dockerfile += 'COPY %s %s\n' % (src, dst)
+            if run is not None:
+                dockerfile += 'RUN --mount=type=ssh %s\n' % (run)
+            return (files, dockerfile)
+
+        def user_copy(file):
+            return (os.path.join('user', file), os.path.join('/base/user', file))
+
+        layers = []
+        if not self.raw_root_image:
+            files = ['prepare_base.sh', 'config.logrotate', 'load_credentials.sh']
+            layers.append(layer(files, [(file, '/base/%s' % file) for file in files], 'bash /base/prepare_base.sh'))
+        if len(self.copy_files) > 0:
+            layers.append(layer(self.copy_files, [user_copy(file) for file in self.copy_files]))
+        for file in self.install_scripts:
+            layers.append(layer([file], [user_copy(file)], 'cd /base/user && ./%s' % file))
+        if not self.raw_root_image:
+            for install_pip, pip, requirements in [('install_pip.sh', 'pip', self.python_requirements),
+                                                   ('install_pip3.sh', 'pip3', self.python3_requirements)]:
+                if requirements:
+                    layers.append(layer([install_pip, requirements],
+                                        [(install_pip, '/base/%s' % install_pip), user_copy(requirements)],
+                                        'cd /base/user && bash ../%s && %s install --process-dependency-links -r %s' % (install_pip, pip, requirements)))
+            layers.append(layer(['clean_base.sh'], [('clean_base.sh', '/base/clean_base.sh')], 'bash /base/clean_base.sh'))
+        if len(layers) == 0:
+            # raw root image without anything to install: still produce an image
+            layers.append(layer([], []))
+        files, dockerfile = layers[-1]
+        layers[-1] = (files, dockerfile + 'CMD ["/bin/bash"]\n')
+        return layers
+
     @staticmethod
     def _get_base_image_tag(root_image_digest, dmake_digest, version=2):
-        dmake_digest_name = 'd2' if version == 2 else 'dd'
+        dmake_digest_name = {2: 'd2', 1: 'dd', 'layered': 'dl'}[version]
         tag = 'base-rid-%s-%s-%s' % (root_image_digest.replace(':', '-'), dmake_digest_name, dmake_digest)
         assert len(tag) <= 128, "docker tag limit"
         return tag
@@ -405,6 +517,7 @@ class DockerSerializer(YAML2PipelineSerializer):
     def get_docker_base_image(self, variant=None):
         base_image = self.get_base_image(variant=variant)
         if base_image is None:
+            DockerPrefetch.register(self.root_image)
             return self.root_image
         else:
             return base_image.get_docker_image()
@@ -425,16 +538,21 @@ class DockerLinkSerializer(YAML2PipelineSerializer):
     link_name        = FieldSerializer("string", example = "mongo", help_text = "Link name.")
     volumes          = FieldSerializer("array", child = FieldSerializer([SharedVolumeMountSerializer(), VolumeMountSerializer()]), default = [], example = ["datasets:/datasets", "/mnt:/mnt"], help_text = "Either shared volumes to mount. Or: for the 'shell' command only. The list of volumes to mount on the link. It must be in the form ./host/path:/absolute/container/path. Host path is relative to the dmake file.")
     need_gpu         = FieldSerializer("bool", default = False, help_text = "Whether the docker link needs to be run on a GPU node.")
+    gpu_count        = FieldSerializer("int", default = 1, help_text = "With `need_gpu`, the number of GPUs locked for the docker link on Jenkins.")
     # TODO: This field is badly named. Link are used by the run command also, nothing to do with testing or not. It should rather be: 'docker_options'
     testing_options  = FieldSerializer("string", default = "", example = "-v /mnt:/data", help_text = "Additional Docker options when testing on Jenkins.")
     probe_ports      = FieldSerializer(["string", "array"], default = "auto", child = "string", help_text = "Either 'none', 'auto' or a list of ports in the form 1234/tcp or 1234/udp")
     env              = FieldSerializer("dict", child = "string", default = {}, example = {'REDIS_URL': '${REDIS_URL}'}, help_text = "Additional environment variables defined when running this image.")
     env_exports      = FieldSerializer("dict", child = "string", default = {}, help_text = "A set of environment variables that will be exported in services that use this link when testing.")
+    pool_reset_command = FieldSerializer("array", child = "string", default = [], example = ['redis-cli', 'flushall'], help_text = "With the local link pool (DMAKE_LINK_POOL=1), the command run in a warm link container before reusing it. The container is dropped if it fails.")
+    resources        = ResourcesSerializer(help_text = "Resources taken while starting the docker link.")
 
     def _validate_(self, file, needed_migrations, data, field_name=''):
         result = super(DockerLinkSerializer, self)._validate_(file, needed_migrations=needed_migrations, data=data, field_name=field_name)
         if not allowed_link_name_pattern.match(self.link_name):
             raise ValidationError("Invalid link name '%s': only '[a-z0-9-]{1,63}' is allowed. " % (self.link_name))
+        if self.gpu_count < 1:
+            raise ValidationError("Invalid `gpu_count` %d for docker link '%s': it must be at least 1." % (self.gpu_count, self.link_name))
         LinkNames.check_duplicate_link_name('docker_link', self, file)
         return result
 
@@ -487,8 +605,6 @@ class DockerLinkSerializer(YAML2PipelineSerializer):
                 if proto not in ['udp', 'tcp']:
                     good = False
                     break
-                if proto == 'udp':
-                    raise DMakeException("TODO: udp support in dmake_wait_for_it")
                 try:
                     if int(port) < 0:
                         good = False
@@ -505,7 +621,17 @@ class DockerLinkSerializer(YAML2PipelineSerializer):
         raise DMakeException("Badly formatted probe ports.")
 
     def get_docker_run_gpu_cmd_prefix(self):
-        return get_docker_run_gpu_cmd_prefix(self.need_gpu, 'docker link', self.link_name)
+        return get_docker_run_gpu_cmd_prefix(self.need_gpu, 'docker link', self.link_name, self.gpu_count)
+
+    def get_link_pool_cmd_prefix(self, image_name, env, options):
+        if not common.link_pool:
+            return ''
+        # containers are interchangeable iff started the same way
+        key = hashlib.sha256(json.dumps([image_name, env, options], sort_keys=True).encode('utf-8')).hexdigest()[:32]
+        prefix = 'DMAKE_LINK_POOL_KEY=%s ' % key
+        if self.pool_reset_command:
+            prefix += 'DMAKE_LINK_POOL_RESET=%s ' % common.wrap_cmd_simple_quotes(json.dumps(self.pool_reset_command))
+        return prefix
 
 class AWSBeanStalkDeploySerializer(YAML2PipelineSerializer):
     name_prefix  = FieldSerializer("string", default = "${DMAKE_DEPLOY_PREFIX}", help_text = "The prefix to add to the 'deploy_name'. Can be useful as application name have to be unique across all users of Elastic BeanStalk.")
@@ -632,6 +758,8 @@ class K8SCDDeploySerializer(YAML2PipelineSerializer):
     context   = FieldSerializer("string", help_text = "kubectl context to use.")
     namespace = FieldSerializer("string", default = "default", help_text = "Kubernetes namespace to target")
     selectors = FieldSerializer("dict", default = {}, child = "string", help_text = "Selectors to restrict the deployment.")
+    parallel_updates = FieldSerializer("int", default = 10, help_text = "Number of Deployments being updated in parallel.")
+    timeout   = FieldSerializer("int", default = 1800, help_text = "Overall deadline of the Deployments updates, in seconds.")
 
     def _serialize_(self, commands, app_name, deploy_name, image_name, env):
         if not self.has_value():
@@ -639,7 +767,7 @@ class K8SCDDeploySerializer(YAML2PipelineSerializer):
 
         selectors = []
         for key, value in self.selectors.items():
-            if value.find(','):
+            if ',' in value:
                 raise DMakeException("Cannot have ',' in selector value")
             selectors.append("%s=%s" % (key, value))
         selectors = ",".join(selectors)
@@ -653,7 +781,9 @@ class K8SCDDeploySerializer(YAML2PipelineSerializer):
         k8s_utils.generate_config_map_file(env, deploy_name, configmap_env_file, labels=configmap_env_labels)
 
         program = 'dmake_deploy_k8s_cd'
-        args = [common.tmp_dir,
+        args = ['--parallel-updates', str(self.parallel_updates),
+                '--timeout', str(self.timeout),
+                common.tmp_dir,
                 common.eval_str_in_env(self.context, env),
                 common.eval_str_in_env(self.namespace, env),
                 app_name,
@@ -669,23 +799,21 @@ class KubernetesConfigMapFromFileSerializer(YAML2PipelineSerializer):
     key  = FieldSerializer("string", example="nginx.conf", help_text="File key")
     path = FieldSerializer("file",  example="deploy/nginx.conf", help_text="File path (relative to this dmake.yml file)")
 
-    def get_arg(self):
-        arg = "--from-file=%s=%s" % (self.key, self.path)
-        return arg
+    def get_from_file(self):
+        return (self.key, self.path)
 
 
 class KubernetesSecretFromFileSerializer(YAML2PipelineSerializer):
     key  = FieldSerializer("string", example="ssh-privatekey", help_text="File key")
     path = FieldSerializer("string",  example="${SECRETS}/ssh_id_rsa", help_text="Absolute file path. Supports variables substitution.")
 
-    def get_arg(self, env):
+    def get_from_file(self, env):
         path = common.eval_str_in_env(self.path, env)
 
         if not os.path.isfile(path):
             raise DMakeException("Invalid Kubernetes Secret 'from_files' absolute path: key '%s', path '%s' (expanded from '%s'): file not found" % (self.key, path, self.path))
 
-        arg = "--from-file=%s=%s" % (self.key, path)
-        return arg
+        return (self.key, path)
 
 
 class KubernetesConfigMapSerializer(YAML2PipelineSerializer):
@@ -693,9 +821,8 @@ class KubernetesConfigMapSerializer(YAML2PipelineSerializer):
     from_files = FieldSerializer("array", child=KubernetesConfigMapFromFileSerializer(), default=[], help_text="Kubernetes create values from files")
 
     def generate_manifest(self, env):
-        from_file_args = [file_source.get_arg() for file_source in self.from_files]
-        data_str = k8s_utils.generate_from_create(args=['configmap'], name=self.name, from_file_args=from_file_args)
-        return data_str
+        from_files = [file_source.get_from_file() for file_source in self.from_files]
+        return k8s_utils.generate_config_map_from_files(self.name, from_files)
 
 
 class KubernetesSecretGenericSerializer(YAML2PipelineSerializer):
@@ -707,9 +834,8 @@ class KubernetesSecretSerializer(YAML2PipelineSerializer):
     generic = FieldSerializer(KubernetesSecretGenericSerializer(), help_text="Kubernetes Generic Secret type parameters")
 
     def generate_manifest(self, env):
-        from_file_args = [file_source.get_arg(env) for file_source in self.generic.from_files]
-        data_str = k8s_utils.generate_from_create(args=['secret', 'generic'], name=self.name, from_file_args=from_file_args)
-        return data_str
+        from_files = [file_source.get_from_file(env) for file_source in self.generic.from_files]
+        return k8s_utils.generate_secret_from_files(self.name, from_files)
 
 
 class KubernetesManifestSerializer(YAML2PipelineSerializer):
@@ -766,6 +892,8 @@ class KubernetesDeploySerializer(YAML2PipelineSerializer):
             'dmake.deepomatic.com/git-repository': common.repo,
             'dmake.deepomatic.com/git-branch': common.branch,
             'dmake.deepomatic.com/git-revision': common.commit_id,
+            # replaced by the content hash once all the manifests are generated
+            k8s_utils.MANIFESTS_HASH_ANNOTATION: k8s_utils.MANIFESTS_HASH_SENTINEL,
         }
         ## injected on dmake-generated resources (configmap env, extra configmaps, extra secrets); *NOT* on user-provided resources, it could break things (labelSelectors), too risky
         extra_labels = {
@@ -824,28 +952,28 @@ class KubernetesDeploySerializer(YAML2PipelineSerializer):
             }
             template_context = manifest.get_template_variables(env)
             template_context.update(template_default_context)
-            with open(manifest.template, 'r') as f:
-                user_manifest_template = Template(f.read())
-            user_manifest_data_str = user_manifest_template.substitute(**template_context)
+            user_manifest_data_str = k8s_utils.render_manifest_template(manifest.template, template_context, dmake_generated_labels, dmake_generated_annotations)
             with open(user_manifest_path, 'w') as f:
-                k8s_utils.dump_all_str_and_add_metadata(user_manifest_data_str, dmake_generated_labels, dmake_generated_annotations, f)
-            # verify the manifest file
-            program = 'kubectl'
-            args = ['--context=%s' % context, 'apply', '--dry-run=true', '--validate=true', '--filename=%s' % user_manifest_path]
-            cmd = '%s %s' % (program, ' '.join(map(common.wrap_cmd, args)))
-            try:
-                common.run_shell_command(cmd, raise_on_return_code=True)
-            except common.ShellError as e:
-                raise DMakeException("%s: Invalid Kubernetes manifest file %s (rendered template: %s): %s" % (deploy_name, manifest.template, user_manifest_path, e))
+                f.write(user_manifest_data_str)
+            # verify the manifest file: offline, with all the manifests of the plan
+            KubernetesManifests.register(deploy_name, manifest.template, user_manifest_path, context)
+
+        # stamp the content hash: unchanged resources are not applied again
+        manifests_hash = k8s_utils.stamp_manifests_hash([os.path.join(tmp_dir, filename.split(':')[-1]) for filename in manifest_files])
 
         # generate call to kubernetes
         program = 'dmake_deploy_kubernetes'
         args = [tmp_dir,
                 context,
                 namespace,
-                deploy_name]
+                deploy_name,
+                manifests_hash]
         args += manifest_files
         cmd = '%s %s' % (program, ' '.join(map(common.wrap_cmd, args)))
+        if common.kubernetes_rollout_monitor:
+            # the rollout is waited for by the monitor, with all the other deployments
+            KubernetesRollouts.register(context, namespace, deploy_name)
+            cmd = 'DMAKE_K8S_ROLLOUT_STATUS=0 %s' % (cmd)
         append_command(commands, 'sh', shell = cmd)
 
 
@@ -861,27 +989,39 @@ class DeployStageSerializer(YAML2PipelineSerializer):
     ssh           = SSHDeploySerializer(optional = True, help_text = "Deploy via SSH")
     k8s_continuous_deployment = K8SCDDeploySerializer(optional = True, help_text = "Continuous deployment via Kubernetes. Look for all the deployments running this service.")
     kubernetes    = KubernetesDeploySerializer(optional = True, help_text = "Deploy to Kubernetes cluster.")
+    canary        = FieldSerializer("bool", default = False, help_text = "Deploy this stage first: the canary stages are deployed one after another, in order, then the other stages are deployed in parallel if they all succeeded.")
 
 class ReadinessProbeSerializer(YAML2PipelineSerializer):
     command               = FieldSerializer("array", child = "string", default = [], example = ['cat', '/tmp/worker_ready'], help_text = "The command to run to check if the container is ready. The command should fail with a non-zero code if not ready.")
     initial_delay_seconds = FieldSerializer("int", default = 0, example = 1, help_text = "The delay before the first probe is launched")
     period_seconds        = FieldSerializer("int", default = 5, example = 5, help_text = "The delay between two first probes")
     max_seconds           = FieldSerializer("int", default = 0, example = 40, help_text = "The maximum delay after failure")
+    adaptive_period       = FieldSerializer("bool", default = False, help_text = "Start probing every 0.25 second, doubling the delay between two probes up to 'period_seconds'.")
+
+    # first period of adaptive probes, in milliseconds
+    ADAPTIVE_FIRST_PERIOD_MS = 250
 
     def get_cmd(self):
         if not self.has_value() or len(self.command) == 0:
             return ""
 
+        # T and periods are in milliseconds
         if self.max_seconds > 0:
-            condition = "$T -le %d" % self.max_seconds
+            condition = "$T -le %d" % (self.max_seconds * 1000)
         else:
             condition = "1"
 
-        period = max(self.period_seconds, 1)
+        period = max(self.period_seconds, 1) * 1000
+        first_period = min(self.ADAPTIVE_FIRST_PERIOD_MS, period) if self.adaptive_period else period
+
+        # whole seconds are slept as integers: some `sleep` implementations (e.g. minimal busybox) reject fractions
+        sleep = "sleep $((P/1000))"
+        if self.adaptive_period:
+            sleep = "if [ $((P%%1000)) = 0 ]; then %s; else sleep $((P/1000)).$(printf %%03d $((P%%1000))); fi" % (sleep)
 
         # Make the command with "" around parameters
         cmd = self.command[0] + ' ' + (' '.join([common.wrap_cmd(c) for c in self.command[1:]]))
-        cmd = """T=0; sleep {initial_delay:d}; while [ {condition} ]; do echo "Running readiness probe"; {cmd}; if [ "$?" = "0" ]; then echo "... ready"; exit 0; fi; T=$((T+{period:d})); sleep {period:d}; done; exit 1;""".format(initial_delay=self.initial_delay_seconds, condition=condition, cmd=cmd, period=period)
+        cmd = """T=0; P={first_period:d}; sleep {initial_delay:d}; while [ {condition} ]; do echo "Running readiness probe"; {cmd}; if [ "$?" = "0" ]; then echo "... ready"; exit 0; fi; T=$((T+P)); {sleep}; P=$((P*2)); if [ $P -gt {period:d} ]; then P={period:d}; fi; done; exit 1;""".format(initial_delay=self.initial_delay_seconds, condition=condition, cmd=cmd, first_period=first_period, period=period, sleep=sleep)
         cmd = common.escape_cmd(cmd)
         return 'bash -c "%s"' % cmd
 
@@ -890,6 +1030,7 @@ class DeployConfigSerializer(YAML2PipelineSerializer):
     docker_opts        = FieldSerializer("string", default = "", example = "--privileged", help_text = "Docker options to add.")
     env_override       = FieldSerializer("dict", child = "string", optional = True, default = {}, help_text = "Extra environment variables for this service. Overrides dmake.yml root `env`, with variable substitution evaluated from it.", example = {'INFO': '${BRANCH}-${BUILD}'})
     need_gpu           = FieldSerializer("bool", default = False, help_text = "Whether the service needs to be run on a GPU node.")
+    gpu_count          = FieldSerializer("int", default = 1, help_text = "With `need_gpu`, the number of GPUs locked for the service on Jenkins.")
     ports              = FieldSerializer("array", child = DeployConfigPortsSerializer(), default = [], help_text = "Ports to open.")
     volumes            = FieldSerializer("array", child = FieldSerializer([SharedVolumeMountSerializer(), VolumeMountSerializer()]), default = [], example = ["datasets:/datasets"], help_text = "Volumes to mount.")
     readiness_probe    = ReadinessProbeSerializer(optional = True, help_text = "A probe that waits until the container is ready.")
@@ -897,6 +1038,12 @@ class DeployConfigSerializer(YAML2PipelineSerializer):
                                          example = ["/dev/bus/usb/001/002:/dev/bus/usb/001/002"],
                                          help_text = "Device to expose from the host to the container. Support variable substitution in host part, to have a generic dmake.yml with host-specific values configured externally, per machine.")
 
+    def _validate_(self, file, needed_migrations, data, field_name=''):
+        result = super(DeployConfigSerializer, self)._validate_(file, needed_migrations=needed_migrations, data=data, field_name=field_name)
+        if self.has_value() and self.gpu_count < 1:
+            raise ValidationError("Invalid `gpu_count` %d: it must be at least 1." % (self.gpu_count))
+        return result
+
     def full_docker_opts(self, env, mount_host_volumes, use_host_ports=None):
         if not self.has_value():
             return ""
@@ -947,6 +1094,7 @@ class DeployConfigSerializer(YAML2PipelineSerializer):
 class DeploySerializer(YAML2PipelineSerializer):
     deploy_name = FieldSerializer("string", optional = True, example = "", help_text = "The name used for deployment. Will default to '{:app_name}-{:service_name}' if not specified")
     stages      = FieldSerializer("array", child = DeployStageSerializer(), help_text = "Deployment possibilities")
+    max_parallel_targets = FieldSerializer("int", default = 0, help_text = "Maximum number of deploy targets (the deployment methods of the active stages) deployed in parallel. 0: no limit.")
 
     def set_service(self, service):
         self.service = service
@@ -965,16 +1113,55 @@ class DeploySerializer(YAML2PipelineSerializer):
 
         image_name = config.docker_image.get_image_name(env=deploy_env)
         kubernetes_stages_deployments = set()
+        # independent deploy targets: (name, canary, commands)
+        targets = []
         for stage in self.stages:
             branches = stage.branches
             if common.branch not in branches and '*' not in branches:
                 continue
 
             branch_env = env.get_replaced_variables(additional_variables_layers=[self.service.config.env_override, stage.env])
-            stage.aws_beanstalk._serialize_(commands, app_name, deploy_name, config, image_name, branch_env)
-            stage.ssh._serialize_(commands, app_name, deploy_name, config, image_name, branch_env)
-            stage.k8s_continuous_deployment._serialize_(commands, app_name, deploy_name, image_name, branch_env)
-            stage.kubernetes._serialize_(commands, app_name, deploy_name, image_name, branch_env, kubernetes_stages_deployments)
+            for method, serialize in [
+                    ('aws_beanstalk', lambda target_commands: stage.aws_beanstalk._serialize_(target_commands, app_name, deploy_name, config, image_name, branch_env)),
+                    ('ssh', lambda target_commands: stage.ssh._serialize_(target_commands, app_name, deploy_name, config, image_name, branch_env)),
+                    ('k8s_continuous_deployment', lambda target_commands: stage.k8s_continuous_deployment._serialize_(target_commands, app_name, deploy_name, image_name, branch_env)),
+                    ('kubernetes', lambda target_commands: stage.kubernetes._serialize_(target_commands, app_name, deploy_name, image_name, branch_env, kubernetes_stages_deployments))]:
+                target_commands = []
+                serialize(target_commands)
+                if len(target_commands) > 0:
+                    targets.append(('%s (%s)' % (stage.description, method), stage.canary, target_commands))
+        generate_deploy_targets(commands, deploy_name, targets, self.max_parallel_targets)
+
+
+def generate_deploy_targets(commands, deploy_name, targets, max_parallel_targets):
+    """
+    Deploy the canary `targets` [(name, canary, commands)] one after another, then
+    the other ones in parallel, at most `max_parallel_targets` at once (0: no limit).
+    All the parallel targets are deployed even if some fail: the failures are reported together.
+    """
+    canary_targets = [target for target in targets if target[1]]
+    other_targets = [target for target in targets if not target[1]]
+    for name, _, target_commands in canary_targets:
+        append_command(commands, 'echo', message = '- Deploying canary {}: {}'.format(deploy_name, name))
+        commands += target_commands
+    if max_parallel_targets <= 0:
+        max_parallel_targets = max(len(other_targets), 1)
+    for start in range(0, len(other_targets), max_parallel_targets):
+        wave = other_targets[start:start + max_parallel_targets]
+        if len(wave) == 1:
+            commands += wave[0][2]
+            continue
+        append_command(commands, 'parallel', background = True)
+        names = set()
+        for n, (name, _, target_commands) in enumerate(wave):
+            # parallel branch names must be unique
+            if name in names:
+                name = '%s #%d' % (name, start + n + 1)
+            names.add(name)
+            append_command(commands, 'parallel_branch', name = '{}: {}'.format(deploy_name, name))
+            commands += target_commands
+            append_command(commands, 'parallel_branch_end')
+        append_command(commands, 'parallel_end')
 
 class DataVolumeSerializer(YAML2PipelineSerializer):
     container_volume  = FieldSerializer("string", example = "/mnt", help_text = "Path of the volume mounted in the container")
@@ -985,11 +1172,19 @@ class DataVolumeSerializer(YAML2PipelineSerializer):
         if env is None:
             env = {}
 
+        path = self.get_host_path(dmake_file_path, env)
+        container_volume = common.eval_str_in_env(self.container_volume, env)
+
+        options = '-v %s:%s' % (path, container_volume)
+        if self.read_only:
+            options += ':ro'
+        return options
+
+    def get_host_path(self, dmake_file_path, env):
         scheme = None
         path = ""
 
         source = common.eval_str_in_env(self.source, env)
-        container_volume = common.eval_str_in_env(self.container_volume, env)
 
         if source[0:1] in ['/', '.']:
             scheme = 'file'
@@ -1005,15 +1200,11 @@ class DataVolumeSerializer(YAML2PipelineSerializer):
             if path[0:1] == '.':
                 path = os.path.normpath(os.path.join(common.root_dir, dmake_file_path, path))
         elif scheme == "s3":
-            path = os.path.join(common.config_dir, 'data_volumes', 's3', service_name.replace(':', '-'), path)
-            common.run_shell_command('aws s3 sync %s %s' % (source, path))
+            # synced once for all services in the plan prefetch step
+            path = DataVolumes.register(source, common.config_dir)
         else:
             raise DMakeException("Invalid data volume mount: Field `source` '%s' (expanded from '%s') must be a host path or start with 's3://'" % (source, self.source))
-
-        options = '-v %s:%s' % (path, container_volume)
-        if self.read_only:
-            options += ':ro'
-        return options
+        return path
 
 
 class TestSerializer(YAML2PipelineSerializer):
@@ -1024,6 +1215,14 @@ class TestSerializer(YAML2PipelineSerializer):
     junit_report       = FieldSerializer(["string", "array"], child = "string", default = [], post_validation = lambda x: [x] if isinstance(x, str) else x, example = "test-reports/nosetests.xml", help_text = "Filepath or array of file paths of xml xunit test reports. Publish a XUnit test report.")
     cobertura_report   = FieldSerializer(["string", "array"], child = "string", default = [], post_validation = lambda x: [x] if isinstance(x, str) else x, example = "test-reports/coverage.xml", help_text = "Filepath or array of file paths of xml xunit test reports. Publish a Cobertura report.")
     html_report        = HTMLReportSerializer(optional = True, help_text = "Publish an HTML report.")
+    shards             = FieldSerializer("int", default = 1, example = 4, help_text = "Split the tests execution into this number of parallel containers. Each one gets DMAKE_TEST_SHARD_INDEX (from 0) and DMAKE_TEST_SHARD_COUNT: the test commands are responsible for running their own part of the tests. The junit reports of the shards are merged.")
+    shard_links        = FieldSerializer("array", child = "string", default = [], example = ['postgres'], help_text = "With `shards`, the needed links of which each shard gets its own instance (e.g. a database the tests write to).")
+
+    def _validate_(self, file, needed_migrations, data, field_name=''):
+        result = super(TestSerializer, self)._validate_(file, needed_migrations=needed_migrations, data=data, field_name=field_name)
+        if self.has_value() and self.shards < 1:
+            raise ValidationError("Invalid tests `shards` %d: it must be at least 1." % (self.shards))
+        return result
 
     def get_mounts_opt(self, service_name, path, env):
         if not self.has_value():
@@ -1033,26 +1232,60 @@ class TestSerializer(YAML2PipelineSerializer):
             opts.append(data_volume.get_mount_opt(service_name, path, env))
         return ' ' + ' '.join(opts)
 
-    def generate_test(self, commands, path, service_name, docker_cmd, docker_links, mount_point):
+    def get_test_cache_cmd_prefix(self, service_name, path, image_name, env, mount_point, shard=None):
+        """The results of a passing run are cached, and replayed by later runs with the same inputs: see `dmake_test_cache`."""
+        if not common.test_cache or not self.has_value():
+            return ''
+        reports = self.junit_report + self.cobertura_report
+        html = self.html_report._value_()
+        if html is not None:
+            reports.append(html['directory'])
+        inputs = {
+            'service_name': service_name,
+            'image_name': image_name,
+            'commands': self.commands,
+            'env': env,
+            'data_volumes': [[common.eval_str_in_env(data_volume.source, env), data_volume.get_host_path(path, env)] for data_volume in self.data_volumes],
+            'reports': [os.path.join(mount_point, path, report) for report in reports]
+        }
+        if shard is not None:
+            inputs['shard'] = [shard, self.shards]
+        return 'DMAKE_TEST_CACHE_INPUTS=%s ' % tests_cache.write_inputs(common.tmp_dir, inputs)
+
+    def get_shards(self):
+        """Return: the shard indexes, [None] if the tests are not sharded."""
+        if self.shards <= 1:
+            return [None]
+        return list(range(self.shards))
+
+    def generate_test(self, commands, path, service_name, shards_commands, mount_point):
+        """`shards_commands`: {shard: commands running the tests of the shard}, see `get_shards()`."""
         if not self.has_value() or len(self.commands) == 0:
             return
 
-        # we want to collect tests results even when tests fail; and support partially executed tests, so partially existing files to collect, but still get test results collection error when the tests succeeded: need to duplicate the collection, and wrap them in try/except to ignore collection error when needed
+        # we want to collect tests results even when tests fail; and support partially executed tests, so partially existing files to collect, but still get test results collection error when the tests succeeded: the collection is duplicated, tolerating missing results after a failure.
+        # all the results are collected at once, see `dmake_collect_tests_results`
 
         tests_results_collection_commands = []
+        shards = self.get_shards()
 
         for junit_report in self.junit_report:
-            append_command(tests_results_collection_commands, 'junit', report = os.path.join(path, junit_report), service_name = service_name, mount_point = mount_point)
+            # a single report, merged from the shards ones
+            append_command(tests_results_collection_commands, 'junit', report = os.path.join(path, junit_report), service_name = service_name, mount_point = mount_point, shards = shards)
 
-        for cobertura_report in self.cobertura_report:
-            append_command(tests_results_collection_commands, 'cobertura', report = os.path.join(path, cobertura_report), service_name = service_name, mount_point = mount_point)
+        for shard in shards:
+            for cobertura_report in self.cobertura_report:
+                append_command(tests_results_collection_commands, 'cobertura', report = os.path.join(path, cobertura_report), service_name = service_name, mount_point = mount_point, shard = shard)
 
-        html = self.html_report._value_()
-        if html is not None:
-            append_command(tests_results_collection_commands, 'publishHTML', service_name = service_name, mount_point = mount_point,
-                           directory = os.path.join(path, html['directory']),
-                           index     = html['index'],
-                           title     = html['title'],)
+            html = self.html_report._value_()
+            if html is not None:
+                title = html['title']
+                if shard is not None:
+                    title += ' (shard %d/%d)' % (shard + 1, len(shards))
+                append_command(tests_results_collection_commands, 'publishHTML', service_name = service_name, mount_point = mount_point, shard = shard,
+                               directory = os.path.join(path, html['directory']),
+                               index     = html['index'],
+                               title     = title,)
 
 
         if tests_results_collection_commands:
@@ -1062,8 +1295,16 @@ class TestSerializer(YAML2PipelineSerializer):
         if has_timeout:
             append_command(commands, 'timeout', time = self.timeout)
 
-        tests_cmd = '/bin/bash -x -c %s' % common.wrap_cmd_simple_quotes(' && '.join(self.commands))
-        append_command(commands, 'sh', shell = docker_cmd + tests_cmd)
+        if shards == [None]:
+            commands += shards_commands[None]
+        else:
+            # run in parallel by both the Jenkins and the local runtimes
+            append_command(commands, 'parallel', background = True)
+            for shard in shards:
+                append_command(commands, 'parallel_branch', name = 'shard %d/%d' % (shard + 1, len(shards)))
+                commands += shards_commands[shard]
+                append_command(commands, 'parallel_branch_end')
+            append_command(commands, 'parallel_end')
 
         if has_timeout:
             append_command(commands, 'timeout_end')
@@ -1072,19 +1313,18 @@ class TestSerializer(YAML2PipelineSerializer):
             append_command(commands, 'catch', what='error_tests')
             # if anything bad happened, try to collect what's there; ignore any error (file not found) and try to collect as much as possible
             append_command(commands, 'echo', message = 'Some tests for this service failed: trying now to collect existing test results.')
-            for command in tests_results_collection_commands:
-                append_command(commands, 'try')
-                commands.append(command)
-                append_command(commands, 'catch', what='errors_tests_results_collection_to_ignore')
-                append_command(commands, 'echo', message = 'Ignoring test result collection error after tests execution failure: some tests may have been skipped because of a previous test failed, not generating the expected tests results, all is fine.')
-                append_command(commands, 'catch_end')
+            append_command(commands, 'try')
+            append_command(commands, 'tests_results', reports = tests_results_collection_commands, allow_missing = True)
+            append_command(commands, 'catch', what='errors_tests_results_collection_to_ignore')
+            append_command(commands, 'echo', message = 'Ignoring test result collection error after tests execution failure: some tests may have been skipped because of a previous test failed, not generating the expected tests results, all is fine.')
+            append_command(commands, 'catch_end')
 
             append_command(commands, 'echo', message = 'Some tests for this service failed: finished trying to collect existing test results, re-throwing the error now.')
             append_command(commands, 'throw', what='error_tests')
             append_command(commands, 'catch_end')
 
             # emit normal tests results collection commands after the tests: if they fail they should raise an error
-            commands.extend(tests_results_collection_commands)
+            append_command(commands, 'tests_results', reports = tests_results_collection_commands)
 
 
 allowed_link_name_pattern = re.compile("^[a-z0-9-]{1,63}$")  # too laxist, but easy to read
@@ -1129,6 +1369,30 @@ class LinkNames(object):
                 raise ValidationError("Duplicate link name '{link_name}' with different definitions: '{kind}' in '{file}', was previously defined as '{other_kind}' in '{other_file}'".format(link_name=link_name, kind=kind, file=file, other_kind=other_kind, other_file=other_file))
         LinkNames.link_names[link_name] = (kind, link, file)
 
+class ContainerNames(object):
+    """
+    Allocate the docker container names at plan time, without runtime lookup
+    of free names: unique in the plan, and across plans thanks to the plan
+    unique temporary directory.
+    """
+    names = set()
+
+    @staticmethod
+    def reset():
+        ContainerNames.names = set()
+
+    @staticmethod
+    def allocate(name):
+        plan_id = hashlib.sha256(common.tmp_dir.encode('utf-8')).hexdigest()[:6]
+        base_name = '%s.%s.%s' % (common.name_prefix, re.sub('[^a-zA-Z0-9_.-]', '_', name), plan_id)
+        unique_name = base_name
+        count = 1
+        while unique_name in ContainerNames.names:
+            unique_name = '%s.%d' % (base_name, count)
+            count += 1
+        ContainerNames.names.add(unique_name)
+        return unique_name
+
 @functools.total_ordering
 class NeededServiceSerializer(YAML2PipelineSerializer):
     service_name    = FieldSerializer("string", help_text = "The name of the needed application part.", example = "worker-nn", no_slash_no_space = True)
@@ -1207,6 +1471,7 @@ class ServicesSerializer(YAML2PipelineSerializer):
     needed_services = FieldSerializer("array", child = FieldSerializer(NeededServiceSerializer()), default = [], help_text = "List here the sub apps (as defined by service_name) of our application that are needed for this sub app to run.")
     needed_links    = FieldSerializer("array", child = "string", default = [], example = ['mongo'], help_text = "The docker links names to bind to for this test. Must be declared at the root level of some dmake file of the app.")
     sources         = FieldSerializer("array", child = FieldSerializer(["file", "dir"]), optional = True, help_text = "If specified, this service will be considered as updated only when the content of those directories or files have changed.", example = 'path/to/app')
+    resources       = ResourcesSerializer(help_text = "Resources taken by the docker image build, the tests (per shard), the shell and the start of the service.")
     dev             = DevConfigSerializer(help_text = "Development runtime configuration.")
     config          = DeployConfigSerializer(help_text = "Deployment configuration.")
     tests           = TestSerializer(optional = True, help_text = "Unit tests list.")
@@ -1248,14 +1513,14 @@ class ServicesSerializer(YAML2PipelineSerializer):
                 if needed_service.needed_for.kind(kind)]
 
     def get_docker_run_gpu_cmd_prefix(self):
-        return get_docker_run_gpu_cmd_prefix(self.config.need_gpu, 'service', self.service_name)
+        return get_docker_run_gpu_cmd_prefix(self.config.need_gpu, 'service', self.service_name, self.config.gpu_count)
 
     def get_shared_volumes(self):
         return [volume.get_shared_volume() for volume in self.config.volumes if isinstance(volume, SharedVolumeMountSerializer)]
 
 class BuildSerializer(YAML2PipelineSerializer):
     env      = FieldSerializer("dict", child = "string", default = {}, help_text = "List of environment variables used when building applications (excluding base_image).", example = {'BUILD': '${BUILD}'})
-    commands = FieldSerializer("array", default = [], child = FieldSerializer(["string", "array"], child = "string", post_validation = lambda x: [x] if isinstance(x, str) else x), help_text ="Command list (or list of lists, in which case each list of commands will be executed in paralell) to build.", example = ["cmake .", "make"])
+    commands = FieldSerializer("array", default = [], child = FieldSerializer(["string", "array"], child = "string"), help_text ="Command list to build, run sequentially. An item can also be a list of commands: consecutive lists are run in parallel (the commands of each list are run sequentially), with their output prefixed by their group name; the first failing list stops the build. Running the lists in parallel requires bash >= 4.3 in the base image: they are run sequentially otherwise.", example = ["cmake .", "make"])
 
     def _validate_(self, file, needed_migrations, data, field_name=''):
         super(BuildSerializer, self)._validate_(file, needed_migrations=needed_migrations, data=data, field_name=field_name)
@@ -1418,11 +1683,16 @@ class DMakeFile(DMakeFileSerializer):
                 return t
         raise DMakeException("Could not find service '%s'" % service)
 
-    def _get_link_opts_(self, needed_links, needed_services):
+    def _get_link_opts_(self, commands, needed_links, needed_services, exclude_links=None, links_app_name=None):
         if common.options.with_dependencies:
             full_needed_links = needed_links + [ns.link_name for ns in needed_services if ns.link_name]
+            if exclude_links:
+                full_needed_links = [link_name for link_name in full_needed_links if link_name not in exclude_links]
             if len(full_needed_links) > 0:
-                return 'dmake_return_docker_links %s %s' % (self.app_name, ' '.join(full_needed_links))
+                # wait in its own command: a failure in the command substitution of the docker options would be ignored
+                links_args = '%s %s' % (links_app_name or self.app_name, ' '.join(full_needed_links))
+                append_command(commands, 'sh', shell='dmake_wait_docker_links %s' % (links_args))
+                return 'dmake_return_docker_links %s' % (links_args)
         return None
 
     def _get_check_needed_services_(self, commands, needed_services):
@@ -1446,13 +1716,15 @@ class DMakeFile(DMakeFileSerializer):
         base_image = self.docker.get_base_image_from_service_name(base_image_service_name)
         base_image._serialize_(commands, self.__path__)
 
-    def _generate_run_docker_opts_(self, commands, service, docker_links, dependencies_needed_for, additional_env_variables=None, use_host_ports=None):
-        docker_opts, env = self._launch_options_(commands, service, docker_links, dependencies_needed_for=dependencies_needed_for, additional_env_variables=additional_env_variables, run_base_image=False, mount_root_dir=False, force_workdir=False, use_host_ports=use_host_ports)
+    def _generate_run_docker_opts_(self, commands, service, docker_links, dependencies_needed_for, additional_env_variables=None, use_host_ports=None, exclude_links=None):
+        docker_opts, env = self._launch_options_(commands, service, docker_links, dependencies_needed_for=dependencies_needed_for, additional_env_variables=additional_env_variables, run_base_image=False, mount_root_dir=False, force_workdir=False, use_host_ports=use_host_ports, exclude_links=exclude_links)
         image_name = service.config.docker_image.get_image_name(env=env)
+        if isinstance(service.config.docker_image, ExternalDockerImage):
+            DockerPrefetch.register(image_name)
 
         return docker_opts, image_name, env
 
-    def generate_run(self, commands, service_name, docker_links, service_customization):
+    def generate_run(self, commands, service_name, docker_links, service_customization, readiness_probes=None):
         service = self._get_service_(service_name)
         if not service.config.docker_image.is_runnable():
             raise DMakeException("You need to specify a 'config.docker_image.start_script' when running service '%s'." % service_name)
@@ -1473,7 +1745,8 @@ class DMakeFile(DMakeFileSerializer):
 
         docker_opts, image_name, env = self._generate_run_docker_opts_(commands, service, docker_links, dependencies_needed_for='run', additional_env_variables=additional_customization_env_variables, use_host_ports=use_host_ports)
         docker_opts += service.tests.get_mounts_opt(service_name, self.__path__, env)
-        docker_cmd = 'dmake_run_docker_daemon "%s" "%s" "%s" "" %s -i %s' % (self.app_name, unique_service_name, link_name or "", docker_opts, image_name)
+        container_name = ContainerNames.allocate(unique_service_name)
+        docker_cmd = 'dmake_run_docker_daemon "%s" "%s" "%s" "%s" %s -i %s' % (self.app_name, unique_service_name, link_name or "", container_name, docker_opts, image_name)
         docker_cmd = service.get_docker_run_gpu_cmd_prefix() + docker_cmd
 
         # Run daemon
@@ -1482,13 +1755,17 @@ class DMakeFile(DMakeFileSerializer):
         # Wait for daemon to be ready
         cmd = service.config.readiness_probe.get_cmd()
         if cmd:
-            append_command(commands, 'sh', shell = 'dmake_exec_docker ${DAEMON_ID} %s' % cmd)
+            if readiness_probes is None:
+                append_command(commands, 'sh', shell = 'dmake_exec_docker ${DAEMON_ID} %s' % cmd)
+            else:
+                # probed later, together with the other daemons of the same dependency level: see core.generate_readiness_probes()
+                readiness_probes.append((unique_service_name, container_name, cmd))
 
     def generate_build_docker(self, commands, service_name):
         service = self._get_service_(service_name)
         service.config.docker_image.generate_build_docker(commands, self.__path__, self.docker, self.build)
 
-    def _launch_options_(self, commands, service, docker_links, dependencies_needed_for, run_base_image, mount_root_dir, force_workdir, additional_env = None, additional_env_variables = None, use_host_ports = None):
+    def _launch_options_(self, commands, service, docker_links, dependencies_needed_for, run_base_image, mount_root_dir, force_workdir, additional_env = None, additional_env_variables = None, use_host_ports = None, exclude_links = None):
         if additional_env is None:
             additional_env = {}
 
@@ -1523,7 +1800,7 @@ class DMakeFile(DMakeFileSerializer):
 
         docker_opts += " " + service.config.full_docker_opts(env, mount_host_volumes=False, use_host_ports=use_host_ports)
 
-        link_opts_command = self._get_link_opts_(needed_links, needed_services)
+        link_opts_command = self._get_link_opts_(commands, needed_links, needed_services, exclude_links)
         if link_opts_command is not None:
             docker_opts += " $(%s)" % link_opts_command
 
@@ -1552,25 +1829,67 @@ class DMakeFile(DMakeFileSerializer):
             # no test specified, nothing to generate for tests
             return
 
-        docker_opts, image_name, env = self._generate_run_docker_opts_(commands, service, docker_links, dependencies_needed_for='test', use_host_ports=False)
+        shards = service.tests.get_shards()
+        for link_name in service.tests.shard_links:
+            if link_name not in service.needed_links:
+                raise DMakeException("Unknown shard link '%s' for service '%s': it must be one of its `needed_links`." % (link_name, service_name))
+        shard_links = service.tests.shard_links if shards != [None] and common.options.with_dependencies else []
+
+        docker_opts, image_name, env = self._generate_run_docker_opts_(commands, service, docker_links, dependencies_needed_for='test', use_host_ports=False, exclude_links=shard_links)
         docker_opts += service.tests.get_mounts_opt(service_name, self.__path__, env)
-        docker_cmd = 'dmake_run_docker_test %s "" %s -i %s ' % (service_name, docker_opts, image_name)
-        docker_cmd = service.get_docker_run_gpu_cmd_prefix() + docker_cmd
+        tests_cmd = '/bin/bash -x -c %s' % common.wrap_cmd_simple_quotes(' && '.join(service.tests.commands))
+
+        shards_commands = {}
+        for shard in shards:
+            shard_commands = []
+            shard_service_name = common.get_shard_service_name(service_name, shard)
+            shard_docker_opts = docker_opts
+            if shard is not None:
+                shard_docker_opts += ' -e DMAKE_TEST_SHARD_INDEX=%d -e DMAKE_TEST_SHARD_COUNT=%d' % (shard, len(shards))
+            if shard_links:
+                # the first shard uses the links instances of the plan, the other ones start their own
+                links_app_name = self.app_name
+                if shard > 0:
+                    links_app_name = '%s.%s' % (self.app_name, common.sanitize_name(shard_service_name))
+                    for link_name in shard_links:
+                        self.generate_run_link(shard_commands, 'links/%s/%s' % (self.app_name, link_name), docker_links, links_app_name=links_app_name)
+                shard_docker_opts += ' $(%s)' % self._get_link_opts_(shard_commands, shard_links, [], links_app_name=links_app_name)
+            container_name = ContainerNames.allocate('test.' + shard_service_name)
+            docker_cmd = 'dmake_run_docker_test %s "%s" %s -i %s ' % (shard_service_name, container_name, shard_docker_opts, image_name)
+            docker_cmd = service.tests.get_test_cache_cmd_prefix(shard_service_name, self.__path__, image_name, env, self.docker.mount_point, shard=shard) + docker_cmd
+            docker_cmd = service.get_docker_run_gpu_cmd_prefix() + docker_cmd
+            append_command(shard_commands, 'sh', shell = docker_cmd + tests_cmd)
+            shards_commands[shard] = shard_commands
 
         # Run test commands
-        service.tests.generate_test(commands, self.__path__, service_name, docker_cmd, docker_links, self.docker.mount_point)
+        service.tests.generate_test(commands, self.__path__, service_name, shards_commands, self.docker.mount_point)
 
-    def generate_run_link(self, commands, service, docker_links):
+    def generate_run_link(self, commands, service, docker_links, links_app_name=None):
         link = self.get_docker_link(service, docker_links)
         context_env = self.env.get_replaced_variables()
         image_name = common.eval_str_in_env(link.image_name, context_env)
         options = link.get_options(self.__path__, context_env)
         env = link.get_env(context_env)
         env_file = generate_env_file(common.tmp_dir, env, service)
-        docker_cmd = 'dmake_run_docker_link "%s" "%s" "%s" "%s" --env-file %s %s' % (self.app_name, image_name, link.link_name, link.probe_ports_list(), env_file, options)
+        DockerPrefetch.register(image_name)
+        container_name = ContainerNames.allocate(link.link_name)
+        docker_cmd = 'dmake_run_docker_link "%s" "%s" "%s" "%s" "%s" --env-file %s %s' % (links_app_name or self.app_name, image_name, link.link_name, container_name, link.probe_ports_list(), env_file, options)
+        docker_cmd = link.get_link_pool_cmd_prefix(image_name, env, options) + docker_cmd
         docker_cmd = link.get_docker_run_gpu_cmd_prefix() + docker_cmd
         append_command(commands, 'sh', shell=docker_cmd)
 
+    def get_node_resources(self, command, service_name, docker_links):
+        """Return: {lockable resources label: quantity} taken by the plan node `command` of `service_name`."""
+        if command == 'base':
+            return self.docker.get_base_image_from_service_name(service_name).resources.get_units()
+        if command == 'run_link':
+            return self.get_docker_link(service_name, docker_links).resources.get_units()
+        if command in ['build_docker', 'test', 'shell', 'run']:
+            service = self._get_service_(service_name)
+            factor = len(service.tests.get_shards()) if command == 'test' and service.tests.has_value() else 1
+            return service.resources.get_units(factor)
+        return {'PARALLEL_BUILDERS': 1}
+
     def generate_deploy(self, commands, service_name):
         service = self._get_service_(service_name)
         if not service.deploy.has_value():
@@ -1584,3 +1903,10 @@ class DMakeFile(DMakeFileSerializer):
 def reset():
     SharedVolumes.reset()
     LinkNames.reset()
+    ContainerNames.reset()
+    DockerBake.reset()
+    DockerPush.reset()
+    DockerPrefetch.reset()
+    DataVolumes.reset()
+    KubernetesManifests.reset()
+    KubernetesRollouts.reset()
@@ -0,0 +1,233 @@
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import quote, urlencode
+
+import dmake.common as common
+from dmake.common import DMakeException
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+###############################################################################
+
+class DockerEngineException(DMakeException):
+    def __init__(self, msg):
+        super(DockerEngineException, self).__init__(msg)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def get_socket_path():
+    docker_host = os.getenv('DOCKER_HOST', '')
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    if docker_host:
+        raise DockerEngineException("Unsupported DOCKER_HOST '%s': only unix sockets are supported" % (docker_host))
+    return DEFAULT_SOCKET
+
+
+class DockerEngine(object):
+    """
+    Minimal Docker Engine API client, over the unix socket. The API paths are
+    unversioned: the daemon serves them with its own API version, and only
+    fields common to all versions are used.
+    """
+    def __init__(self, socket_path=None, timeout=30):
+        self.socket_path = socket_path or get_socket_path()
+        self.timeout = timeout
+
+    def _open(self, method, path, query=None, timeout=None):
+        url = path
+        if query:
+            url += '?' + urlencode(query)
+        connection = UnixHTTPConnection(self.socket_path, timeout or self.timeout)
+        try:
+            connection.request(method, url)
+            return connection, connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+
+    def request(self, method, path, query=None):
+        """Return: (status, decoded JSON body or None)."""
+        connection, response = self._open(method, path, query)
+        try:
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400 and response.status != 404:
+            raise DockerEngineException("Docker Engine API error on %s %s: %d %s" % (method, path, response.status, body.decode('utf-8', 'replace').strip()))
+        return response.status, json.loads(body.decode('utf-8')) if body else None
+
+    def inspect_container(self, container):
+        """Return: the container details, None if it does not exist."""
+        status, data = self.request('GET', '/containers/%s/json' % quote(container, safe=''))
+        return None if status == 404 else data
+
+    def get_container_status(self, container):
+        """Return: the container status, None if it does not exist."""
+        data = self.inspect_container(container)
+        return None if data is None else data['State']['Status']
+
+    @contextlib.contextmanager
+    def archive(self, container, path):
+        """Yield: the tar stream of `path` in the container, None if it does not exist."""
+        connection, response = self._open('GET', '/containers/%s/archive' % quote(container, safe=''), {'path': path})
+        try:
+            if response.status == 404:
+                yield None
+            elif response.status != 200:
+                raise DockerEngineException("Docker Engine API error on GET /containers/%s/archive: %d %s" % (container, response.status, response.read().decode('utf-8', 'replace').strip()))
+            else:
+                yield response
+        finally:
+            connection.close()
+
+    def events(self, filters, since, until):
+        """Yield the events matching `filters` between `since` and `until` (unix timestamps), as they happen."""
+        query = {'since': '%.3f' % since, 'until': '%.3f' % until, 'filters': json.dumps(filters)}
+        connection, response = self._open('GET', '/events', query, timeout=max(until - time.time(), 0) + 5)
+        try:
+            if response.status != 200:
+                raise DockerEngineException("Docker Engine API error on GET /events: %d" % (response.status))
+            while True:
+                line = response.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            connection.close()
+
+
+class DockerCLI(object):
+    """
+    Fallback of DockerEngine through the docker CLI, when the Engine API socket
+    is unavailable (e.g. tcp DOCKER_HOST, docker in docker): without events
+    stream, the containers are waited for by polling their status.
+    """
+    def get_container_status(self, container):
+        process = subprocess.run(['docker', 'inspect', '--type', 'container', '-f', '{{.State.Status}}', container], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            error = process.stderr.decode('utf-8', 'replace').strip()
+            if 'no such' in error.lower():
+                return None
+            raise DockerEngineException("docker inspect %s failed: %s" % (container, error))
+        return process.stdout.decode('utf-8').strip()
+
+    @contextlib.contextmanager
+    def archive(self, container, path):
+        process = subprocess.Popen(['docker', 'cp', '%s:%s' % (container, path), '-'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            # nothing is streamed if the path does not exist
+            stream = process.stdout if process.stdout.peek(1) else None
+            yield stream
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    def events(self, filters, since, until):
+        raise DockerEngineException("Docker events stream unavailable through the docker CLI")
+
+
+def get_engine():
+    """Return: the Engine API client when its unix socket is available, the docker CLI fallback otherwise."""
+    try:
+        engine = DockerEngine()
+        if os.path.exists(engine.socket_path):
+            return engine
+    except DockerEngineException:
+        pass
+    return DockerCLI()
+
+###############################################################################
+
+# container statuses that end a wait for a started container
+SETTLED_STATUSES = ['running', 'exited', 'dead', 'restarting']
+# events after which the container status is re-inspected
+STATE_EVENTS = ['start', 'die', 'restart', 'oom', 'destroy']
+
+
+def get_container_status(engine, container):
+    status = engine.get_container_status(container)
+    if status is None:
+        raise DockerEngineException("Container %s does not exist" % (container))
+    return status
+
+
+def wait_for_container_with_backoff(engine, container, deadline, initial_delay=0.05, max_delay=1.):
+    delay = initial_delay
+    while True:
+        status = get_container_status(engine, container)
+        if status in SETTLED_STATUSES or time.time() >= deadline:
+            return status
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        delay = min(delay * 2, max_delay)
+
+
+def wait_for_container(engine, container, timeout):
+    """
+    Wait until the `container` leaves its 'created' status, through the
+    events stream (falling back to inspect with backoff if it is unavailable).
+    Return: the container status ('running', 'exited', ...), still 'created' on timeout.
+    """
+    start = time.time()
+    deadline = start + timeout
+    status = get_container_status(engine, container)
+    if status in SETTLED_STATUSES:
+        return status
+    try:
+        # events since `start`: the transitions between the inspect above and the stream opening are replayed
+        for event in engine.events({'type': ['container'], 'container': [container]}, since=start, until=deadline):
+            if event.get('status', event.get('Action')) in STATE_EVENTS:
+                status = get_container_status(engine, container)
+                if status in SETTLED_STATUSES:
+                    return status
+        return get_container_status(engine, container)
+    except (OSError, http.client.HTTPException, ValueError, DockerEngineException) as e:
+        common.logger.debug("Docker events unavailable, inspecting with backoff: %s" % (e))
+        return wait_for_container_with_backoff(engine, container, deadline)
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Wait for a just started daemon container to be running.")
+    parser.add_argument("container", help="Container ID or name")
+    parser.add_argument("description", help="Container description, for error messages")
+    parser.add_argument("--timeout", type=float, default=float(os.getenv('DMAKE_CONTAINER_START_TIMEOUT', '300')), help="Timeout, in seconds")
+    args = parser.parse_args(argv)
+
+    try:
+        status = wait_for_container(get_engine(), args.container, args.timeout)
+    except DMakeException as e:
+        common.logger.error(str(e))
+        return 1
+    if status == 'running':
+        return 0
+    if status == 'restarting':
+        common.logger.error("%s is restarting" % (args.description))
+    elif status == 'created':
+        common.logger.error("%s did not start after %g seconds" % (args.description, args.timeout))
+    else:
+        common.logger.error("%s exited" % (args.description))
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
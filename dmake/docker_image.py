@@ -1,8 +1,11 @@
 import os
+import re
+import json
 from abc import abstractmethod
 
 import dmake.common as common
 from dmake.common import DMakeException, append_command
+from dmake.docker_push import DockerPush
 from dmake.serializer import FieldSerializer, SerializerMixin, YAML2PipelineSerializer
 
 ###############################################################################
@@ -17,6 +20,183 @@ def generate_copy_command(commands, tmp_dir, src):
 
 ###############################################################################
 
+def split_build_commands(build_commands):
+    """
+    Split `build.commands` in sequential steps: a string is a single step,
+    consecutive lists of commands form a step whose lists are run in parallel.
+    Return a list of steps, each step being a list of groups of commands.
+    """
+    steps = []
+    previous_is_group = False
+    for cmd in build_commands:
+        if isinstance(cmd, str):
+            steps.append([[cmd]])
+            previous_is_group = False
+            continue
+        if len(cmd) == 0:
+            continue
+        if previous_is_group:
+            steps[-1].append(cmd)
+        else:
+            steps.append([cmd])
+        previous_is_group = True
+    return steps
+
+def has_parallel_build_commands(build_commands):
+    return any(len(step) > 1 for step in split_build_commands(build_commands))
+
+def generate_build_commands_script(build_commands):
+    """
+    Generate a bash script running `build.commands`: parallel groups are run
+    concurrently (sequentially with bash < 4.3), their output is prefixed by
+    the group name, and the first failing group kills the others.
+    """
+    lines = [
+        '#!/bin/bash',
+        '# Generated by dmake from `build.commands`',
+        'set -e',
+        '',
+        'dmake_run_group() {',
+        '    local name=$1',
+        '    shift',
+        '    ( set -o pipefail; ( "$@" ) 2>&1 | while IFS= read -r line; do echo "[${name}] ${line}"; done )',
+        '}',
+        '',
+        'dmake_has_wait_n() {',
+        '    # `wait -n` requires bash >= 4.3 (e.g. CentOS 7 ships bash 4.2)',
+        '    [ ${BASH_VERSINFO[0]} -gt 4 ] || { [ ${BASH_VERSINFO[0]} -eq 4 ] && [ ${BASH_VERSINFO[1]} -ge 3 ]; }',
+        '}',
+        '',
+        'dmake_run_parallel_groups() {',
+        '    local group',
+        '    if ! dmake_has_wait_n; then',
+        '        echo "bash ${BASH_VERSION} does not support \\`wait -n\\`: running the parallel build commands sequentially"',
+        '        for group in "$@"; do',
+        '            # run in background: `set -e` would be ignored in the group if it were run in a `||` list',
+        '            dmake_run_group ${group} ${group} &',
+        '            wait $! || return $?',
+        '        done',
+        '        return 0',
+        '    fi',
+        '    # each group gets its own process group so that it can be killed with its children',
+        '    set -m',
+        '    local pids=()',
+        '    for group in "$@"; do',
+        '        dmake_run_group ${group} ${group} &',
+        '        pids+=($!)',
+        '    done',
+        '    local remaining=${#pids[@]}',
+        '    local status=0',
+        '    while [ ${remaining} -gt 0 ]; do',
+        '        wait -n || { status=$?; break; }',
+        '        remaining=$((remaining - 1))',
+        '    done',
+        '    if [ ${status} -ne 0 ]; then',
+        '        for pid in "${pids[@]}"; do',
+        '            kill -TERM -- -${pid} 2> /dev/null || :',
+        '        done',
+        '        wait 2> /dev/null || :',
+        '    fi',
+        '    set +m',
+        '    return ${status}',
+        '}',
+        '',
+    ]
+    group_index = 0
+    for step in split_build_commands(build_commands):
+        if len(step) == 1:
+            lines += step[0]
+            continue
+        groups = []
+        for group in step:
+            group_index += 1
+            name = 'build_group_%d' % group_index
+            groups.append(name)
+            lines.append('%s() {' % name)
+            lines += ['    %s' % cmd for cmd in group]
+            lines.append('}')
+        lines.append('dmake_run_parallel_groups %s' % ' '.join(groups))
+    return '\n'.join(lines) + '\n'
+
+###############################################################################
+
+class DockerBake(object):
+    """
+    Collect the service docker images builds of a plan in a single
+    `docker buildx bake` file, built at once (see `DMAKE_DOCKER_BAKE`).
+    """
+    BAKE_FILE_NAME = 'docker-bake.json'
+    TARGET_FIELDS = {'context': str, 'dockerfile': str, 'tags': list, 'args': dict, 'labels': dict, 'target': str}
+
+    # target name to target definition
+    targets = dict()
+
+    @staticmethod
+    def reset():
+        DockerBake.targets = dict()
+
+    @staticmethod
+    def add_target(context, image_name, dockerfile=None, args=None, labels=None, target=None):
+        name = common.sanitize_name(image_name)
+        if name in DockerBake.targets:
+            name = common.sanitize_name_unique(image_name, 'kubernetes')
+        definition = {
+            'context': os.path.join(common.root_dir, context),
+            'tags': [image_name]
+        }
+        if dockerfile:
+            definition['dockerfile'] = dockerfile
+        if args:
+            definition['args'] = dict(args)
+        if labels:
+            definition['labels'] = dict(labels)
+        if target:
+            definition['target'] = target
+        DockerBake.targets[name] = definition
+        return name
+
+    @staticmethod
+    def generate():
+        return {
+            'group': {'default': {'targets': list(DockerBake.targets.keys())}},
+            'target': DockerBake.targets
+        }
+
+    @staticmethod
+    def write(tmp_dir):
+        data = DockerBake.generate()
+        validate_bake_file(data)
+        bake_file = os.path.join(tmp_dir, DockerBake.BAKE_FILE_NAME)
+        with open(bake_file, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        return bake_file
+
+
+def validate_bake_file(data):
+    """Offline validation of the generated `docker buildx bake` JSON file."""
+    def check(condition, message):
+        if not condition:
+            raise DMakeException("Invalid docker bake file: %s" % message)
+
+    check(isinstance(data, dict) and set(data.keys()) == {'group', 'target'}, "expecting 'group' and 'target' top-level keys only")
+    targets = data['target']
+    check(isinstance(targets, dict), "'target' must be a dict")
+    for name, target in targets.items():
+        check(re.match(r'^[a-zA-Z0-9_-]+$', name), "invalid target name '%s'" % name)
+        check(isinstance(target, dict), "target '%s' must be a dict" % name)
+        for key, value in target.items():
+            check(key in DockerBake.TARGET_FIELDS, "unexpected field '%s' in target '%s'" % (key, name))
+            check(isinstance(value, DockerBake.TARGET_FIELDS[key]), "field '%s' of target '%s' must be a %s" % (key, name, DockerBake.TARGET_FIELDS[key].__name__))
+        check('context' in target and 'tags' in target and len(target['tags']) > 0, "target '%s' needs a context and tags" % name)
+        for key in ['args', 'labels']:
+            for k, v in target.get(key, {}).items():
+                check(isinstance(k, str) and isinstance(v, str), "%s of target '%s' must be strings" % (key, name))
+    for group_name, group in data['group'].items():
+        for target in group.get('targets', []):
+            check(target in targets, "group '%s' references unknown target '%s'" % (group_name, target))
+
+###############################################################################
+
 class AbstractDockerImage(SerializerMixin):
     """
     This is an abstract class to represent a docker image, either
@@ -138,11 +318,15 @@ class ServiceDockerCommonSerializer(YAML2PipelineSerializer, AbstractDockerImage
             image_name_without_tag = image_name.split(':')[0]
             raise DMakeException("Service '{}' declares a docker image without a user name in config::docker_image::name so I cannot deploy it. I suggest to change it to 'your_company/{}'".format(service_name, image_name_without_tag))
 
-        check_private_flag = "1" if self.check_private else "0"
-        append_command(commands, 'sh', shell='dmake_push_docker_image "%s" "%s"' % (image_name, check_private_flag))
+        # pushed with all the other images of the plan before deploying, see `core.generate_push_images`
+        DockerPush.register(image_name, self.check_private)
 
 ###############################################################################
 
+class ServiceDockerV1DependencyLayerSerializer(YAML2PipelineSerializer):
+    files    = FieldSerializer("array", child = FieldSerializer("file", child_path_only = True), help_text = "Dependency manifests (requirements files, lockfiles, ...) needed by `commands`, relative to the dmake file directory. Only these files are added to the layer, so it is rebuilt only when they change.", example = ['requirements.txt'])
+    commands = FieldSerializer("array", child = "string", default = [], help_text = "Commands installing the dependencies, run in the docker image working directory.", example = ['pip install -r requirements.txt'])
+
 class ServiceDockerV1Serializer(ServiceDockerCommonSerializer):
     # v1: dmake generated Dockerfile
     workdir          = FieldSerializer("dir", optional = True, help_text = "Working directory of the produced docker file, must be an existing directory. By default it will be directory of the dmake file.")
@@ -150,6 +334,7 @@ class ServiceDockerV1Serializer(ServiceDockerCommonSerializer):
     install_script   = FieldSerializer("file", child_path_only = True, executable = True, optional = True, example = "install.sh", help_text = "The install script (will be run in the docker). It has to be executable.")
     entrypoint       = FieldSerializer("file", child_path_only = True, executable = True, optional = True, help_text = "Set the entrypoint of the docker image generated to run the app.")
     start_script     = FieldSerializer("file", child_path_only = True, executable = True, optional = True, example = "start.sh", help_text = "The start script (will be run in the docker). It has to be executable.")
+    dependency_layers = FieldSerializer("array", child = ServiceDockerV1DependencyLayerSerializer(), default = [], help_text = "Opt-in cache-friendly layering: each item adds its dependency manifests and runs its install commands in a dedicated layer, before the whole source directory is added. Source changes then do not invalidate the dependencies layers. The `build.env` variables are only set after these layers: they are not available to their commands.")
 
     def is_runnable(self):
         return self.start_script is not None
@@ -163,38 +348,61 @@ class ServiceDockerV1Serializer(ServiceDockerCommonSerializer):
         for d in self.copy_directories:
             generate_copy_command(commands, tmp_dir, os.path.join(path_dir, '..', d))
 
+        self.generate_dockerfile(tmp_dir, path_dir, docker_base, build)
+
+        if common.docker_bake:
+            DockerBake.add_target(tmp_dir, image_name)
+            return
+        append_command(commands, 'sh', shell = 'dmake_build_docker "%s" "%s"' % (tmp_dir, image_name))
+
+    def generate_dockerfile(self, tmp_dir, path_dir, docker_base, build):
+        """
+        Write the Dockerfile (and its generated build scripts) in `tmp_dir`.
+        In layered mode (with `dependency_layers`), the dependencies layers come
+        before the whole source directory `ADD`, and before the build
+        environment: changing it does not invalidate them.
+        """
         mount_point = docker_base.mount_point
         docker_base_image = docker_base.get_docker_base_image(self.base_image_variant)
+
+        if self.workdir is not None:
+            workdir = self.workdir
+        else:
+            workdir = path_dir
+        workdir = os.path.join(mount_point, workdir)
+
         dockerfile = os.path.join(tmp_dir, 'Dockerfile')
         with open(dockerfile, 'w') as f:
             f.write('FROM %s\n' % docker_base_image)
-            f.write("ADD app %s\n" % mount_point)
 
-            if self.workdir is not None:
-                workdir = self.workdir
-            else:
-                workdir = path_dir
-            workdir = os.path.join(mount_point, workdir)
+            for layer in self.dependency_layers:
+                for file in layer.files:
+                    src = os.path.normpath(os.path.join(path_dir, file))
+                    f.write('COPY %s %s\n' % (os.path.join('app', src), os.path.join(mount_point, src)))
+                if len(layer.commands) > 0:
+                    f.write('RUN mkdir -p %s && cd %s && %s\n' % (workdir, workdir, ' && '.join(layer.commands)))
+
+            f.write("ADD app %s\n" % mount_point)
             f.write('WORKDIR %s\n' % workdir)
 
             for port in self.service.config.ports:
                 f.write('EXPOSE %d\n' % port.container_port)
 
             if build.has_value():
-                for key, value in build.env.items():
-                    if value:
-                        f.write('ENV %s %s\n' % (key, common.wrap_cmd(value)))
-                    else:
-                        # docker 17.06.1-ce rejects "ENV foo ", special case to passe empty value
-                        f.write('ENV %s=""\n' % (key))
-                f.write('ENV DMAKE_BUILD_TYPE %s\n' % (common.get_dmake_build_type()))
-
-                cmds = []
-                for cmd in build.commands:
-                    cmds += cmd
-                if len(cmds) > 0:
-                    cmd = ' && '.join(cmds)
-                    f.write('RUN cd %s && %s\n' % (workdir, cmd))
+                self._write_build_env_(f, build)
+
+                if has_parallel_build_commands(build.commands):
+                    with open(os.path.join(tmp_dir, 'dmake_build_commands.sh'), 'w') as script:
+                        script.write(generate_build_commands_script(build.commands))
+                    f.write('ADD dmake_build_commands.sh /tmp/dmake_build_commands.sh\n')
+                    f.write('RUN cd %s && bash /tmp/dmake_build_commands.sh && rm -f /tmp/dmake_build_commands.sh\n' % (workdir))
+                else:
+                    cmds = []
+                    for step in split_build_commands(build.commands):
+                        cmds += step[0]
+                    if len(cmds) > 0:
+                        cmd = ' && '.join(cmds)
+                        f.write('RUN cd %s && %s\n' % (workdir, cmd))
 
             if self.install_script is not None:
                 f.write('RUN cd %s && %s\n' % (workdir, os.path.join(mount_point, path_dir, self.install_script)))
@@ -205,7 +413,18 @@ class ServiceDockerV1Serializer(ServiceDockerCommonSerializer):
             if self.entrypoint is not None:
                 f.write('ENTRYPOINT ["%s"]\n' % os.path.join(mount_point, path_dir, self.entrypoint))
 
-        append_command(commands, 'sh', shell = 'dmake_build_docker "%s" "%s"' % (tmp_dir, image_name))
+        return dockerfile
+
+    def _write_build_env_(self, f, build):
+        if not build.has_value():
+            return
+        for key, value in build.env.items():
+            if value:
+                f.write('ENV %s %s\n' % (key, common.wrap_cmd(value)))
+            else:
+                # docker 17.06.1-ce rejects "ENV foo ", special case to passe empty value
+                f.write('ENV %s=""\n' % (key))
+        f.write('ENV DMAKE_BUILD_TYPE %s\n' % (common.get_dmake_build_type()))
 
 ###############################################################################
 
@@ -243,6 +462,9 @@ class ServiceDockerBuildSerializer(YAML2PipelineSerializer):
         # target
         if self.target:
             args.append("--target=%s" % (self.target))
+        if common.docker_bake:
+            DockerBake.add_target(self.context, image_name, dockerfile=self.dockerfile, args=build_args, labels=self.labels, target=self.target)
+            return
         cmd = '%s %s' % (program, ' '.join(map(common.wrap_cmd, args)))
         append_command(commands, 'sh', shell = cmd)
 
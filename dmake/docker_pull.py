@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import dmake.common as common
+from dmake.common import DMakeException
+from dmake.docker_push import get_local_repo_digests
+
+PULL_POLICIES = ['always', 'if-not-present', 'digest-ttl']
+
+###############################################################################
+
+class DockerPrefetch(object):
+    """
+    Collect the external docker images needed by a plan, to pull them all at
+    once in a prefetch step at the start of the plan (see `dmake_pull_docker_images`).
+    Immutable images (pinned by digest, or content-addressed base images tags)
+    are only pulled if not present, the pull policy applies to the others.
+    """
+    IMAGES_FILE_NAME = 'images_to_pull.txt'
+
+    # image name to `mutable`
+    images = dict()
+
+    @staticmethod
+    def reset():
+        DockerPrefetch.images = dict()
+
+    @staticmethod
+    def register(image_name, mutable=True):
+        if '@' in image_name:
+            mutable = False
+        DockerPrefetch.images[image_name] = DockerPrefetch.images.get(image_name, False) or mutable
+
+    @staticmethod
+    def write(tmp_dir):
+        images_file = os.path.join(tmp_dir, DockerPrefetch.IMAGES_FILE_NAME)
+        with open(images_file, 'w') as f:
+            for image_name, mutable in DockerPrefetch.images.items():
+                f.write('%s %s\n' % (image_name, "1" if mutable else "0"))
+        return images_file
+
+###############################################################################
+
+def read_images_file(images_file):
+    images = []
+    with open(images_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            image_name, mutable = line.split(' ')
+            images.append((image_name, mutable != "0"))
+    return images
+
+
+def read_digest_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_digest_cache(cache_file, cache):
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def is_image_present(image_name):
+    return len(subprocess.check_output(['docker', 'image', 'ls', '--quiet', image_name], universal_newlines=True).strip()) > 0
+
+
+def docker_pull(image_name):
+    subprocess.check_call(['docker', 'pull', image_name])
+
+
+def is_up_to_date(image_name):
+    """Compare the registry manifest digest of the image tag with the local image ones."""
+    # lazy import for faster cli
+    import dmake.docker_registry as docker_registry
+
+    try:
+        remote_digest = docker_registry.get_manifest_digest(image_name)
+    except Exception as e:
+        common.logger.warning("Could not check if '%s' is up to date, using the local image: %s" % (image_name, e))
+        return True
+    if remote_digest is None:
+        return True
+    return any(repo_digest.endswith('@' + remote_digest) for repo_digest in get_local_repo_digests(image_name))
+
+
+def should_pull(image_name, mutable, policy, ttl, cache, now):
+    if not is_image_present(image_name):
+        return True
+    if not mutable or policy == 'if-not-present':
+        return False
+    if policy == 'always':
+        return True
+    # digest-ttl: only ask the registry once per `ttl`
+    if now - cache.get(image_name, 0) < ttl:
+        return False
+    cache[image_name] = now
+    return not is_up_to_date(image_name)
+
+
+def pull_images(images, policy, ttl, cache_file, pool_size):
+    """
+    Pull all `images` [(image_name, mutable)] concurrently, according to the
+    pull `policy`. Pull failures are only warnings: the images are pulled
+    again by docker when used.
+    Return: the list of pulled images.
+    """
+    if policy not in PULL_POLICIES:
+        raise DMakeException("Invalid docker pull policy '%s', expecting one of: %s" % (policy, ', '.join(PULL_POLICIES)))
+    if len(images) == 0:
+        return []
+    cache = read_digest_cache(cache_file) if cache_file else {}
+    now = time.time()
+
+    def pull(image):
+        image_name, mutable = image
+        if not should_pull(image_name, mutable, policy, ttl, cache, now):
+            common.logger.info("Docker image %s: up to date" % (image_name))
+            return False
+        common.logger.info("Pulling docker image %s" % (image_name))
+        try:
+            docker_pull(image_name)
+        except subprocess.CalledProcessError as e:
+            common.logger.warning("Could not pull docker image %s: %s" % (image_name, e))
+            return False
+        cache[image_name] = now
+        return True
+
+    pool = ThreadPool(min(pool_size, len(images)))
+    try:
+        pulled = pool.map(pull, images)
+    finally:
+        pool.close()
+    if cache_file:
+        write_digest_cache(cache_file, cache)
+    return [image_name for (image_name, _), was_pulled in zip(images, pulled) if was_pulled]
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Pull docker images listed in IMAGES_FILE ('<image> <mutable>' lines).")
+    parser.add_argument("images_file", help="Images file")
+    parser.add_argument("digest_cache_file", nargs='?', help="Registry digests checks cache file, for the 'digest-ttl' policy")
+    args = parser.parse_args(argv)
+
+    policy = os.getenv('DMAKE_PULL_POLICY', 'always')
+    ttl = int(os.getenv('DMAKE_PULL_DIGEST_TTL', '3600'))
+    pool_size = int(os.getenv('DMAKE_PULL_PARALLELISM', '4'))
+    try:
+        pull_images(read_images_file(args.images_file), policy, ttl, args.digest_cache_file, pool_size)
+    except DMakeException as e:
+        common.logger.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
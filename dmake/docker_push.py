@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+import dmake.common as common
+from dmake.common import DMakeException
+
+###############################################################################
+
+class DockerPush(object):
+    """
+    Collect the docker images to push before deploying, to push them all at
+    once in a single plan step (see `dmake_push_docker_images`).
+    """
+    IMAGES_FILE_NAME = 'images_to_push.txt'
+
+    # image name to `check_private`
+    images = dict()
+
+    @staticmethod
+    def reset():
+        DockerPush.images = dict()
+
+    @staticmethod
+    def register(image_name, check_private):
+        DockerPush.images[image_name] = DockerPush.images.get(image_name, False) or check_private
+
+    @staticmethod
+    def write(tmp_dir):
+        images_file = os.path.join(tmp_dir, DockerPush.IMAGES_FILE_NAME)
+        with open(images_file, 'w') as f:
+            for image_name, check_private in DockerPush.images.items():
+                f.write('%s %s\n' % (image_name, "1" if check_private else "0"))
+        return images_file
+
+###############################################################################
+
+def read_images_file(images_file):
+    images = []
+    with open(images_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            image_name, check_private = line.split(' ')
+            images.append((image_name, check_private != "0"))
+    return images
+
+
+def get_local_repo_digests(image_name):
+    try:
+        output = subprocess.check_output(['docker', 'image', 'inspect', '--format', '{{json .RepoDigests}}', image_name], universal_newlines=True)
+    except subprocess.CalledProcessError:
+        return []
+    return json.loads(output) or []
+
+
+def docker_push(image_name):
+    subprocess.check_call(['docker', 'push', image_name])
+
+
+def is_already_pushed(image_name):
+    """The image is already pushed if the registry manifest of its tag is the one of the local image."""
+    # lazy import for faster cli
+    import dmake.docker_registry as docker_registry
+
+    try:
+        remote_digest = docker_registry.get_manifest_digest(image_name)
+    except Exception as e:
+        common.logger.warning("Could not check if '%s' is already pushed, pushing it: %s" % (image_name, e))
+        return False
+    if remote_digest is None:
+        return False
+    return any(repo_digest.endswith('@' + remote_digest) for repo_digest in get_local_repo_digests(image_name))
+
+
+def check_repositories_private(images, pool):
+    # lazy import for faster cli
+    import dmake.docker_registry as docker_registry
+
+    to_check = [image_name for image_name, check_private in images if check_private]
+    public = [image_name for image_name, is_public in zip(to_check, pool.map(docker_registry.is_docker_hub_repository_public, to_check)) if is_public]
+    if public:
+        raise DMakeException("The docker image repositories of %s are public. Aborting. If you still want to push, please set 'check_private' to '0' in the concerned service configuration." % (', '.join(public)))
+
+
+def push_image(image_name):
+    if is_already_pushed(image_name):
+        common.logger.info("Docker image %s already pushed, skipping" % (image_name))
+        return False
+    common.logger.info("Pushing docker image %s" % (image_name))
+    docker_push(image_name)
+    return True
+
+
+def push_images(images, pool_size):
+    """
+    Push all `images` [(image_name, check_private)]: privacy checks are done
+    first in one batch, then images are pushed concurrently, skipping the ones
+    already present in the registry.
+    Return: the list of pushed images.
+    """
+    # images without docker user cannot be pushed, like with the former per-image push
+    images = [(image_name, check_private) for image_name, check_private in images if len(image_name.split('/')) > 1]
+    if len(images) == 0:
+        return []
+    pool = ThreadPool(min(pool_size, len(images)))
+    try:
+        check_repositories_private(images, pool)
+        image_names = [image_name for image_name, _ in images]
+        pushed = pool.map(push_image, image_names)
+    finally:
+        pool.close()
+    return [image_name for image_name, was_pushed in zip(image_names, pushed) if was_pushed]
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Push docker images listed in IMAGES_FILE ('<image> <check_private>' lines).")
+    parser.add_argument("images_file", help="Images file")
+    args = parser.parse_args(argv)
+
+    pool_size = int(os.getenv('DMAKE_PUSH_PARALLELISM', '4'))
+    try:
+        push_images(read_images_file(args.images_file), pool_size)
+    except (DMakeException, subprocess.CalledProcessError) as e:
+        common.logger.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
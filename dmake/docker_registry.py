@@ -103,6 +103,72 @@ def get_image_digest(image):
     return response.headers['Docker-Content-Digest']
 
 
+def parse_docker_image_reference(image):
+    """Parse docker image with optional registry host and digest, add defaults.
+
+    Return: (registry_url, repository, reference) where reference is a tag or a digest
+    """
+    registry_url = REGISTRY_URL
+    tokens = image.split('/')
+    if len(tokens) > 1 and ('.' in tokens[0] or ':' in tokens[0] or tokens[0] == 'localhost'):
+        if tokens[0] not in ['docker.io', 'index.docker.io']:
+            registry_url = 'https://' + tokens[0]
+        tokens = tokens[1:]
+    if len(tokens) == 1 and registry_url == REGISTRY_URL:
+        tokens = ['library'] + tokens
+    image = '/'.join(tokens)
+
+    if '@' in image:
+        repository, reference = image.split('@', 1)
+    elif ':' in tokens[-1]:
+        repository, reference = image.rsplit(':', 1)
+    else:
+        repository, reference = image, 'latest'
+    return registry_url, repository, reference
+
+
+def get_manifest_digest(image):
+    """Get the registry manifest digest of an image tag or digest.
+
+    Return: the digest, or None if the manifest does not exist in the registry
+    """
+    logger.debug('get_manifest_digest: %s', image)
+
+    registry_url, repository, reference = parse_docker_image_reference(image)
+
+    manifest_path = '/v2/%s/manifests/%s' % (repository, reference)
+    headers = {'Accept': ', '.join(['application/vnd.docker.distribution.manifest.v2+json',
+                                    'application/vnd.docker.distribution.manifest.list.v2+json',
+                                    'application/vnd.oci.image.manifest.v1+json',
+                                    'application/vnd.oci.image.index.v1+json'])}
+    response = get(registry_url, manifest_path, headers=headers)
+
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200 or 'Docker-Content-Digest' not in response.headers:
+        raise DMakeException('Docker registry: Error getting manifest: %s%s %s %s' % (registry_url, manifest_path, response.status_code, response.text))
+
+    return response.headers['Docker-Content-Digest']
+
+
+def is_docker_hub_repository_public(image):
+    """Check if the Docker Hub repository of an image is public.
+
+    Return: True if public, False if private (or not found), None if the image is not hosted on Docker Hub
+    """
+    registry_url, repository, _ = parse_docker_image_reference(image)
+    if registry_url != REGISTRY_URL:
+        return None
+
+    url = 'https://hub.docker.com/v2/repositories/%s/' % (repository)
+    response = requests.get(url)
+    if response.status_code == 200:
+        return True
+    if response.status_code == 404:
+        return False
+    raise DMakeException('Docker Hub: Error checking repository privacy: %s %s %s' % (url, response.status_code, response.text))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("command", choices=['image-digest'], default='image-digest', nargs='?', help="Command on docker registry")
@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import dmake.common as common
+
+SUITES_COUNTERS = ['tests', 'failures', 'errors', 'skipped']
+
+###############################################################################
+
+def merge_reports(reports, output):
+    """
+    Merge the `<testsuite>`s of the junit `reports` into a single `<testsuites>`
+    report. Missing reports are ignored, but at least one is needed.
+    Return: the missing reports.
+    """
+    merged = ET.Element('testsuites')
+    counters = {counter: 0 for counter in SUITES_COUNTERS}
+    time = 0.
+    missing = []
+    for report in reports:
+        if not os.path.isfile(report):
+            missing.append(report)
+            continue
+        root = ET.parse(report).getroot()
+        suites = [root] if root.tag == 'testsuite' else list(root)
+        for suite in suites:
+            merged.append(suite)
+            for counter in SUITES_COUNTERS:
+                counters[counter] += int(suite.get(counter, 0))
+            time += float(suite.get('time', 0))
+    if len(missing) == len(reports):
+        raise common.DMakeException("No junit report to merge: %s" % (', '.join(reports)))
+
+    for counter, value in counters.items():
+        merged.set(counter, str(value))
+    merged.set('time', '%.3f' % time)
+    output_dir = os.path.dirname(output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    ET.ElementTree(merged).write(output, encoding='utf-8', xml_declaration=True)
+    return missing
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Merge junit reports into a single one.")
+    parser.add_argument("output", help="Merged report path")
+    parser.add_argument("reports", nargs='+', help="Reports to merge")
+    args = parser.parse_args(argv)
+
+    try:
+        missing = merge_reports(args.reports, args.output)
+    except (common.DMakeException, ET.ParseError) as e:
+        common.logger.error(str(e))
+        return 1
+    for report in missing:
+        common.logger.warning("Missing junit report: %s" % (report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,269 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import dmake.common as common
+from dmake.common import DMakeException
+from dmake.kubernetes_rollout import get_rollout_status
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logger = logging.getLogger(__name__)
+
+###############################################################################
+
+class KubernetesCDApi(object):
+    """
+    The API calls of the continuous deployment, on one kubectl context and
+    namespace: resources are plain dicts, as served by the API. The client
+    credentials come from the kubeconfig, exec credential plugins included:
+    they are loaded again when the API server rejects them (expired token).
+    """
+    def __init__(self, context, namespace, config_file=None):
+        import kubernetes
+        self.kubernetes = kubernetes
+        self.context = context
+        self.namespace = namespace
+        self.config_file = config_file
+        self.load_client()
+
+    def load_client(self):
+        api_client = self.kubernetes.config.new_client_from_config(config_file=self.config_file, context=self.context)
+        if os.getenv('DMAKE_DEBUG') == '1':
+            api_client.configuration.debug = True
+        self.core_v1 = self.kubernetes.client.CoreV1Api(api_client)
+        self.apps_v1 = self.kubernetes.client.AppsV1Api(api_client)
+
+    def call(self, get_method, *args, **kwargs):
+        """Return: the decoded response of `get_method()(*args, **kwargs)`, or None on 404."""
+        for attempt in range(2):
+            try:
+                response = get_method()(*args, _preload_content=False, **kwargs)
+                return json.loads(response.data)
+            except self.kubernetes.client.rest.ApiException as e:
+                if e.status == 404:
+                    return None
+                if e.status == 401 and attempt == 0:
+                    logger.info("Unauthorized: refreshing the credentials")
+                    self.load_client()
+                    continue
+                raise DMakeException("Kubernetes API error: %s %s" % (e.status, e.reason))
+
+    def read_config_map(self, name):
+        return self.call(lambda: self.core_v1.read_namespaced_config_map, name, self.namespace)
+
+    def create_config_map(self, body):
+        return self.call(lambda: self.core_v1.create_namespaced_config_map, self.namespace, body)
+
+    def replace_config_map(self, name, body):
+        return self.call(lambda: self.core_v1.replace_namespaced_config_map, name, self.namespace, body)
+
+    def list_deployments(self, label_selector):
+        """Return: (Deployments, resourceVersion of the list)."""
+        data = self.call(lambda: self.apps_v1.list_namespaced_deployment, self.namespace, label_selector=label_selector)
+        for deployment in data['items']:
+            deployment['kind'] = 'Deployment'
+        return data['items'], data['metadata']['resourceVersion']
+
+    def patch_deployment(self, name, json_patch):
+        """Return: the patched Deployment, or None if it disappeared."""
+        return self.call(lambda: self.apps_v1.patch_namespaced_deployment, name, self.namespace, json_patch)
+
+    def watch_deployments(self, label_selector, resource_version, timeout):
+        """Yield: (event type, Deployment) from `resource_version`, for at most `timeout` seconds."""
+        # plain dicts: no client models deserialization
+        watch = self.kubernetes.watch.Watch(return_type='object')
+        for event in watch.stream(self.apps_v1.list_namespaced_deployment, self.namespace, label_selector=label_selector,
+                                  resource_version=resource_version, timeout_seconds=max(1, int(timeout))):
+            if event['type'] != 'ERROR':
+                event['raw_object']['kind'] = 'Deployment'
+            yield event['type'], event['raw_object']
+
+###############################################################################
+
+def ensure_config_map_env(api, configmap):
+    """Create the env ConfigMap, unless it already exists: its name is unique per env."""
+    name = configmap['metadata']['name']
+    existing = api.read_config_map(name)
+    if existing is None:
+        logger.info("Creating new ConfigMap Environment %s" % (name))
+        api.create_config_map(configmap)
+    elif existing.get('data') != configmap['data']:
+        raise DMakeException('ConfigMap name should be unique per environment (configmap/%s)' % (name))
+
+
+def ensure_dmake_metadata_config_map(api, app_name, service, configmap_env_name, image):
+    """Create or update the DMake metadata ConfigMap defining the default ConfigMap env, and image."""
+    name = 'dmake-metadata-%s' % (service)
+    data = {
+        'ConfigMapEnvName': configmap_env_name,
+        'Image': image
+    }
+    existing = api.read_config_map(name)
+    if existing is not None and existing.get('data') == data:
+        return
+    body = {
+        'apiVersion': 'v1',
+        'kind': 'ConfigMap',
+        'metadata': {
+            'name': name,
+            'labels': {
+                'app': service,
+                'product': app_name
+            }
+        },
+        'data': data
+    }
+    if existing is None:
+        logger.info("Create DMake metadata ConfigMap %s: %s" % (name, data))
+        api.create_config_map(body)
+    else:
+        logger.info("Update DMake metadata ConfigMap %s: %s" % (name, data))
+        api.replace_config_map(name, body)
+
+
+def get_deployment_patch(deployment, image, configmap_env_name):
+    """Return: the JSON patch updating the image and the env ConfigMap of `deployment`, empty if it is up to date."""
+    name = deployment['metadata']['name']
+    containers = deployment['spec']['template']['spec']['containers']
+    # TODO use container name from label value (using `selector`)
+    if len(containers) != 1:
+        raise DMakeException("Deployment %s: multiple containers found in Pod definition; not yet supported." % (name))
+    container = containers[0]
+
+    json_patch = []
+    if container.get('image') != image:
+        json_patch.append({"op": "replace", "path": "/spec/template/spec/containers/0/image", "value": image})
+    # `env` takes precedence over `envFrom`
+    # does it already use a configMap?
+    try:
+        existing_configmap_env_name = container['envFrom'][0]['configMapRef']['name']
+    except (KeyError, IndexError, TypeError):
+        existing_configmap_env_name = None
+    if existing_configmap_env_name is None:
+        json_patch.append({"op": "add", "path": "/spec/template/spec/containers/0/envFrom", "value": [{"configMapRef": {"name": configmap_env_name}}]})
+    elif existing_configmap_env_name != configmap_env_name:
+        json_patch.append({"op": "replace", "path": "/spec/template/spec/containers/0/envFrom/0/configMapRef/name", "value": configmap_env_name})
+    return json_patch
+
+
+def update_deployments(api, label_selector, image, configmap_env_name, parallel_updates, timeout, clock=time.time):
+    """
+    Update the image and env ConfigMap of the Deployments matching `label_selector`:
+    at most `parallel_updates` of them are rolling out at once, their progress is
+    followed with one watch, within the `timeout` overall deadline.
+    """
+    deadline = clock() + timeout
+    deployments, resource_version = api.list_deployments(label_selector)
+    pending = []
+    # name -> Deployment, being rolled out
+    updating = {}
+    # name -> generation of the update: older watch events don't tell about it
+    generations = {}
+    for deployment in deployments:
+        json_patch = get_deployment_patch(deployment, image, configmap_env_name)
+        if json_patch:
+            pending.append((deployment['metadata']['name'], json_patch))
+        elif not get_rollout_status(deployment)[0]:
+            updating[deployment['metadata']['name']] = deployment
+            generations[deployment['metadata']['name']] = deployment['metadata']['generation']
+    logger.info("%d Deployments to update, %d up to date" % (len(pending), len(deployments) - len(pending)))
+
+    def start_updates():
+        while pending and len(updating) < parallel_updates:
+            name, json_patch = pending.pop(0)
+            logger.info("- Updating Deployment %s" % (name))
+            deployment = api.patch_deployment(name, json_patch)
+            if deployment is None:
+                # ignore deployments that disappeared during update
+                logger.info("- Deployment %s disappeared during update, skipping" % (name))
+                continue
+            deployment['kind'] = 'Deployment'
+            updating[name] = deployment
+            generations[name] = deployment['metadata']['generation']
+
+    def update_status(deployment):
+        name = deployment['metadata']['name']
+        if name not in updating or deployment['metadata']['generation'] < generations[name]:
+            return
+        updating[name] = deployment
+        done, message = get_rollout_status(deployment)
+        if done:
+            logger.info("  Deployment ready: %s" % (name))
+            del updating[name]
+        else:
+            logger.info("- Waiting for Deployment %s: %s" % (name, message))
+
+    start_updates()
+    while updating or pending:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise DMakeException("Deployments not updated after %d seconds: %s" % (timeout, ', '.join(sorted(list(updating) + [name for name, _ in pending]))))
+        expired = False
+        for event_type, deployment in api.watch_deployments(label_selector, resource_version, remaining):
+            if event_type == 'ERROR':
+                # resource version too old: list again
+                expired = True
+                break
+            resource_version = deployment['metadata']['resourceVersion']
+            if event_type == 'DELETED':
+                if updating.pop(deployment['metadata']['name'], None) is not None:
+                    logger.info("- Deployment %s disappeared during update, skipping" % (deployment['metadata']['name']))
+            else:
+                update_status(deployment)
+            start_updates()
+            if not updating and not pending:
+                break
+        if expired:
+            deployments, resource_version = api.list_deployments(label_selector)
+            names = set()
+            for deployment in deployments:
+                names.add(deployment['metadata']['name'])
+                update_status(deployment)
+            for name in set(updating) - names:
+                del updating[name]
+            start_updates()
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Continuous deployment via Kubernetes: update the image and env ConfigMap of the Deployments running a service.")
+    parser.add_argument('--parallel-updates', type=int, default=10, help="Number of Deployments being updated in parallel")
+    parser.add_argument('--timeout', type=float, default=1800, help="Overall deadline of the Deployments updates, in seconds")
+    parser.add_argument('tmp_dir')
+    parser.add_argument('context')
+    parser.add_argument('namespace')
+    parser.add_argument('app_name')
+    parser.add_argument('service')
+    parser.add_argument('image')
+    parser.add_argument('configmap_env_file')
+    parser.add_argument('selectors', nargs='?', default='')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if os.getenv('DMAKE_DEBUG') == '1' else logging.INFO, format=FORMAT)
+
+    with open(args.configmap_env_file) as f:
+        configmap = common.yaml_ordered_load(f)
+    configmap_env_name = configmap['metadata']['name']
+
+    label_selector = 'dmake_%s' % (args.service)
+    if args.selectors:
+        label_selector += ',' + args.selectors
+
+    try:
+        api = KubernetesCDApi(args.context, args.namespace, config_file=os.getenv('KUBECONFIG'))
+        ensure_config_map_env(api, configmap)
+        ensure_dmake_metadata_config_map(api, args.app_name, args.service, configmap_env_name, args.image)
+        logger.info("Deploying new image %s with ConfigMap env %s" % (args.image, configmap_env_name))
+        update_deployments(api, label_selector, args.image, configmap_env_name, args.parallel_updates, args.timeout)
+    except DMakeException as e:
+        logger.critical(str(e))
+        return 1
+    logger.info("Finished updating Deployments with new image %s with ConfigMap env %s" % (args.image, configmap_env_name))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,31 @@
+import base64
 import hashlib
 import json
+import os
+import re
+from string import Template
 
 import dmake.common as common
+from dmake.common import DMakeException
+
+# bump to invalidate the rendered manifests cache
+RENDER_CACHE_VERSION = 1
+DEPLOY_TIMESTAMP_ANNOTATION = 'dmake.deepomatic.com/deploy-timestamp'
+DEPLOY_TIMESTAMP_SENTINEL = '0001-01-01T00:00:00Z'
+# content hash of all the manifests of a service deployment, stamped on its resources: unchanged services are not applied again
+MANIFESTS_HASH_ANNOTATION = 'dmake.deepomatic.com/manifests-hash'
+MANIFESTS_HASH_SENTINEL = 'sha256:' + '0' * 64
+# annotations changing at each deployment, without changing the deployed resources
+VOLATILE_ANNOTATIONS = [
+    DEPLOY_TIMESTAMP_ANNOTATION,
+    MANIFESTS_HASH_ANNOTATION,
+    'dmake.deepomatic.com/git-branch',
+    'dmake.deepomatic.com/git-revision',
+    'kubernetes.io/change-cause',
+]
+
+# ConfigMap and Secret data keys
+valid_key_pattern = re.compile(r'^[-._a-zA-Z0-9]+$')
 
 
 def get_env_hash(env):
@@ -13,21 +37,16 @@ def get_env_hash(env):
 
 def generate_config_map(env, name, labels = None, annotations = None):
     """Return a kubernetes manifest defining a ConfigMap storing `env`."""
-    data = common.yaml_ordered_load("""
-apiVersion: v1
-kind: ConfigMap
-metadata:
-  name: ""
-  labels: {}
-  annotations: {}
-data: {}
-""")
-    data['metadata']['name'] = name
-    if labels:
-        data['metadata']['labels'] = labels
-    if annotations:
-        data['metadata']['annotations'] = annotations
-    data['data'] = env
+    data = {
+        'apiVersion': 'v1',
+        'kind': 'ConfigMap',
+        'metadata': {
+            'name': name,
+            'labels': labels or {},
+            'annotations': annotations or {},
+        },
+        'data': env,
+    }
     return data
 
 
@@ -35,12 +54,56 @@ def generate_config_map_file(env, name_prefix, output_filepath, labels = None, a
     """Generate a ConfigMap manifest file with unique env-hashed name, and return the name."""
     env_hash = get_env_hash(env)
     name = "%s-env-%s" % (name_prefix, env_hash)
-    data = generate_config_map(env, name, labels, annotations)
+    key_data = {'config_map_env': env, 'name': name, 'labels': labels}
+    data_str = render_cached(key_data, annotations, lambda annotations: common.yaml_ordered_dump(generate_config_map(env, name, labels, annotations), default_flow_style=False))
     with open(output_filepath, 'w') as configmap_file:
-        common.yaml_ordered_dump(data, configmap_file, default_flow_style=False)
+        configmap_file.write(data_str)
     return name
 
 
+def render_manifest_template(template_path, template_context, labels = None, annotations = None):
+    """Return the `template_path` manifest template rendered with `template_context`, with labels and annotations injected."""
+    with open(template_path, 'r') as f:
+        template = f.read()
+    key_data = {'template': hashlib.sha256(template.encode('utf-8')).hexdigest(), 'variables': template_context, 'labels': labels}
+    return render_cached(key_data, annotations, lambda annotations: dump_all_str_and_add_metadata(Template(template).substitute(**template_context), labels, annotations))
+
+
+def get_render_cache_file(key_data):
+    key = hashlib.sha256(json.dumps([RENDER_CACHE_VERSION, common.yaml_backend, key_data], sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(common.config_dir, 'kubernetes', 'rendered', key[:2], '%s.yaml' % (key))
+
+
+def render_cached(key_data, annotations, render):
+    """
+    Return the YAML output of `render(annotations)`, cached on disk by `key_data` and `annotations`.
+    The deploy timestamp annotation changes at each deployment: it is rendered as a sentinel of the
+    same shape (same YAML quoting and folding), substituted afterwards.
+    """
+    timestamp = (annotations or {}).get(DEPLOY_TIMESTAMP_ANNOTATION)
+    if timestamp is not None and len(timestamp) == len(DEPLOY_TIMESTAMP_SENTINEL):
+        annotations = annotations.copy()
+        annotations[DEPLOY_TIMESTAMP_ANNOTATION] = DEPLOY_TIMESTAMP_SENTINEL
+    else:
+        timestamp = None
+
+    cache_file = get_render_cache_file([key_data, annotations])
+    try:
+        with open(cache_file, 'r') as f:
+            data_str = f.read()
+    except IOError:
+        data_str = render(annotations)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(data_str)
+        os.rename(tmp_file, cache_file)
+
+    if timestamp is not None:
+        data_str = data_str.replace(DEPLOY_TIMESTAMP_SENTINEL, timestamp)
+    return data_str
+
+
 def add_metadata(resource, labels = None, annotations = None):
     if labels:
         if 'labels' not in resource['metadata']:
@@ -56,12 +119,12 @@ def dump_all_str_and_add_metadata(data_str_or_list_of_str, labels=None, annotati
     """
     Input:
     - either a str for one or more yamls;
-    - or a list of str for one yaml
+    - or a list of str for one yaml, or of already loaded resources
     Output:
     multi element yaml str (or written to file if specified), with labels and annotations injected in metadata (and annotations also added to spec.template.metadata when it exists).
     """
     if isinstance(data_str_or_list_of_str, list):
-        data = [common.yaml_ordered_load(data_str) for data_str in data_str_or_list_of_str]
+        data = [common.yaml_ordered_load(data_str) if isinstance(data_str, str) else data_str for data_str in data_str_or_list_of_str]
     else:
         data = common.yaml_ordered_load(data_str_or_list_of_str, all=True)
     for resource in data:
@@ -73,9 +136,88 @@ def dump_all_str_and_add_metadata(data_str_or_list_of_str, labels=None, annotati
     return common.yaml_ordered_dump(data, file, all=True)
 
 
-def generate_from_create(args, name, from_file_args):
-    program = 'kubectl'
-    args = ['create'] + args + ['--dry-run=true', '--output=yaml', name] + from_file_args
-    cmd = '%s %s' % (program, ' '.join(map(common.wrap_cmd, args)))
-    manifest = common.run_shell_command(cmd, raise_on_return_code=True)
-    return manifest
+def get_manifests_hash(data_strs):
+    """Return the content hash of the `data_strs` manifests, ignoring their volatile annotations."""
+    data = []
+    for data_str in data_strs:
+        for resource in common.yaml_ordered_load(data_str, all=True):
+            if not resource:
+                continue
+            metadatas = [resource.get('metadata')]
+            if isinstance(resource.get('spec'), dict) and isinstance(resource['spec'].get('template'), dict):
+                metadatas.append(resource['spec']['template'].get('metadata'))
+            for metadata in metadatas:
+                annotations = metadata.get('annotations') if isinstance(metadata, dict) else None
+                if annotations:
+                    metadata['annotations'] = {key: value for key, value in annotations.items() if key not in VOLATILE_ANNOTATIONS}
+            data.append(resource)
+    serialized_data = json.dumps(data, sort_keys=True, default=str)
+    return 'sha256:' + hashlib.sha256(serialized_data.encode('utf-8')).hexdigest()
+
+
+def stamp_manifests_hash(paths):
+    """Replace the manifests hash sentinel in the `paths` manifest files by their content hash, and return it."""
+    data_strs = []
+    for path in paths:
+        with open(path, 'r') as f:
+            data_strs.append(f.read())
+    manifests_hash = get_manifests_hash(data_strs)
+    for path, data_str in zip(paths, data_strs):
+        with open(path, 'w') as f:
+            f.write(data_str.replace(MANIFESTS_HASH_SENTINEL, manifests_hash))
+    return manifests_hash
+
+
+def read_from_files(from_files):
+    """Return: {key: file content bytes} of `from_files` [(key, path)], with the `kubectl create --from-file=key=path` keys checks."""
+    data = {}
+    for key, path in from_files:
+        if not valid_key_pattern.match(key) or len(key) > 253 or key == '.' or key.startswith('..'):
+            raise DMakeException("Invalid Kubernetes data key '%s' (file %s): a valid key must consist of alphanumeric characters, '-', '_' or '.'" % (key, path))
+        if key in data:
+            raise DMakeException("Invalid Kubernetes data key '%s' (file %s): another key by that name already exists" % (key, path))
+        with open(path, 'rb') as f:
+            data[key] = f.read()
+    return data
+
+
+def base64_encode(content):
+    return base64.b64encode(content).decode('ascii')
+
+
+def generate_config_map_from_files(name, from_files):
+    """
+    Return a ConfigMap resource storing the files `from_files` [(key, path)], as
+    `kubectl create configmap --dry-run --output=yaml` would: UTF-8 files in
+    `data`, the other ones base64-encoded in `binaryData`; keys sorted.
+    """
+    data = {}
+    binary_data = {}
+    for key, content in sorted(read_from_files(from_files).items()):
+        try:
+            data[key] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            binary_data[key] = base64_encode(content)
+    resource = {'apiVersion': 'v1'}
+    if binary_data:
+        resource['binaryData'] = binary_data
+    if data:
+        resource['data'] = data
+    resource['kind'] = 'ConfigMap'
+    resource['metadata'] = {'creationTimestamp': None, 'name': name}
+    return resource
+
+
+def generate_secret_from_files(name, from_files):
+    """
+    Return an Opaque Secret resource storing the files `from_files` [(key, path)], base64-encoded,
+    as `kubectl create secret generic --dry-run --output=yaml` would.
+    """
+    data = {key: base64_encode(content) for key, content in sorted(read_from_files(from_files).items())}
+    resource = {'apiVersion': 'v1'}
+    if data:
+        resource['data'] = data
+    resource['kind'] = 'Secret'
+    resource['metadata'] = {'creationTimestamp': None, 'name': name}
+    resource['type'] = 'Opaque'
+    return resource
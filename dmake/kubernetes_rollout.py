@@ -0,0 +1,374 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import dmake.common as common
+from dmake.common import DMakeException, append_command
+
+###############################################################################
+
+SERVICE_LABEL = 'dmake.deepomatic.com/service'
+MANIFESTS_HASH_ANNOTATION = 'dmake.deepomatic.com/manifests-hash'
+# workloads kinds with a rollout, and their kubernetes python client AppsV1Api methods suffix
+ROLLOUT_KINDS = {
+    'Deployment': 'deployment',
+    'StatefulSet': 'stateful_set',
+    'DaemonSet': 'daemon_set',
+}
+# pods containers waiting reasons failing the rollout right away
+CRASH_REASONS = ['CrashLoopBackOff', 'ImagePullBackOff', 'ErrImagePull', 'InvalidImageName', 'CreateContainerConfigError']
+
+
+class KubernetesRollouts(object):
+    """
+    Collect the Kubernetes deployments of the deploy height of a parallel plan:
+    they are applied without waiting for their rollouts, then one monitor waits
+    for all of them concurrently (see `RolloutMonitor`).
+    """
+    # (kubectl context, namespace, deploy_name)
+    deployments = []
+
+    @staticmethod
+    def reset():
+        KubernetesRollouts.deployments = []
+
+    @staticmethod
+    def register(context, namespace, deploy_name):
+        KubernetesRollouts.deployments.append((context, namespace, deploy_name))
+
+    @staticmethod
+    def generate_monitor(commands):
+        if len(KubernetesRollouts.deployments) == 0:
+            return
+        args = ['--timeout', str(common.kubernetes_rollout_timeout)]
+        for deployment in KubernetesRollouts.deployments:
+            args += ['--target'] + list(deployment)
+        cmd = 'dmake_k8s_rollout_monitor %s' % (' '.join(map(common.wrap_cmd, args)))
+        append_command(commands, 'sh', shell = cmd)
+
+###############################################################################
+
+class KubernetesApi(object):
+    """
+    The API calls of the monitor, on one kubectl context and namespace:
+    resources are returned as plain dicts, as served by the API.
+    """
+    def __init__(self, context, namespace):
+        import kubernetes
+        import urllib3
+        self.kubernetes = kubernetes
+        # client (HTTP status) and transport errors
+        self.errors = (kubernetes.client.rest.ApiException, urllib3.exceptions.HTTPError, OSError)
+        try:
+            api_client = kubernetes.config.new_client_from_config(context=context)
+            self.apps_v1 = kubernetes.client.AppsV1Api(api_client)
+            self.core_v1 = kubernetes.client.CoreV1Api(api_client)
+            if not namespace:
+                contexts, active_context = kubernetes.config.list_kube_config_contexts()
+                context_data = next((c for c in contexts if c['name'] == context), active_context)
+                namespace = context_data['context'].get('namespace', 'default')
+        except (kubernetes.config.ConfigException,) + self.errors as e:
+            raise KubernetesApiError("Kubernetes context '%s': %s" % (context, e))
+        self.namespace = namespace
+
+    def list(self, kind, label_selector):
+        """Return: (resources, resourceVersion of the list)."""
+        method = getattr(self.apps_v1, 'list_namespaced_%s' % (ROLLOUT_KINDS[kind]))
+        data = json.loads(method(self.namespace, label_selector=label_selector, _preload_content=False).data)
+        return data['items'], data['metadata']['resourceVersion']
+
+    def watch(self, kind, label_selector, resource_version, timeout):
+        """Yield: (event type, resource) from `resource_version`, for at most `timeout` seconds."""
+        method = getattr(self.apps_v1, 'list_namespaced_%s' % (ROLLOUT_KINDS[kind]))
+        # plain dicts: no client models deserialization
+        watch = self.kubernetes.watch.Watch(return_type='object')
+        try:
+            for event in watch.stream(method, self.namespace, label_selector=label_selector, resource_version=resource_version, timeout_seconds=max(1, int(timeout))):
+                yield event['type'], event['raw_object']
+        except self.kubernetes.client.rest.ApiException as e:
+            if e.status == 410:
+                raise ResourceVersionExpired()
+            raise
+
+    def list_pods(self, label_selector):
+        try:
+            data = json.loads(self.core_v1.list_namespaced_pod(self.namespace, label_selector=label_selector, _preload_content=False).data)
+        except self.errors + (ValueError,) as e:
+            raise KubernetesApiError("failed listing pods '%s': %s" % (label_selector, e))
+        return data['items']
+
+
+class ResourceVersionExpired(Exception):
+    pass
+
+
+class KubernetesApiError(DMakeException):
+    pass
+
+###############################################################################
+
+def get_rollout_status(resource):
+    """
+    Return: (done, message) of the rollout of a Deployment, StatefulSet or DaemonSet,
+    like `kubectl rollout status`; raises DMakeException when the rollout is stuck.
+    """
+    kind = resource['kind']
+    name = resource['metadata']['name']
+    spec = resource.get('spec', {})
+    status = resource.get('status') or {}
+    if status.get('observedGeneration', 0) < resource['metadata'].get('generation', 0):
+        return False, "waiting for the rollout to start"
+
+    if kind == 'Deployment':
+        for condition in status.get('conditions', []):
+            if condition['type'] == 'Progressing' and condition.get('reason') == 'ProgressDeadlineExceeded':
+                raise DMakeException("Deployment %s exceeded its progress deadline: %s" % (name, condition.get('message', '')))
+        replicas = spec.get('replicas', 1)
+        updated = status.get('updatedReplicas', 0)
+        if updated < replicas:
+            return False, "%d out of %d new replicas have been updated" % (updated, replicas)
+        if status.get('replicas', 0) > updated:
+            return False, "%d old replicas are pending termination" % (status['replicas'] - updated)
+        if status.get('availableReplicas', 0) < updated:
+            return False, "%d of %d updated replicas are available" % (status.get('availableReplicas', 0), updated)
+        return True, "successfully rolled out"
+
+    if kind == 'StatefulSet':
+        strategy = spec.get('updateStrategy', {})
+        if strategy.get('type') == 'OnDelete':
+            return True, "OnDelete update strategy: not waiting"
+        replicas = spec.get('replicas', 1)
+        ready = status.get('readyReplicas', 0)
+        if ready < replicas:
+            return False, "%d of %d pods are ready" % (ready, replicas)
+        partition = strategy.get('rollingUpdate', {}).get('partition', 0)
+        if partition:
+            updated = status.get('updatedReplicas', 0)
+            if updated < replicas - partition:
+                return False, "%d of %d partitioned pods are updated" % (updated, replicas - partition)
+            return True, "partitioned roll out complete"
+        if status.get('updateRevision') != status.get('currentRevision'):
+            return False, "%d of %d pods are updated" % (status.get('updatedReplicas', 0), replicas)
+        return True, "successfully rolled out"
+
+    if kind == 'DaemonSet':
+        if spec.get('updateStrategy', {}).get('type') == 'OnDelete':
+            return True, "OnDelete update strategy: not waiting"
+        desired = status.get('desiredNumberScheduled', 0)
+        updated = status.get('updatedNumberScheduled', 0)
+        if updated < desired:
+            return False, "%d out of %d new pods have been updated" % (updated, desired)
+        available = status.get('numberAvailable', 0)
+        if available < desired:
+            return False, "%d of %d updated pods are available" % (available, desired)
+        return True, "successfully rolled out"
+
+    raise DMakeException("Unsupported rollout kind: %s" % (kind))
+
+
+def get_crashed_pod_error(resource, pods):
+    """Return: the error of the first crashing pod of the new revision of `resource`, or None."""
+    template_annotations = resource['spec']['template'].get('metadata', {}).get('annotations') or {}
+    manifests_hash = template_annotations.get(MANIFESTS_HASH_ANNOTATION)
+    for pod in pods:
+        # old revisions pods are being replaced: they don't fail the rollout
+        if manifests_hash is not None and (pod['metadata'].get('annotations') or {}).get(MANIFESTS_HASH_ANNOTATION) != manifests_hash:
+            continue
+        statuses = (pod.get('status') or {}).get('initContainerStatuses', []) + (pod.get('status') or {}).get('containerStatuses', [])
+        for container_status in statuses:
+            waiting = container_status.get('state', {}).get('waiting') or {}
+            if waiting.get('reason') in CRASH_REASONS:
+                return "pod %s container %s: %s %s" % (pod['metadata']['name'], container_status['name'], waiting['reason'], waiting.get('message', ''))
+    return None
+
+
+def get_display_name(key, resource):
+    """Return: `service Kind/name`, for the (context, namespace, kind, name) `key`."""
+    service = (resource['metadata'].get('labels') or {}).get(SERVICE_LABEL, '')
+    return "%s %s/%s" % (service, key[2], key[3])
+
+
+def get_selector_string(resource):
+    selector = resource['spec'].get('selector', {})
+    requirements = ['%s=%s' % item for item in sorted(selector.get('matchLabels', {}).items())]
+    for expression in selector.get('matchExpressions', []):
+        if expression['operator'] in ['In', 'NotIn']:
+            requirements.append('%s %s (%s)' % (expression['key'], expression['operator'].lower(), ','.join(expression['values'])))
+        elif expression['operator'] == 'Exists':
+            requirements.append(expression['key'])
+        elif expression['operator'] == 'DoesNotExist':
+            requirements.append('!%s' % (expression['key']))
+    return ','.join(requirements)
+
+###############################################################################
+
+class RolloutMonitor(object):
+    """
+    Wait for the rollouts of all the Deployments, StatefulSets and DaemonSets
+    of the `targets` services [(kubectl context, namespace, deploy_name)]
+    concurrently: one watch per context, namespace and kind, and one overall
+    deadline. Fails on the first stuck or crash-looping rollout.
+    """
+    def __init__(self, targets, timeout, api_factory=KubernetesApi, check_interval=5, report_interval=30, clock=time.time):
+        self.groups = {}
+        for context, namespace, deploy_name in targets:
+            self.groups.setdefault((context, namespace), []).append(deploy_name)
+        self.timeout = timeout
+        self.api_factory = api_factory
+        self.check_interval = check_interval
+        self.report_interval = report_interval
+        self.clock = clock
+        self.condition = threading.Condition()
+        # (context, namespace, kind, name) -> [resource, done, message]
+        self.rollouts = {}
+        # (context, namespace, kind) not listed yet
+        self.pending_lists = set()
+        self.error = None
+
+    def log(self, message):
+        print("[DMake] %s" % (message))
+        sys.stdout.flush()
+
+    def update(self, key, resource):
+        try:
+            done, message = get_rollout_status(resource)
+        except DMakeException as e:
+            self.fail("%s: %s" % (get_display_name(key, resource), e))
+            return
+        previous = self.rollouts.get(key)
+        self.rollouts[key] = [resource, done, message]
+        if previous is None or previous[1:] != [done, message]:
+            self.log("%s: %s" % (get_display_name(key, resource), message))
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+
+    def watcher(self, api, context, kind, label_selector, deadline):
+        """Thread: list, then watch the `kind` resources of one context and namespace, until the deadline."""
+        try:
+            resource_version = None
+            while True:
+                if resource_version is None:
+                    items, resource_version = api.list(kind, label_selector)
+                    with self.condition:
+                        for resource in items:
+                            resource['kind'] = kind
+                            self.update((context, api.namespace, kind, resource['metadata']['name']), resource)
+                        self.pending_lists.discard((context, api.namespace, kind))
+                        self.condition.notify_all()
+                remaining = deadline - self.clock()
+                if remaining <= 0 or self.is_finished():
+                    return
+                try:
+                    for event_type, resource in api.watch(kind, label_selector, resource_version, remaining):
+                        if event_type == 'ERROR':
+                            raise ResourceVersionExpired()
+                        resource_version = resource['metadata']['resourceVersion']
+                        key = (context, api.namespace, kind, resource['metadata']['name'])
+                        with self.condition:
+                            if event_type == 'DELETED':
+                                self.rollouts.pop(key, None)
+                            else:
+                                resource['kind'] = kind
+                                self.update(key, resource)
+                            self.condition.notify_all()
+                        if self.is_finished():
+                            return
+                except ResourceVersionExpired:
+                    resource_version = None
+        except Exception as e:
+            with self.condition:
+                self.fail("%s: failed watching %s resources: %s" % (context, kind, e))
+                self.condition.notify_all()
+
+    def is_finished(self):
+        return self.error is not None or (len(self.pending_lists) == 0 and all(done for _, done, _ in self.rollouts.values()))
+
+    def check_pods(self, apis):
+        """Fail on crash-looping pods of the pending rollouts."""
+        with self.condition:
+            pending = [(key, resource) for key, (resource, done, _) in self.rollouts.items() if not done]
+        for key, resource in pending:
+            api = apis[(key[0], key[1])]
+            try:
+                pods = api.list_pods(get_selector_string(resource))
+            except KubernetesApiError as e:
+                # transient: retried at the next check
+                self.log("%s: %s" % (get_display_name(key, resource), e))
+                return
+            error = get_crashed_pod_error(resource, pods)
+            if error is not None:
+                with self.condition:
+                    self.fail("%s: %s" % (get_display_name(key, resource), error))
+                    self.condition.notify_all()
+                return
+
+    def report(self):
+        pending = sorted((key, resource, message) for key, (resource, done, message) in self.rollouts.items() if not done)
+        self.log("Rollouts: %d of %d done" % (len(self.rollouts) - len(pending), len(self.rollouts)))
+        for key, resource, message in pending:
+            self.log("  - %s: %s" % (get_display_name(key, resource), message))
+
+    def run(self):
+        start = self.clock()
+        deadline = start + self.timeout
+        apis = {}
+        for (context, namespace), deploy_names in sorted(self.groups.items()):
+            api = self.api_factory(context, namespace)
+            apis[(context, api.namespace)] = api
+            label_selector = '%s in (%s)' % (SERVICE_LABEL, ','.join(sorted(set(deploy_names))))
+            for kind in ROLLOUT_KINDS:
+                self.pending_lists.add((context, api.namespace, kind))
+                thread = threading.Thread(target=self.watcher, args=(api, context, kind, label_selector, deadline))
+                thread.daemon = True
+                thread.start()
+
+        last_check = start
+        last_report = start
+        with self.condition:
+            while not self.is_finished():
+                now = self.clock()
+                if now >= deadline:
+                    self.report()
+                    raise DMakeException("Rollouts not finished after %d seconds" % (self.timeout))
+                if now - last_report >= self.report_interval:
+                    self.report()
+                    last_report = now
+                if now - last_check >= self.check_interval:
+                    self.condition.release()
+                    try:
+                        self.check_pods(apis)
+                    finally:
+                        self.condition.acquire()
+                    last_check = now
+                    continue
+                self.condition.wait(min(self.check_interval, max(0, deadline - now)))
+            if self.error is not None:
+                raise DMakeException(self.error)
+        self.log("Rollouts: %d done in %.1fs" % (len(self.rollouts), self.clock() - start))
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Wait for the rollouts of Kubernetes services deployed by dmake, all together.")
+    parser.add_argument('--timeout', type=float, default=1800, help="Overall deadline, in seconds")
+    parser.add_argument('--target', nargs=3, action='append', default=[], metavar=('CONTEXT', 'NAMESPACE', 'SERVICE'), help="Service to wait for: resources with its `%s` label. Empty NAMESPACE: the context default namespace" % (SERVICE_LABEL))
+    args = parser.parse_args(argv)
+
+    if os.getenv('DMAKE_K8S_DRY_RUN') == '1':
+        print("dry-run, exiting")
+        return 0
+    try:
+        RolloutMonitor(args.target, args.timeout).run()
+    except DMakeException as e:
+        print("[DMake] Rollout failed: %s" % (e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
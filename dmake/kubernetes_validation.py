@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+import dmake.common as common
+import dmake.kubernetes as k8s_utils
+from dmake.common import DMakeException
+from dmake.profiler import Profiler
+
+###############################################################################
+
+class KubernetesManifests(object):
+    """
+    Collect the rendered Kubernetes manifests of a plan: they are validated
+    together once the plan is generated, offline against the OpenAPI schema of
+    their target cluster (see `validate_manifests`).
+    """
+    # (deploy_name, template, rendered manifest path, kubectl context)
+    manifests = []
+
+    @staticmethod
+    def reset():
+        KubernetesManifests.manifests = []
+
+    @staticmethod
+    def register(deploy_name, template, manifest_path, context):
+        KubernetesManifests.manifests.append((deploy_name, template, manifest_path, context))
+
+    @staticmethod
+    def validate():
+        if len(KubernetesManifests.manifests) == 0:
+            return
+        common.logger.info("Validating %d Kubernetes manifests" % (len(KubernetesManifests.manifests)))
+        pool_size = int(os.getenv('DMAKE_K8S_VALIDATION_PARALLELISM', '8'))
+        validate_manifests(KubernetesManifests.manifests, common.kubernetes_live_dry_run, pool_size)
+
+###############################################################################
+
+class Schema(object):
+    """OpenAPI v2 definitions, indexed by (group, version, kind)."""
+    def __init__(self, schema_id, definitions, kinds=None):
+        self.id = schema_id
+        self.definitions = definitions
+        if kinds is None:
+            kinds = {}
+            for name, definition in definitions.items():
+                for gvk in definition.get('x-kubernetes-group-version-kind', []):
+                    kinds[(gvk['group'], gvk['version'], gvk['kind'])] = name
+        self.kinds = kinds
+
+    @staticmethod
+    def from_openapi(data):
+        schema_id = hashlib.sha256(data.encode('utf-8')).hexdigest()
+        return Schema(schema_id, json.loads(data)['definitions'])
+
+    def get_definition_name(self, api_version, kind):
+        group, _, version = api_version.rpartition('/')
+        return self.kinds.get((group, version, kind))
+
+
+CLIENT_PRIMITIVE_TYPES = {
+    'str': {'type': 'string'},
+    'int': {'type': 'integer'},
+    'float': {'type': 'number'},
+    'bool': {'type': 'boolean'},
+    'datetime': {'type': 'string'},
+    'date': {'type': 'string'},
+    'object': {},
+}
+
+CLIENT_MODEL_NAME_RE = re.compile(r'^([A-Z][a-z]+)?(V\d+(?:(?:alpha|beta)\d+)?)([A-Z]\w*)$')
+
+
+def get_client_type_schema(type_name):
+    """Return: the OpenAPI schema of a kubernetes python client `openapi_types` type."""
+    if type_name.startswith('list['):
+        return {'type': 'array', 'items': get_client_type_schema(type_name[len('list['):-1])}
+    if type_name.startswith('dict('):
+        return {'type': 'object', 'additionalProperties': get_client_type_schema(type_name[len('dict('):-1].split(', ', 1)[1])}
+    if type_name in CLIENT_PRIMITIVE_TYPES:
+        return CLIENT_PRIMITIVE_TYPES[type_name]
+    return {'$ref': '#/definitions/%s' % (type_name)}
+
+
+class ClientModelsSchema(Schema):
+    """Schema of the kubernetes python client models: resources groups are only known by the models names prefix."""
+    def get_definition_name(self, api_version, kind):
+        group, _, version = api_version.rpartition('/')
+        return self.kinds.get((group.split('.')[0], version, kind)) or self.kinds.get(('', version, kind))
+
+
+def is_client_field_required(model, attribute):
+    # the generated setters reject None for required fields
+    instance = model.__new__(model)
+    try:
+        getattr(model, attribute).fset(instance, None)
+    except ValueError:
+        return True
+    return False
+
+
+bundled_schema = None
+
+def get_bundled_schema():
+    """
+    Return: the Schema bundled with the kubernetes python client models, for
+    the Kubernetes version it targets: the fallback when the cluster schema is
+    not available. The resources groups are matched on the models names
+    prefix (e.g. `ExtensionsV1beta1Ingress`), or ignored (`V1Deployment`).
+    """
+    global bundled_schema
+    if bundled_schema is not None:
+        return bundled_schema
+    import kubernetes
+    import kubernetes.client.models as models
+
+    definitions = {}
+    kinds = {}
+    for name in dir(models):
+        model = getattr(models, name)
+        if not isinstance(model, type) or not hasattr(model, 'openapi_types'):
+            continue
+        definitions[name] = {
+            'type': 'object',
+            'properties': {model.attribute_map[attribute]: get_client_type_schema(type_name) for attribute, type_name in model.openapi_types.items()},
+            'required': [model.attribute_map[attribute] for attribute in model.openapi_types if is_client_field_required(model, attribute)],
+        }
+        match = CLIENT_MODEL_NAME_RE.match(name)
+        if match and 'kind' in model.openapi_types and 'api_version' in model.openapi_types:
+            group_prefix, version, kind = match.groups()
+            kinds[((group_prefix or '').lower(), version.lower(), kind)] = name
+    bundled_schema = ClientModelsSchema('kubernetes-client-%s' % (kubernetes.__version__), definitions, kinds)
+    return bundled_schema
+
+###############################################################################
+
+def get_cache_dir(*path):
+    return os.path.join(common.config_dir, 'kubernetes', *path)
+
+
+def fetch_openapi(context):
+    """Return: the OpenAPI v2 schema served by the `context` cluster, or None."""
+    command = ['kubectl', '--context=%s' % (context), 'get', '--raw', '/openapi/v2']
+    try:
+        with Profiler.subprocess(command):
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if process.returncode != 0:
+        return None
+    try:
+        json.loads(process.stdout)['definitions']
+    except (ValueError, KeyError, TypeError):
+        return None
+    return process.stdout
+
+
+def load_schema(context, now=None):
+    """
+    Return: the Schema to validate the manifests of `context` with, by order of preference:
+    - the OpenAPI v2 file DMAKE_K8S_OPENAPI_SCHEMA, to pin the target Kubernetes version;
+    - the schema of the cluster cached for less than DMAKE_K8S_OPENAPI_MAX_AGE seconds (default: 1 day);
+    - the schema fetched from the cluster, then cached;
+    - the stale cached schema;
+    - the schema bundled with the kubernetes python client.
+    """
+    schema_file = os.getenv('DMAKE_K8S_OPENAPI_SCHEMA')
+    if schema_file:
+        with open(schema_file, 'r') as f:
+            return Schema.from_openapi(f.read())
+
+    now = time.time() if now is None else now
+    max_age = int(os.getenv('DMAKE_K8S_OPENAPI_MAX_AGE', '86400'))
+    cache_file = get_cache_dir('openapi', '%s.json' % (common.sanitize_name_unique(context, 'docker')))
+    if os.path.isfile(cache_file) and now - os.path.getmtime(cache_file) < max_age:
+        with open(cache_file, 'r') as f:
+            return Schema.from_openapi(f.read())
+
+    data = fetch_openapi(context)
+    if data is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.rename(tmp_file, cache_file)
+        return Schema.from_openapi(data)
+
+    if os.path.isfile(cache_file):
+        common.logger.warning("Kubernetes context '%s' unreachable: validating with its stale cached schema" % (context))
+        with open(cache_file, 'r') as f:
+            return Schema.from_openapi(f.read())
+    common.logger.warning("Kubernetes context '%s' unreachable: validating with the schema bundled with the kubernetes python client" % (context))
+    return get_bundled_schema()
+
+###############################################################################
+
+def validate_value(schema, value, definition, path, errors):
+    if value is None:
+        return
+    while '$ref' in definition:
+        definition = schema.definitions.get(definition['$ref'].split('/')[-1], {})
+    value_type = definition.get('type')
+    if definition.get('format') == 'int-or-string':
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            errors.append("%s: expected integer or string" % (path))
+        return
+
+    if value_type == 'object' or 'properties' in definition:
+        if not isinstance(value, dict):
+            errors.append("%s: expected object" % (path))
+            return
+        properties = definition.get('properties')
+        for key in definition.get('required', []):
+            if value.get(key) is None:
+                errors.append("%s: missing required field '%s'" % (path, key))
+        for key, item in value.items():
+            if properties is not None and key in properties:
+                validate_value(schema, item, properties[key], '%s.%s' % (path, key), errors)
+            elif 'additionalProperties' in definition:
+                if isinstance(definition['additionalProperties'], dict):
+                    validate_value(schema, item, definition['additionalProperties'], '%s.%s' % (path, key), errors)
+            elif properties is not None:
+                errors.append("%s: unknown field '%s'" % (path, key))
+    elif value_type == 'array':
+        if not isinstance(value, list):
+            errors.append("%s: expected array" % (path))
+            return
+        for index, item in enumerate(value):
+            validate_value(schema, item, definition.get('items', {}), '%s[%d]' % (path, index), errors)
+    elif value_type == 'string':
+        # unquoted YAML dates and timestamps are strings for Kubernetes
+        if not isinstance(value, str) and type(value).__name__ not in ['date', 'datetime']:
+            errors.append("%s: expected string, got %s" % (path, type(value).__name__))
+    elif value_type == 'integer':
+        if isinstance(value, bool) or not isinstance(value, int):
+            errors.append("%s: expected integer, got %s" % (path, type(value).__name__))
+    elif value_type == 'number':
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            errors.append("%s: expected number, got %s" % (path, type(value).__name__))
+    elif value_type == 'boolean':
+        if not isinstance(value, bool):
+            errors.append("%s: expected boolean, got %s" % (path, type(value).__name__))
+
+
+def validate_resource(schema, resource):
+    """Return: the errors of the Kubernetes `resource`; custom resources are not validated."""
+    if not isinstance(resource, dict):
+        return ["expected a Kubernetes resource object"]
+    api_version = resource.get('apiVersion')
+    kind = resource.get('kind')
+    if not isinstance(api_version, str) or not isinstance(kind, str):
+        return ["missing 'apiVersion' or 'kind'"]
+    definition_name = schema.get_definition_name(api_version, kind)
+    if definition_name is None:
+        common.logger.debug("No schema for %s %s: not validated" % (api_version, kind))
+        return []
+    errors = []
+    name = resource.get('metadata', {}).get('name') if isinstance(resource.get('metadata'), dict) else None
+    validate_value(schema, resource, {'$ref': '#/definitions/%s' % (definition_name)}, '%s/%s' % (kind, name), errors)
+    return errors
+
+
+def validate_manifest_data(schema, data):
+    """Return: the errors of the resources of the multi-documents YAML `data`."""
+    try:
+        resources = common.yaml_ordered_load(data, all=True)
+    except DMakeException as e:
+        return ["invalid YAML: %s" % (e)]
+    errors = []
+    for resource in resources:
+        if resource is not None:
+            errors += validate_resource(schema, resource)
+    return errors
+
+
+def live_dry_run(context, manifest_path):
+    """Return: the error of the server side validation, or None."""
+    cmd = 'kubectl %s' % (' '.join(map(common.wrap_cmd, ['--context=%s' % context, 'apply', '--dry-run=true', '--validate=true', '--filename=%s' % manifest_path])))
+    try:
+        common.run_shell_command(cmd, raise_on_return_code=True)
+    except common.ShellError as e:
+        return str(e)
+    return None
+
+
+def get_validation_key(schema, data):
+    """
+    Return: the validation cache key of the manifest `data`: its content hash
+    without the annotations changing at each deployment (see
+    `k8s_utils.VOLATILE_ANNOTATIONS`), so it is stable across deployments.
+    """
+    try:
+        content_hash = k8s_utils.get_manifests_hash([data])
+    except DMakeException:
+        # invalid YAML: reported by the validation
+        content_hash = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    return hashlib.sha256(('%s\0%s' % (schema.id, content_hash)).encode('utf-8')).hexdigest()
+
+
+def validate_manifest(schema, manifest_path, context, live):
+    """
+    Return: the error message of the manifest file, or None. Valid manifests
+    are cached by content hash and schema.
+    """
+    with open(manifest_path, 'r') as f:
+        data = f.read()
+    cache_file = get_cache_dir('validated', get_validation_key(schema, data))
+    if not os.path.isfile(cache_file):
+        errors = validate_manifest_data(schema, data)
+        if errors:
+            return '\n'.join(errors)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        open(cache_file, 'w').close()
+    if live:
+        return live_dry_run(context, manifest_path)
+    return None
+
+
+def validate_manifests(manifests, live, pool_size):
+    """
+    Validate concurrently the rendered manifests [(deploy_name, template, manifest_path, context)],
+    with the live `kubectl apply --dry-run` too if `live`. Raise: all the errors at once.
+    """
+    contexts = sorted(set(context for _, _, _, context in manifests))
+    pool = ThreadPool(max(1, min(pool_size, len(manifests))))
+    try:
+        schemas = dict(zip(contexts, pool.map(load_schema, contexts)))
+        errors = pool.map(lambda manifest: validate_manifest(schemas[manifest[3]], manifest[2], manifest[3], live), manifests)
+    finally:
+        pool.close()
+    messages = ["%s: Invalid Kubernetes manifest file %s (rendered template: %s): %s" % (deploy_name, template, manifest_path, error)
+                for (deploy_name, template, manifest_path, _), error in zip(manifests, errors) if error is not None]
+    if messages:
+        raise DMakeException('\n'.join(messages))
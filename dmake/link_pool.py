@@ -0,0 +1,160 @@
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+
+import dmake.common as common
+
+###############################################################################
+
+def get_pool_file():
+    return os.path.join(os.getenv('DMAKE_CONFIG_DIR', os.path.expanduser('~/.dmake')), 'link_pool.json')
+
+
+def get_idle_ttl():
+    return int(os.getenv('DMAKE_LINK_POOL_IDLE_TTL', '7200'))
+
+
+def get_max_size():
+    return int(os.getenv('DMAKE_LINK_POOL_MAX_SIZE', '10'))
+
+
+@contextlib.contextmanager
+def locked_pool(pool_file=None):
+    """
+    Yield the pool state {container_id: entry}, saved on exit. The pool is
+    shared by all local dmake executions: it is locked meanwhile.
+    """
+    pool_file = pool_file or get_pool_file()
+    with open(pool_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(pool_file, 'r') as f:
+                    pool = json.load(f)
+            except (IOError, ValueError):
+                pool = {}
+            yield pool
+            with open(pool_file, 'w') as f:
+                json.dump(pool, f, indent=2, sort_keys=True)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def is_container_running(container_id):
+    try:
+        output = subprocess.check_output(['docker', 'inspect', '--format', '{{.State.Running}}', container_id], stderr=subprocess.DEVNULL, universal_newlines=True)
+    except subprocess.CalledProcessError:
+        return False
+    return output.strip() == 'true'
+
+
+def remove_container(container_id):
+    subprocess.call(['docker', 'rm', '-f', container_id], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def exec_in_container(container_id, command):
+    return subprocess.call(['docker', 'exec', container_id] + command) == 0
+
+
+def is_in_use(entry):
+    # the dmake execution using it may have been killed before releasing it
+    return entry['in_use_by'] is not None and os.path.isdir(entry['in_use_by'])
+
+###############################################################################
+
+def purge(pool, now, idle_ttl, max_size, purge_all=False):
+    """
+    Remove the dead containers, the ones idle for more than `idle_ttl`
+    seconds, then the least recently used idle ones above `max_size`.
+    With `purge_all`, remove all of them, even in use.
+    Return: the removed container IDs.
+    """
+    to_remove = []
+    for container_id, entry in pool.items():
+        if purge_all or not is_container_running(container_id):
+            to_remove.append(container_id)
+        elif not is_in_use(entry) and now - entry['last_used'] > idle_ttl:
+            to_remove.append(container_id)
+    idle = sorted([container_id for container_id, entry in pool.items() if container_id not in to_remove and not is_in_use(entry)],
+                  key=lambda container_id: pool[container_id]['last_used'])
+    excess = len(pool) - len(to_remove) - max_size
+    if excess > 0:
+        to_remove += idle[:excess]
+
+    for container_id in to_remove:
+        remove_container(container_id)
+        del pool[container_id]
+    return to_remove
+
+
+def acquire(pool, key, reset_command, tmp_dir, now):
+    """
+    Return: the ID of an idle running container matching `key`, now used by the
+    dmake execution of `tmp_dir`; None if there is none. The container is
+    reset with `reset_command` first: it is dropped if the reset fails.
+    """
+    for container_id, entry in sorted(pool.items(), key=lambda item: -item[1]['last_used']):
+        if entry['key'] != key or is_in_use(entry):
+            continue
+        if reset_command and not exec_in_container(container_id, reset_command):
+            common.logger.warning("Reset of pooled link %s failed: dropping it" % (container_id))
+            remove_container(container_id)
+            del pool[container_id]
+            continue
+        entry['in_use_by'] = tmp_dir
+        entry['last_used'] = now
+        return container_id
+    return None
+
+
+def add(pool, key, container_id, image_name, link_name, tmp_dir, now):
+    pool[container_id] = {'key': key, 'image': image_name, 'link_name': link_name, 'created': now, 'last_used': now, 'in_use_by': tmp_dir}
+
+
+def release(pool, tmp_dir, now):
+    """Put back in the pool the containers used by the dmake execution of `tmp_dir`."""
+    for entry in pool.values():
+        if entry['in_use_by'] == tmp_dir:
+            entry['in_use_by'] = None
+            entry['last_used'] = now
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Warm pool of reusable docker links containers, for local executions.")
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+    parser_acquire = subparsers.add_parser('acquire', help="Print the ID of a pooled container matching KEY, if any")
+    parser_acquire.add_argument('key')
+    parser_acquire.add_argument('reset_command', help="JSON list: command run in the container before reusing it")
+    parser_add = subparsers.add_parser('add', help="Add a new container to the pool")
+    parser_add.add_argument('key')
+    parser_add.add_argument('container_id')
+    parser_add.add_argument('image_name')
+    parser_add.add_argument('link_name')
+    subparsers.add_parser('release', help="Put back the containers used by the current dmake execution in the pool")
+    args = parser.parse_args(argv)
+
+    tmp_dir = os.environ['DMAKE_TMP_DIR']
+    now = time.time()
+    with locked_pool() as pool:
+        purge(pool, now, get_idle_ttl(), get_max_size())
+        if args.action == 'acquire':
+            container_id = acquire(pool, args.key, json.loads(args.reset_command), tmp_dir, now)
+            if container_id:
+                print(container_id)
+        elif args.action == 'add':
+            add(pool, args.key, args.container_id, args.image_name, args.link_name, tmp_dir, now)
+        elif args.action == 'release':
+            release(pool, tmp_dir, now)
+            purge(pool, now, get_idle_ttl(), get_max_size())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,245 @@
+# This module only depends on the standard library: it is also run alone in the
+# prober container (see `probe_from_container`).
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+PROBE_IMAGE = 'python:3-alpine'
+
+###############################################################################
+
+def parse_probe_ports(probe_ports):
+    """Parse `probe_ports` ('1234/tcp,5678-5680/udp') into [(port, proto)]."""
+    ports = []
+    for port_range in probe_ports.split(','):
+        port_range = port_range.strip()
+        if not port_range:
+            continue
+        port_range, _, proto = port_range.partition('/')
+        proto = proto or 'tcp'
+        if proto not in ['tcp', 'udp']:
+            raise ValueError("Unknown protocol: %s" % (proto))
+        first, _, last = port_range.partition('-')
+        for port in range(int(first), int(last or first) + 1):
+            ports.append((port, proto))
+    return ports
+
+
+def parse_target(target):
+    """Parse 'host:port/proto' into (host, port, proto)."""
+    host, _, port = target.rpartition(':')
+    (port, proto), = parse_probe_ports(port)
+    return host, port, proto
+
+
+def format_target(host, port, proto):
+    return '%s:%d/%s' % (host, port, proto)
+
+###############################################################################
+
+class _UDPProbeProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        # the error received back, None if the port answered
+        self.error = asyncio.get_event_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.error.done():
+            self.error.set_result(None)
+
+    def error_received(self, exc):
+        # ICMP port unreachable (connection refused), but also host or network unreachable: not ready
+        if not self.error.done():
+            self.error.set_result(exc)
+
+
+async def probe_tcp_once(host, port, timeout):
+    _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    writer.close()
+
+
+async def probe_udp_once(host, port, timeout):
+    """
+    UDP has no handshake: the port is considered ready when an empty datagram
+    does not trigger an ICMP error (e.g. port unreachable, reported as
+    connection refused on the connected socket) within `timeout`.
+    """
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_datagram_endpoint(_UDPProbeProtocol, remote_addr=(host, port))
+    try:
+        transport.sendto(b'')
+        try:
+            error = await asyncio.wait_for(asyncio.shield(protocol.error), timeout)
+        except asyncio.TimeoutError:
+            error = None
+        if error is not None:
+            raise OSError("%s:%d/udp: %s" % (host, port, error))
+    finally:
+        transport.close()
+
+
+async def wait_for_port(host, port, proto, deadline, initial_delay=0.05, max_delay=2., connect_timeout=1.):
+    """
+    Try to reach host:port/proto until `deadline` (time.monotonic()), with
+    exponential backoff and full jitter between attempts.
+    Return: whether the port is ready.
+    """
+    probe_once = probe_tcp_once if proto == 'tcp' else probe_udp_once
+    delay = initial_delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        try:
+            await probe_once(host, port, min(connect_timeout, remaining))
+            return True
+        except (OSError, asyncio.TimeoutError):
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(random.uniform(0, delay), remaining))
+        delay = min(delay * 2, max_delay)
+
+
+async def wait_for_targets_async(targets, timeout, **kwargs):
+    deadline = time.monotonic() + timeout
+    ready = await asyncio.gather(*[wait_for_port(host, port, proto, deadline, **kwargs) for host, port, proto in targets])
+    return [target for target, is_ready in zip(targets, ready) if not is_ready]
+
+
+def wait_for_targets(targets, timeout, **kwargs):
+    """
+    Wait concurrently for all `targets` [(host, port, proto)] with a single
+    overall `timeout` (seconds).
+    Return: the list of targets not ready before the deadline.
+    """
+    if len(targets) == 0:
+        return []
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(wait_for_targets_async(targets, timeout, **kwargs))
+    finally:
+        loop.close()
+
+###############################################################################
+
+def docker_inspect(container_ids):
+    output = subprocess.check_output(['docker', 'inspect'] + container_ids, universal_newlines=True)
+    return json.loads(output)
+
+
+def get_link_ports(container, probe_ports):
+    if probe_ports == 'auto':
+        exposed_ports = container['Config'].get('ExposedPorts') or {}
+        return parse_probe_ports(','.join(sorted(exposed_ports.keys())))
+    return parse_probe_ports(probe_ports)
+
+
+def get_container_ip(container):
+    for network in (container['NetworkSettings'].get('Networks') or {}).values():
+        if network.get('IPAddress'):
+            return network['IPAddress']
+    return container['NetworkSettings'].get('IPAddress')
+
+
+def read_links(cache_dir, link_names):
+    """
+    Return: [(link_name, container_id, probe_ports)] of links started by
+    `dmake_run_docker_link` and not already probed.
+    """
+    links = []
+    for link_name in link_names:
+        base = os.path.join(cache_dir, link_name)
+        if os.path.isfile(base + '.ready') or not os.path.isfile(base + '.probe'):
+            continue
+        with open(base + '.id') as f:
+            container_id = f.read().strip()
+        with open(base + '.probe') as f:
+            probe_ports = f.read().strip()
+        if probe_ports != 'none':
+            links.append((link_name, container_id, probe_ports))
+    return links
+
+
+def get_probe_mode():
+    mode = os.getenv('DMAKE_LINK_PROBE_MODE')
+    if mode:
+        return mode
+    # containers IPs are only reachable from the host on Linux
+    return 'host' if platform.system() == 'Linux' else 'container'
+
+
+def probe_from_container(links, targets, timeout):
+    """Probe all `targets` (link names as hosts) from a single prober container linked to all `links`."""
+    cmd = ['docker', 'run', '--rm']
+    for link_name, container_id, _ in links:
+        cmd += ['--link', '%s:%s' % (container_id, link_name)]
+    cmd += ['-v', '%s:/dmake_link_probe.py:ro' % (os.path.abspath(__file__)), PROBE_IMAGE,
+            'python3', '/dmake_link_probe.py', '--timeout', str(timeout)]
+    cmd += [format_target(*target) for target in targets]
+    return subprocess.call(cmd) == 0
+
+
+def wait_for_links(cache_dir, link_names, timeout, mode):
+    """
+    Wait concurrently for the probe ports of all `link_names`.
+    Return: the error message, None on success.
+    """
+    missing = [link_name for link_name in link_names if not os.path.isfile(os.path.join(cache_dir, link_name + '.id'))]
+    if missing:
+        return "Unexpected error: missing links: %s" % (', '.join(missing))
+    links = read_links(cache_dir, link_names)
+    if len(links) == 0:
+        return None
+    containers = docker_inspect([container_id for _, container_id, _ in links])
+    host_targets = []
+    link_targets = []
+    for (link_name, _, probe_ports), container in zip(links, containers):
+        ip = get_container_ip(container)
+        for port, proto in get_link_ports(container, probe_ports):
+            host_targets.append((ip, port, proto))
+            link_targets.append((link_name, port, proto))
+
+    sys.stderr.write("Waiting for links: %s\n" % (', '.join(format_target(*target) for target in link_targets)))
+    start = time.monotonic()
+    if mode == 'container':
+        if not probe_from_container(links, link_targets, timeout):
+            return "Links not ready after %g seconds" % (timeout)
+    else:
+        not_ready = set(wait_for_targets(host_targets, timeout))
+        if not_ready:
+            return "Links not ready after %g seconds: %s" % (timeout, ', '.join(format_target(*link_target) for link_target, host_target in zip(link_targets, host_targets) if host_target in not_ready))
+    sys.stderr.write("Links ready after %.1f seconds\n" % (time.monotonic() - start))
+
+    for link_name, _, _ in links:
+        open(os.path.join(cache_dir, link_name + '.ready'), 'w').close()
+    return None
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Wait for docker links (or host:port/proto targets) to accept connections.")
+    parser.add_argument("--timeout", type=float, default=float(os.getenv('DMAKE_LINK_PROBE_TIMEOUT', '60')), help="Overall deadline, in seconds")
+    parser.add_argument("--links-dir", help="Links cache directory: wait for the LINK_NAMES started by dmake_run_docker_link")
+    parser.add_argument("targets", nargs='*', help="host:port/proto targets, or link names with --links-dir")
+    args = parser.parse_args(argv)
+
+    if args.links_dir:
+        error = wait_for_links(args.links_dir, args.targets, args.timeout, get_probe_mode())
+    else:
+        not_ready = wait_for_targets([parse_target(target) for target in args.targets], args.timeout)
+        error = "Not ready after %g seconds: %s" % (args.timeout, ', '.join(format_target(*target) for target in not_ready)) if not_ready else None
+    if error:
+        sys.stderr.write(error + '\n')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""
+Plan generation profiler (`dmake --profile`): wall time per phase, and the
+subprocesses run meanwhile, grouped by command prefix.
+"""
+import contextlib
+import logging
+import os
+import shlex
+import threading
+import time
+
+logger = logging.getLogger("dmake")
+
+# commands grouped with their sub-command, e.g. `git rev-parse`
+SUB_COMMANDS_TOOLS = ['git', 'kubectl', 'docker', 'aws', 'helm']
+# their options taking a separate value, e.g. `git -C <dir>`
+OPTIONS_WITH_VALUE = ['-C', '-c', '-n', '--context', '--namespace', '--profile', '--region']
+# the shell commands preparing the environment of the next one
+SKIPPED_COMMANDS = ['set', 'source', '.', 'export']
+SEPARATORS = [';', '&&', '||', '|']
+
+
+def get_command_prefix(command):
+    """
+    Return: the prefix a command (shell command or argv) is grouped by: its
+    program, and its sub-command for `SUB_COMMANDS_TOOLS`; the leading
+    environment preparation (variables, `set`, `source`, `export`) is skipped.
+    """
+    if isinstance(command, str):
+        lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        try:
+            words = list(lexer)
+        except ValueError:
+            words = command.split()
+    else:
+        words = list(command)
+    while words:
+        word = words.pop(0)
+        if word in SEPARATORS or ('=' in word and not word.startswith('-')):
+            continue
+        if word in SKIPPED_COMMANDS:
+            while words and words[0] not in SEPARATORS:
+                words.pop(0)
+            continue
+        prefix = os.path.basename(word)
+        if prefix in SUB_COMMANDS_TOOLS:
+            while words and words[0].startswith('-'):
+                if words.pop(0) in OPTIONS_WITH_VALUE and words:
+                    words.pop(0)
+            if words and words[0] not in SEPARATORS:
+                prefix += ' ' + words[0]
+        return prefix
+    return command if isinstance(command, str) else ' '.join(command)
+
+
+class Profiler(object):
+    """
+    Collect the plan generation profile: the phases are switched with
+    `set_phase()`, or nested with `phase()` (e.g. the env evaluations during
+    the commands generation); each phase only counts its own time, without
+    its nested phases.
+    """
+    enabled = False
+    # phase -> [count, seconds]
+    phases = {}
+    # command prefix -> [count, seconds]
+    subprocesses = {}
+    phases_stack = []
+    last_switch = None
+    start_time = None
+    pstats_file = None
+    cprofile = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def reset():
+        Profiler.enabled = False
+        Profiler.phases = {}
+        Profiler.subprocesses = {}
+        Profiler.phases_stack = []
+        Profiler.last_switch = None
+        Profiler.start_time = None
+        Profiler.pstats_file = None
+        Profiler.cprofile = None
+
+    @staticmethod
+    def start(pstats_file=None):
+        Profiler.reset()
+        Profiler.enabled = True
+        Profiler.start_time = Profiler.last_switch = time.time()
+        Profiler.phases_stack = ['init']
+        Profiler.phases['init'] = [1, 0.]
+        if pstats_file:
+            import cProfile
+            Profiler.pstats_file = pstats_file
+            Profiler.cprofile = cProfile.Profile()
+            Profiler.cprofile.enable()
+
+    @staticmethod
+    def _switch():
+        """Account the time since the last switch to the current phase."""
+        now = time.time()
+        Profiler.phases[Profiler.phases_stack[-1]][1] += now - Profiler.last_switch
+        Profiler.last_switch = now
+
+    @staticmethod
+    def _enter(name):
+        Profiler.phases_stack.append(name)
+        Profiler.phases.setdefault(name, [0, 0.])[0] += 1
+
+    @staticmethod
+    def set_phase(name):
+        """Switch the top level phase."""
+        if not Profiler.enabled:
+            return
+        Profiler._switch()
+        Profiler.phases_stack.pop(0)
+        Profiler.phases_stack.insert(0, name)
+        Profiler.phases.setdefault(name, [0, 0.])[0] += 1
+
+    @staticmethod
+    @contextlib.contextmanager
+    def phase(name):
+        """Nested phase: only accounted in the main thread."""
+        if not Profiler.enabled or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        Profiler._switch()
+        Profiler._enter(name)
+        try:
+            yield
+        finally:
+            Profiler._switch()
+            Profiler.phases_stack.pop()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def subprocess(command):
+        """Account a subprocess run, from any thread."""
+        if not Profiler.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with Profiler.lock:
+                entry = Profiler.subprocesses.setdefault(get_command_prefix(command), [0, 0.])
+                entry[0] += 1
+                entry[1] += duration
+
+    @staticmethod
+    def stop():
+        """Stop profiling, and report: nothing when not started or already stopped."""
+        if not Profiler.enabled:
+            return
+        Profiler._switch()
+        Profiler.enabled = False
+        total = time.time() - Profiler.start_time
+        for line in Profiler.get_report(total):
+            logger.info(line)
+        if Profiler.cprofile is not None:
+            Profiler.cprofile.disable()
+            Profiler.cprofile.dump_stats(Profiler.pstats_file)
+            logger.info("cProfile statistics written to %s: read them with `python -m pstats %s`" % (Profiler.pstats_file, Profiler.pstats_file))
+
+    @staticmethod
+    def get_report(total):
+        """Return: the report lines: the phases in order, then the subprocesses, slowest first."""
+        lines = ["Plan generation profile: %.3fs" % (total),
+                 "  %-24s %6s %10s %7s" % ('phase', 'count', 'time', '%')]
+        for name, (count, seconds) in Profiler.phases.items():
+            lines.append("  %-24s %6d %9.3fs %6.1f%%" % (name, count, seconds, 100 * seconds / total if total else 0))
+        count = sum(entry[0] for entry in Profiler.subprocesses.values())
+        seconds = sum(entry[1] for entry in Profiler.subprocesses.values())
+        lines += ["Subprocesses: %d, %.3fs" % (count, seconds),
+                  "  %-24s %6s %10s" % ('command', 'count', 'time')]
+        for prefix, (count, seconds) in sorted(Profiler.subprocesses.items(), key=lambda item: (-item[1][1], item[0])):
+            lines.append("  %-24s %6d %9.3fs" % (prefix, count, seconds))
+        return lines
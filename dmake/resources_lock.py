@@ -0,0 +1,124 @@
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import sys
+import time
+
+import dmake.common as common
+
+###############################################################################
+
+def get_state_file():
+    return os.path.join(os.getenv('DMAKE_CONFIG_DIR', os.path.expanduser('~/.dmake')), 'resources_lock.json')
+
+
+def get_poll_interval():
+    return float(os.getenv('DMAKE_RESOURCES_LOCK_POLL_INTERVAL', '1'))
+
+
+def get_capacity(label):
+    """Return: the `label` units available on this machine: CPUs, or memory GB; overridden by DMAKE_PARALLEL_BUILDERS[_MEMORY]_CAPACITY."""
+    variable = common.PARALLEL_BUILDERS_CAPACITY_VARIABLES[label]
+    if os.getenv(variable):
+        return int(os.getenv(variable))
+    if label == 'PARALLEL_BUILDERS':
+        return os.cpu_count() or 1
+    return max(1, os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**30)
+
+
+@contextlib.contextmanager
+def locked_state(state_file=None):
+    """
+    Yield the list of held locks [{label, quantity, pid}], saved on exit. The
+    state is shared by all local dmake executions: it is locked meanwhile.
+    """
+    state_file = state_file or get_state_file()
+    with open(state_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(state_file, 'r') as f:
+                    state = json.load(f)
+            except (IOError, ValueError):
+                state = []
+            yield state
+            with open(state_file, 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+###############################################################################
+
+def try_acquire(state, label, quantity, pid, capacity):
+    """
+    Take `quantity` units of `label` for the dmake execution `pid` if they are
+    available; the locks of dead executions are dropped first. A quantity above
+    `capacity` is capped: it then waits for all the others to be released.
+    Return: True if acquired.
+    """
+    state[:] = [entry for entry in state if is_alive(entry['pid'])]
+    quantity = min(quantity, capacity)
+    used = sum(entry['quantity'] for entry in state if entry['label'] == label)
+    if used + quantity > capacity:
+        return False
+    state.append({'label': label, 'quantity': quantity, 'pid': pid})
+    return True
+
+
+def release(state, label, pid):
+    """Release the last lock of `label` taken by the dmake execution `pid`."""
+    for index in reversed(range(len(state))):
+        if state[index]['label'] == label and state[index]['pid'] == pid:
+            del state[index]
+            return
+
+
+def acquire(label, quantity, pid, state_file=None, poll_interval=1):
+    capacity = get_capacity(label)
+    waiting = False
+    while True:
+        with locked_state(state_file) as state:
+            if try_acquire(state, label, quantity, pid, capacity):
+                return
+        if not waiting:
+            common.logger.info("Waiting for %d %s units (capacity: %d)" % (quantity, label, capacity))
+            waiting = True
+        time.sleep(poll_interval)
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Weighted lock of the parallel builders resources, shared by the local dmake executions.")
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+    parser_acquire = subparsers.add_parser('acquire', help="Wait for QUANTITY units of LABEL, then take them")
+    parser_acquire.add_argument('label', choices=sorted(common.PARALLEL_BUILDERS_CAPACITY_VARIABLES))
+    parser_acquire.add_argument('quantity', type=int)
+    parser_acquire.add_argument('pid', type=int, help="PID of the dmake execution holding the lock: released when it dies")
+    parser_release = subparsers.add_parser('release', help="Release the last units of LABEL taken by PID")
+    parser_release.add_argument('label', choices=sorted(common.PARALLEL_BUILDERS_CAPACITY_VARIABLES))
+    parser_release.add_argument('pid', type=int)
+    args = parser.parse_args(argv)
+
+    if args.action == 'acquire':
+        acquire(args.label, args.quantity, args.pid, poll_interval=get_poll_interval())
+    elif args.action == 'release':
+        with locked_state() as state:
+            release(state, args.label, args.pid)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
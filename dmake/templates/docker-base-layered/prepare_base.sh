@@ -0,0 +1,31 @@
+#!/bin/bash
+# Please do not edit this file but rather use:
+# - requirements.txt: for any pip related install
+# - dependencies.sh: for other libraries
+#
+# Layered base image build: first layer, prepares the root image before the
+# install scripts layers. Cleaning is done by `clean_base.sh` in the last layer.
+
+set -e
+
+cd /base
+
+# Setup packet manager
+dpkg --configure -a
+apt-get update || apt-get update --fix-missing
+
+# Make sure SSH Agent socket is here if needed
+if [ ! -z "$SSH_AUTH_SOCK" ]; then
+    # Disable SSH strict checking
+    apt-get -y install openssh-client
+    mkdir -p /etc/ssh
+    echo -e "\nHost *\n    ForwardAgent yes\n    StrictHostKeyChecking no\n" >> /etc/ssh/ssh_config
+fi
+
+# Setup logrotate
+apt-get --no-install-recommends -y install logrotate
+cp config.logrotate /etc/logrotate.d/deepomatic
+
+# Configure SSL on the system
+# This step is needed to install Pip
+apt-get -y install apt-transport-https ca-certificates
@@ -0,0 +1,204 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import dmake.common as common
+from dmake.data_volumes import read_manifest
+
+OUTCOME_FILE_NAME = 'outcome.json'
+ARTIFACTS_DIR_NAME = 'artifacts'
+
+###############################################################################
+
+def get_store_dir():
+    """The content-addressed store: local by default, may be on a shared filesystem."""
+    default = os.path.join(os.getenv('DMAKE_CONFIG_DIR', os.path.expanduser('~/.dmake')), 'test_cache')
+    return os.getenv('DMAKE_TEST_CACHE_DIR', default)
+
+
+def write_inputs(tmp_dir, inputs):
+    """Write the plan-time fingerprint inputs of a test run. Return: the file path."""
+    content = json.dumps(inputs, indent=2, sort_keys=True)
+    inputs_file = os.path.join(tmp_dir, 'test_cache_inputs_%s.json' % (hashlib.md5(content.encode('utf-8')).hexdigest()))
+    with open(inputs_file, 'w') as f:
+        f.write(content)
+    return inputs_file
+
+
+def read_inputs(inputs_file):
+    with open(inputs_file, 'r') as f:
+        return json.load(f)
+
+
+def docker_inspect(format, name):
+    try:
+        output = subprocess.check_output(['docker', 'inspect', '--format', format, name], stderr=subprocess.DEVNULL, universal_newlines=True)
+    except subprocess.CalledProcessError:
+        return None
+    return output.strip() or None
+
+
+def get_image_id(image_name):
+    return docker_inspect('{{.Id}}', image_name)
+
+
+def get_container_image_id(container):
+    return docker_inspect('{{.Image}}', container)
+
+
+def docker_cp(container_id, src_path, dest_path):
+    return subprocess.call(['docker', 'cp', '%s:%s' % (container_id, src_path), dest_path], stderr=subprocess.DEVNULL) == 0
+
+
+def parse_links(docker_args):
+    """Return: [(container, alias)] of the `--link` options of a docker run command line."""
+    links = []
+    args = iter(docker_args)
+    for arg in args:
+        if arg == '--link':
+            value = next(args, '')
+        elif arg.startswith('--link='):
+            value = arg[len('--link='):]
+        else:
+            continue
+        container, _, alias = value.partition(':')
+        links.append((container, alias or container))
+    return links
+
+
+def get_path_state(path):
+    """
+    Return: the state of the host path `path`: its files (relative path, size
+    and modification time), None if it does not exist.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [['', stat.st_size, stat.st_mtime_ns]]
+    if not os.path.isdir(path):
+        return None
+    files = []
+    for root, dirs, file_names in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                # broken symlink
+                continue
+            files.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+    return files
+
+###############################################################################
+
+def compute_fingerprint(inputs, docker_args):
+    """
+    Return: the fingerprint of a test run, from its plan-time `inputs` and the
+    images actually used at runtime (service image, linked links and services),
+    or None if they cannot be resolved.
+    """
+    image_id = get_image_id(inputs['image_name'])
+    if image_id is None:
+        return None
+    links = []
+    for container, alias in sorted(parse_links(docker_args), key=lambda link: link[1]):
+        link_image_id = get_container_image_id(container)
+        if link_image_id is None:
+            return None
+        links.append([alias, link_image_id])
+    data_volumes = []
+    for source, path in inputs['data_volumes']:
+        # synced data volumes are identified by their objects ETags, host paths by their files
+        manifest = read_manifest(path)
+        data_volumes.append([source, path, manifest['objects'] if manifest is not None else get_path_state(path)])
+
+    fingerprint_inputs = dict(inputs, image_id=image_id, links=links, data_volumes=data_volumes)
+    return hashlib.sha256(json.dumps(fingerprint_inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_entry_dir(store_dir, fingerprint):
+    return os.path.join(store_dir, fingerprint[:2], fingerprint)
+
+
+def lookup(store_dir, fingerprint):
+    """Return: the cached artifacts directory of a passing run with this `fingerprint`, or None."""
+    entry_dir = get_entry_dir(store_dir, fingerprint)
+    try:
+        with open(os.path.join(entry_dir, OUTCOME_FILE_NAME), 'r') as f:
+            outcome = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if outcome.get('outcome') != 'passed':
+        return None
+    return os.path.join(entry_dir, ARTIFACTS_DIR_NAME)
+
+
+def store(store_dir, fingerprint, inputs, container_id, now):
+    """
+    Store the reports of the passing test run of `container_id` under `fingerprint`.
+    The entry is written aside then renamed, so concurrent lookups never see it partially.
+    Return: the reports not found in the container.
+    """
+    entry_dir = get_entry_dir(store_dir, fingerprint)
+    if os.path.isdir(entry_dir):
+        return []
+    tmp_entry_dir = '%s.tmp.%d' % (entry_dir, os.getpid())
+    missing = []
+    try:
+        for report in inputs['reports']:
+            dest_path = os.path.join(tmp_entry_dir, ARTIFACTS_DIR_NAME, report.lstrip('/'))
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            if not docker_cp(container_id, report, os.path.dirname(dest_path)):
+                missing.append(report)
+        with open(os.path.join(tmp_entry_dir, OUTCOME_FILE_NAME), 'w') as f:
+            json.dump({'outcome': 'passed', 'service_name': inputs['service_name'], 'stored_at': now}, f, indent=2, sort_keys=True)
+        try:
+            os.rename(tmp_entry_dir, entry_dir)
+        except OSError:
+            # stored concurrently by another execution
+            pass
+    finally:
+        shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+    return missing
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Cache of passing test runs results, keyed by the fingerprint of their inputs.")
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+    parser_fingerprint = subparsers.add_parser('fingerprint', help="Print the fingerprint of a test run, nothing if it cannot be computed")
+    parser_fingerprint.add_argument('inputs_file')
+    parser_fingerprint.add_argument('docker_args', nargs=argparse.REMAINDER)
+    parser_lookup = subparsers.add_parser('lookup', help="Print the cached artifacts directory of FINGERPRINT; fail on cache miss")
+    parser_lookup.add_argument('fingerprint')
+    parser_store = subparsers.add_parser('store', help="Store the reports of the passing test run of CONTAINER_ID")
+    parser_store.add_argument('fingerprint')
+    parser_store.add_argument('inputs_file')
+    parser_store.add_argument('container_id')
+    args = parser.parse_args(argv)
+
+    store_dir = get_store_dir()
+    if args.action == 'fingerprint':
+        fingerprint = compute_fingerprint(read_inputs(args.inputs_file), args.docker_args)
+        if fingerprint:
+            print(fingerprint)
+    elif args.action == 'lookup':
+        artifacts_dir = lookup(store_dir, args.fingerprint)
+        if artifacts_dir is None:
+            return 1
+        print(artifacts_dir)
+    elif args.action == 'store':
+        missing = store(store_dir, args.fingerprint, read_inputs(args.inputs_file), args.container_id, time.time())
+        for report in missing:
+            common.logger.warning("Test report not found, not cached: %s" % (report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
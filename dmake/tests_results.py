@@ -0,0 +1,121 @@
+import argparse
+import http.client
+import os
+import shutil
+import sys
+import tarfile
+
+import dmake.common as common
+from dmake.common import DMakeException
+from dmake.docker_engine import get_engine
+
+CACHED_PREFIX = 'cache:'
+
+###############################################################################
+
+def read_test_ids(dmake_tmp_dir):
+    """Return: {test run name: container ID, or `cache:<artifacts dir>` for cached results (see `dmake_test_cache`)}."""
+    test_ids = {}
+    try:
+        with open(os.path.join(dmake_tmp_dir, 'test_ids.txt'), 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    container_id, name = line.split(' ', 1)
+                    test_ids[name] = container_id
+    except IOError:
+        pass
+    return test_ids
+
+
+def get_destination(src_path, dest_path, member_name):
+    """Return: where to extract the archive member `member_name`, rooted at the basename of `src_path`, or None if it is outside."""
+    root = os.path.basename(src_path.rstrip('/'))
+    parts = [part for part in member_name.split('/') if part not in ['', '.']]
+    if not parts or parts[0] != root or '..' in parts:
+        return None
+    return os.path.join(dest_path, *parts[1:])
+
+
+def extract_archive(stream, src_path, dest_path):
+    """Extract the tar `stream` of `src_path` to `dest_path`, in one pass. Return: the number of extracted files."""
+    extracted = 0
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            destination = get_destination(src_path, dest_path, member.name)
+            if destination is None:
+                continue
+            if member.isdir():
+                os.makedirs(destination, exist_ok=True)
+            elif member.isfile():
+                os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+                with open(destination, 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(member), f)
+                extracted += 1
+    return extracted
+
+
+def copy_cached(artifacts_dir, src_path, dest_path):
+    """Return: False if `src_path` is not in the cached artifacts."""
+    cached_path = os.path.join(artifacts_dir, src_path.lstrip('/'))
+    if os.path.isdir(cached_path):
+        shutil.rmtree(dest_path, ignore_errors=True)
+        shutil.copytree(cached_path, dest_path)
+    elif os.path.isfile(cached_path):
+        os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+        shutil.copyfile(cached_path, dest_path)
+    else:
+        return False
+    return True
+
+
+def collect(engine, test_ids, entries):
+    """
+    Copy the tests results `entries` [(test run name, container path, host path)]
+    out of the tests containers, streamed through the Engine API archives.
+    Return: the missing entries.
+    """
+    missing = []
+    for name, src_path, dest_path in entries:
+        container_id = test_ids.get(name)
+        if container_id is None:
+            raise DMakeException("Unexpected error: unknown test run %s" % (name))
+        common.logger.info("Tests results for '%s': '%s'" % (name, dest_path))
+        if container_id.startswith(CACHED_PREFIX):
+            found = copy_cached(container_id[len(CACHED_PREFIX):], src_path, dest_path)
+        else:
+            with engine.archive(container_id, src_path) as stream:
+                found = stream is not None
+                if found:
+                    extract_archive(stream, src_path, dest_path)
+        if not found:
+            missing.append((name, src_path, dest_path))
+    return missing
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Collect the tests results of test containers.")
+    parser.add_argument("--allow-missing", action='store_true', help="Don't fail on missing results (e.g. after tests failure)")
+    parser.add_argument("entries", nargs='+', help="NAME SRC_PATH DEST_PATH triples: copy SRC_PATH of the test run NAME container to DEST_PATH")
+    args = parser.parse_args(argv)
+    if len(args.entries) % 3 != 0:
+        parser.error("entries must be NAME SRC_PATH DEST_PATH triples")
+    entries = [tuple(args.entries[i:i + 3]) for i in range(0, len(args.entries), 3)]
+
+    try:
+        missing = collect(get_engine(), read_test_ids(os.environ['DMAKE_TMP_DIR']), entries)
+    except (DMakeException, OSError, http.client.HTTPException, tarfile.TarError) as e:
+        common.logger.error(str(e))
+        return 1
+    for name, src_path, _ in missing:
+        message = "Missing tests results for '%s': '%s'" % (name, src_path)
+        if args.allow_missing:
+            common.logger.warning(message)
+        else:
+            common.logger.error(message)
+    return 0 if args.allow_missing or not missing else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
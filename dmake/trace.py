@@ -0,0 +1,120 @@
+"""
+Execution trace of the generated plans: both runtimes (bash and Jenkins) record
+one JSON event per line when the plan nodes, their commands and their lock
+waits begin and end, on one track per parallel branch. `dmake_trace_export`
+then converts them to the Chrome trace-event format, for chrome://tracing or
+https://ui.perfetto.dev.
+"""
+import argparse
+import json
+import sys
+
+###############################################################################
+
+MAIN_TRACK = 'main'
+# relative to the cache dir
+EVENTS_DIR = 'trace'
+TRACE_FILE = 'trace.json'
+COMMAND_NAME_MAX_LENGTH = 100
+
+
+def get_track(branches):
+    """Return: the track of the events emitted in the `branches` stack of nested parallel branches."""
+    return ' / '.join(branches) if branches else MAIN_TRACK
+
+
+def get_command_name(command):
+    """Return: the slice name of a shell command: its first line, shortened."""
+    lines = command.strip().splitlines()
+    name = lines[0] if lines else ''
+    if len(lines) > 1 or len(name) > COMMAND_NAME_MAX_LENGTH:
+        name = name[:COMMAND_NAME_MAX_LENGTH - 3] + '...'
+    return name
+
+
+def get_event_fields(phase, category, track, name):
+    """
+    Return: the JSON fields of an event, without braces: the runtimes prepend
+    its timestamp (microseconds), e.g. `{"ts": 1577836800000000, <fields>}`.
+    """
+    return json.dumps({'ph': phase, 'cat': category, 'tid': track, 'name': name})[1:-1]
+
+###############################################################################
+
+def load_events(lines):
+    """Return: the recorded events; the lines truncated by a killed runtime are ignored."""
+    events = []
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(event, dict) and event.get('ph') in ['B', 'E'] and isinstance(event.get('ts'), (int, float)):
+            events.append(event)
+    return events
+
+
+def get_trace(events):
+    """
+    Return: the Chrome trace of the recorded events, with one thread per track.
+    A slice ends with the next end event of the same name on its track: the
+    slices it still contains (e.g. a failed command caught by its node) end
+    with it; the slices still open at the end of the trace (failed execution)
+    end with the last event, marked `unfinished`.
+    """
+    events = sorted(events, key=lambda event: event['ts'])
+    tids = {}
+    open_slices = {}
+    trace_events = [{'ph': 'M', 'pid': 1, 'name': 'process_name', 'args': {'name': 'dmake'}}]
+    for event in events:
+        track = event.get('tid', MAIN_TRACK)
+        if track not in tids:
+            tids[track] = len(tids)
+            trace_events.append({'ph': 'M', 'pid': 1, 'tid': tids[track], 'name': 'thread_name', 'args': {'name': track}})
+            trace_events.append({'ph': 'M', 'pid': 1, 'tid': tids[track], 'name': 'thread_sort_index', 'args': {'sort_index': tids[track]}})
+            open_slices[track] = []
+        slice_event = {'ph': event['ph'], 'pid': 1, 'tid': tids[track], 'ts': event['ts'], 'cat': event.get('cat', ''), 'name': event.get('name', '')}
+        stack = open_slices[track]
+        if event['ph'] == 'B':
+            stack.append(slice_event['name'])
+            trace_events.append(slice_event)
+            continue
+        if slice_event['name'] not in stack:
+            # its begin event was not recorded
+            continue
+        while stack[-1] != slice_event['name']:
+            trace_events.append(dict(slice_event, name=stack.pop(), args={'unfinished': True}))
+        stack.pop()
+        trace_events.append(slice_event)
+    end = events[-1]['ts'] if events else 0
+    for track, stack in open_slices.items():
+        while stack:
+            trace_events.append({'ph': 'E', 'pid': 1, 'tid': tids[track], 'ts': end, 'name': stack.pop(), 'args': {'unfinished': True}})
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def export(events_file, trace_file):
+    """Return: False if no event could be loaded, in which case no trace is written."""
+    with open(events_file) as f:
+        events = load_events(f)
+    if not events:
+        return False
+    with open(trace_file, 'w') as f:
+        json.dump(get_trace(events), f)
+    return True
+
+###############################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Convert the recorded events of a plan execution to a Chrome trace-event file.")
+    parser.add_argument('events_file')
+    parser.add_argument('trace_file')
+    args = parser.parse_args(argv)
+    if not export(args.events_file, args.trace_file):
+        print("No execution trace event recorded in %s" % (args.events_file), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
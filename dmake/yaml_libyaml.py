@@ -0,0 +1,74 @@
+"""
+libyaml (C) backend of `common.yaml_ordered_load` and `common.yaml_ordered_dump`
+(DMAKE_YAML_BACKEND=libyaml), through PyYAML: it loads the same YAML 1.1 data,
+and dumps the same data, quoted the same way, as the default pure Python
+ruamel.yaml backend.
+"""
+import datetime
+import io
+import re
+
+import yaml
+from ruamel.yaml.emitter import Emitter as RuamelEmitter
+from ruamel.yaml.nodes import ScalarNode
+from ruamel.yaml.resolver import VersionedResolver
+
+###############################################################################
+
+class Loader(yaml.CSafeLoader):
+    # YAML 1.1 booleans, like ruamel.yaml (and kubectl)
+    bool_values = dict(yaml.CSafeLoader.bool_values, y=True, n=False)
+
+    def construct_yaml_timestamp(self, node):
+        value = super(Loader, self).construct_yaml_timestamp(node)
+        # like ruamel.yaml: naive UTC datetimes
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value
+
+
+Loader.add_constructor('tag:yaml.org,2002:timestamp', Loader.construct_yaml_timestamp)
+Loader.add_implicit_resolver('tag:yaml.org,2002:bool', re.compile(r'^(?:y|Y|n|N)$'), list('yYnN'))
+# floats without a dot in their mantissa, e.g. `1e3`
+Loader.add_implicit_resolver('tag:yaml.org,2002:float', re.compile(r'^[-+]?[0-9][0-9_]*[eE][-+]?[0-9]+$'), list('-+0123456789'))
+
+###############################################################################
+
+ruamel_resolver = VersionedResolver(version=(1, 1))
+ruamel_analyzer = RuamelEmitter(io.StringIO(), allow_unicode=True)
+
+
+def represent_str(dumper, value):
+    """Choose the scalar style ruamel.yaml would choose, where it differs from libyaml."""
+    style = None
+    # e.g. `y` and `n` are YAML 1.1 booleans for ruamel.yaml, not for PyYAML: quote them
+    plain = ruamel_resolver.resolve(ScalarNode, value, (True, False)) == 'tag:yaml.org,2002:str'
+    if not plain:
+        style = "'"
+    # ruamel.yaml prefers double quotes for non plain scalars with quotes or line breaks
+    if ("'" in value or '\n' in value) and not (plain and ruamel_analyzer.analyze_scalar(value).allow_block_plain):
+        style = '"'
+    return dumper.represent_scalar('tag:yaml.org,2002:str', value, style=style)
+
+
+class Dumper(yaml.CSafeDumper):
+    pass
+
+
+Dumper.add_representer(str, represent_str)
+Dumper.add_representer(type(None), lambda dumper, value: dumper.represent_scalar('tag:yaml.org,2002:null', ''))
+
+###############################################################################
+
+def load(stream, all=False):
+    if all:
+        return list(yaml.load_all(stream, Loader=Loader))
+    return yaml.load(stream, Loader=Loader)
+
+
+def dump(data, stream, all=False):
+    options = dict(Dumper=Dumper, explicit_start=True, sort_keys=False, allow_unicode=True, default_flow_style=False)
+    if all:
+        yaml.dump_all(data, stream, **options)
+    else:
+        yaml.dump(data, stream, **options)
@@ -0,0 +1,75 @@
+import pytest
+
+import dmake.common as common
+from dmake.deepobuild import DockerBaseSerializer
+
+
+DMAKE_FILE = 'test/web/dmake.yml'
+SCRIPTS = ['deploy/dependencies.sh', 'deploy/entrypoint.sh', 'deploy/start.sh']
+
+
+@pytest.fixture(autouse=True)
+def offline_root_image(monkeypatch):
+    monkeypatch.setattr(DockerBaseSerializer, '_get_root_image_digest', lambda self: 'sha256:1234')
+    monkeypatch.setattr(common, 'is_local', True, raising=False)
+
+
+def get_base_image(**kwargs):
+    data = {'name': 'dmake-test-base', 'variant': 'test', 'root_image': 'ubuntu:20.04', 'layered_build': True, 'install_scripts': SCRIPTS}
+    data.update(kwargs)
+    return DockerBaseSerializer()._validate_(DMAKE_FILE, [], data)
+
+
+def get_md5s(**kwargs):
+    md5s = {file: 'md5-%s' % file for file in SCRIPTS + ['manage.py', 'requirements.txt', 'prepare_base.sh', 'config.logrotate', 'load_credentials.sh', 'install_pip3.sh', 'clean_base.sh']}
+    md5s.update(kwargs)
+    return md5s
+
+
+def serialize_layered(tmp_path, base_image, md5s):
+    commands = []
+    base_image._serialize_layered_(commands, str(tmp_path), md5s)
+    with open(str(tmp_path / 'layers.txt')) as f:
+        layers = [line.split() for line in f.read().splitlines()]
+    return commands, layers
+
+
+def test_layers_order(tmp_path):
+    """one layer per install script, in order, between the prepare and clean layers"""
+    base_image = get_base_image(copy_files=['manage.py'], python3_requirements='requirements.txt')
+    commands, layers = serialize_layered(tmp_path, base_image, get_md5s())
+    assert [dockerfile for dockerfile, _ in layers] == ['Dockerfile.%d' % i for i in range(7)]
+    dockerfiles = [(tmp_path / dockerfile).read_text() for dockerfile, _ in layers]
+    assert 'RUN --mount=type=ssh bash /base/prepare_base.sh\n' in dockerfiles[0]
+    assert dockerfiles[1] == 'ARG BASE_IMAGE\nFROM ${BASE_IMAGE}\nCOPY user/manage.py /base/user/manage.py\n'
+    for script, dockerfile in zip(SCRIPTS, dockerfiles[2:5]):
+        assert dockerfile == 'ARG BASE_IMAGE\nFROM ${{BASE_IMAGE}}\nCOPY user/{0} /base/user/{0}\nRUN --mount=type=ssh cd /base/user && ./{0}\n'.format(script)
+    assert 'pip3 install --process-dependency-links -r requirements.txt' in dockerfiles[5]
+    assert dockerfiles[6].endswith('RUN --mount=type=ssh bash /base/clean_base.sh\nCMD ["/bin/bash"]\n')
+    # the base image is the last layer
+    assert base_image.tag == layers[-1][1]
+    assert base_image.tag.startswith('base-rid-sha256-1234-dl-')
+    assert len(commands) == 1
+    cmd, args = commands[0]
+    assert cmd == 'sh'
+    assert args['shell'].startswith('dmake_build_base_docker_layered ')
+
+
+def test_layers_raw_root_image(tmp_path):
+    """raw root images only get the install scripts layers"""
+    _, layers = serialize_layered(tmp_path, get_base_image(raw_root_image=True), get_md5s())
+    assert len(layers) == len(SCRIPTS)
+    assert (tmp_path / layers[-1][0]).read_text().endswith('CMD ["/bin/bash"]\n')
+
+
+def test_layers_chained_digests(tmp_path):
+    """changing an install script only changes its layer digest and the next ones"""
+    _, layers = serialize_layered(tmp_path, get_base_image(), get_md5s())
+    _, changed_layers = serialize_layered(tmp_path, get_base_image(), get_md5s(**{SCRIPTS[1]: 'changed'}))
+    tags = [tag for _, tag in layers]
+    changed_tags = [tag for _, tag in changed_layers]
+    assert len(set(tags)) == len(tags)
+    # layers: prepare, 3 scripts, clean
+    assert tags[:2] == changed_tags[:2]
+    for tag, changed_tag in zip(tags[2:], changed_tags[2:]):
+        assert tag != changed_tag
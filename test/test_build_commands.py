@@ -0,0 +1,74 @@
+import subprocess
+import time
+
+import pytest
+
+from dmake.docker_image import split_build_commands, has_parallel_build_commands, generate_build_commands_script
+
+
+@pytest.mark.parametrize("build_commands,expected", [
+    ([], []),
+    (['cmake .', 'make'], [[['cmake .']], [['make']]]),
+    ([['a1', 'a2']], [[['a1', 'a2']]]),
+    ([['a'], ['b'], 'c', ['d']], [[['a'], ['b']], [['c']], [['d']]]),
+])
+def test_split_build_commands(build_commands, expected):
+    assert split_build_commands(build_commands) == expected
+
+
+def test_has_parallel_build_commands():
+    """only consecutive lists of commands are run in parallel"""
+    assert not has_parallel_build_commands(['cmake .', 'make'])
+    assert not has_parallel_build_commands([['cmake .', 'make']])
+    assert has_parallel_build_commands(['cmake .', ['make a'], ['make b']])
+
+
+def run_script(tmp_path, build_commands):
+    script = tmp_path / 'build.sh'
+    script.write_text(generate_build_commands_script(build_commands))
+    return subprocess.run(['bash', str(script)], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def test_parallel_groups_output_prefix(tmp_path):
+    """parallel groups output is prefixed by the group name, sequential commands are not"""
+    result = run_script(tmp_path, ['echo start', ['echo a1', 'echo a2'], ['echo b'], 'echo end'])
+    assert result.returncode == 0
+    lines = result.stdout.splitlines()
+    assert lines[0] == 'start'
+    assert sorted(lines[1:4]) == ['[build_group_1] a1', '[build_group_1] a2', '[build_group_2] b']
+    assert lines.index('[build_group_1] a1') < lines.index('[build_group_1] a2')
+    assert lines[4] == 'end'
+
+
+def test_parallel_groups_run_concurrently(tmp_path):
+    start = time.time()
+    result = run_script(tmp_path, [['sleep 1'], ['sleep 1'], ['sleep 1']])
+    assert result.returncode == 0
+    assert time.time() - start < 2.5
+
+
+def test_parallel_groups_fail_fast(tmp_path):
+    """the first failing group stops the others and the build"""
+    start = time.time()
+    result = run_script(tmp_path, [['sleep 30', 'touch slow'], ['echo failing', 'false', 'touch fast'], 'touch end'])
+    assert result.returncode != 0
+    assert time.time() - start < 10
+    assert '[build_group_2] failing' in result.stdout
+    assert not (tmp_path / 'fast').exists()
+    assert not (tmp_path / 'slow').exists()
+    assert not (tmp_path / 'end').exists()
+
+
+def test_parallel_groups_sequential_fallback(tmp_path):
+    """without `wait -n` (bash < 4.3), the groups are run sequentially and still stop the build on failure"""
+    script = tmp_path / 'build.sh'
+    content = generate_build_commands_script([['echo a1', 'echo a2'], ['false', 'touch fast'], ['touch never'], 'touch end'])
+    script.write_text(content.replace('dmake_has_wait_n() {\n', 'dmake_has_wait_n() {\n    return 1\n'))
+    result = subprocess.run(['bash', str(script)], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    assert result.returncode != 0
+    lines = result.stdout.splitlines()
+    assert 'running the parallel build commands sequentially' in lines[0]
+    assert lines[1:] == ['[build_group_1] a1', '[build_group_1] a2']
+    assert not (tmp_path / 'fast').exists()
+    assert not (tmp_path / 'never').exists()
+    assert not (tmp_path / 'end').exists()
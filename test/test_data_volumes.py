@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+import dmake.common as common
+import dmake.data_volumes as data_volumes
+from dmake.core import generate_prefetch
+from dmake.data_volumes import DataVolumes, FileBackend, S3Backend, read_manifest, sync_source, sync_sources
+from dmake.deepobuild import DataVolumeSerializer
+from dmake.docker_pull import DockerPrefetch
+
+
+def make_bucket(root, objects):
+    for key, content in objects.items():
+        path = os.path.join(root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def test_register_dedupe(monkeypatch, tmp_path):
+    """the same source mounted by several services is synced once"""
+    monkeypatch.setattr(common, 'config_dir', str(tmp_path), raising=False)
+    DataVolumes.reset()
+    volume = DataVolumeSerializer()._validate_('test/web/dmake.yml', [], {'source': 's3://bucket/datasets/mnist', 'container_volume': '/data'})
+    assert volume.get_mount_opt('app/web', 'test/web') == volume.get_mount_opt('app/worker', 'test/worker')
+    assert volume.get_mount_opt('app/web', 'test/web') == '-v %s:/data' % os.path.join(str(tmp_path), 'data_volumes', 's3', 'bucket/datasets/mnist')
+    assert len(DataVolumes.sources) == 1
+    DataVolumes.reset()
+
+
+def test_sync_incremental(tmp_path):
+    bucket = str(tmp_path / 'bucket')
+    local_path = str(tmp_path / 'local')
+    make_bucket(bucket, {'a.txt': 'a', 'sub/b.txt': 'b'})
+    source = 'file://' + bucket
+    assert sync_source(source, local_path, max_age=0, now=0) == ['a.txt', 'sub/b.txt']
+    assert sync_source(source, local_path, max_age=0, now=1) == []
+    make_bucket(bucket, {'sub/b.txt': 'b2', 'c.txt': 'c'})
+    assert sync_source(source, local_path, max_age=0, now=2) == ['c.txt', 'sub/b.txt']
+    with open(os.path.join(local_path, 'sub/b.txt')) as f:
+        assert f.read() == 'b2'
+    # locally deleted objects are fetched again
+    os.remove(os.path.join(local_path, 'a.txt'))
+    assert sync_source(source, local_path, max_age=0, now=3) == ['a.txt']
+    assert read_manifest(local_path)['synced_at'] == 3
+    # the manifest is not in the mounted directory
+    assert sorted(os.listdir(local_path)) == ['a.txt', 'c.txt', 'sub']
+    assert os.path.isfile(local_path + '.dmake_manifest.json')
+
+
+def test_sync_max_age(tmp_path, monkeypatch):
+    """recently synced sources are not even listed"""
+    bucket = str(tmp_path / 'bucket')
+    local_path = str(tmp_path / 'local')
+    make_bucket(bucket, {'a.txt': 'a'})
+    source = 'file://' + bucket
+    sync_source(source, local_path, max_age=60, now=0)
+    listed = []
+    monkeypatch.setattr(FileBackend, 'list_objects', lambda self, source: listed.append(source) or {})
+    assert sync_source(source, local_path, max_age=60, now=30) == []
+    assert listed == []
+    sync_source(source, local_path, max_age=60, now=90)
+    assert listed == [source]
+
+
+def test_sync_s3_standin(tmp_path, monkeypatch):
+    monkeypatch.setenv('DMAKE_DATA_VOLUMES_S3_STANDIN_DIR', str(tmp_path / 'standin'))
+    make_bucket(str(tmp_path / 'standin' / 'bucket' / 'prefix'), {'a.txt': 'a'})
+    local_path = str(tmp_path / 'local')
+    assert sync_source('s3://bucket/prefix', local_path, max_age=0, now=0) == ['a.txt']
+    assert read_manifest(local_path)['source'] == 's3://bucket/prefix'
+
+
+def test_s3_sync_keys(tmp_path, monkeypatch):
+    """only the changed objects are synced from S3"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    aws = bin_dir / 'aws'
+    aws.write_text('#!/bin/bash\necho "$@" >> %s\n' % (tmp_path / 'aws.log'))
+    aws.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+    monkeypatch.setattr(data_volumes, 'S3_SYNC_MAX_KEYS', 2)
+    S3Backend().sync('s3://bucket/prefix', '/local', ['a.txt', 'sub/b[1].txt', 'c*.txt'])
+    assert (tmp_path / 'aws.log').read_text().splitlines() == [
+        's3 sync --only-show-errors --exclude * --include a.txt --include sub/b[[]1].txt s3://bucket/prefix /local',
+        's3 sync --only-show-errors --exclude * --include c[*].txt s3://bucket/prefix /local',
+    ]
+
+
+def test_sync_sources_concurrently(tmp_path, monkeypatch):
+    sources = []
+    for i in range(4):
+        bucket = str(tmp_path / ('bucket-%d' % i))
+        make_bucket(bucket, {'a.txt': str(i)})
+        sources.append(('file://' + bucket, str(tmp_path / ('local-%d' % i))))
+    sync = FileBackend.sync
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def slow_sync(self, source, local_path, keys):
+        with lock:
+            running.append(source)
+            max_running.append(len(running))
+        time.sleep(0.2)
+        sync(self, source, local_path, keys)
+        with lock:
+            running.remove(source)
+
+    monkeypatch.setattr(FileBackend, 'sync', slow_sync)
+    result = sync_sources(sources, max_age=0, pool_size=4)
+    assert result == {source: ['a.txt'] for source, _ in sources}
+    assert max(max_running) == 4
+
+
+def test_prefetch_plan(tmp_path, monkeypatch):
+    """images pulls and data volumes syncs run in parallel branches of the prefetch stage"""
+    monkeypatch.setattr(common, 'tmp_dir', str(tmp_path), raising=False)
+    monkeypatch.setattr(common, 'cache_dir', str(tmp_path), raising=False)
+    DockerPrefetch.reset()
+    DataVolumes.reset()
+    commands = []
+    generate_prefetch(commands)
+    assert commands == []
+    DataVolumes.register('s3://bucket/prefix', str(tmp_path))
+    generate_prefetch(commands)
+    assert [cmd for cmd, _ in commands] == ['stage', 'sh', 'stage_end']
+    DockerPrefetch.register('redis:5')
+    commands = []
+    generate_prefetch(commands)
+    assert [cmd for cmd, _ in commands] == ['stage', 'parallel',
+                                            'parallel_branch', 'sh', 'parallel_branch_end',
+                                            'parallel_branch', 'sh', 'parallel_branch_end',
+                                            'parallel_end', 'stage_end']
+    assert commands[6][1]['shell'].startswith('dmake_sync_data_volumes ')
+    DockerPrefetch.reset()
+    DataVolumes.reset()
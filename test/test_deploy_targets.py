@@ -0,0 +1,53 @@
+import subprocess
+
+import dmake.common as common
+from dmake.common import append_command
+from dmake.core import generate_command_bash
+from dmake.deepobuild import generate_deploy_targets
+
+
+def target(name, canary=False):
+    return (name, canary, [('sh', {'shell': 'deploy %s' % (name)})])
+
+
+def test_deploy_targets():
+    commands = []
+    generate_deploy_targets(commands, 'web', [target('eu'), target('us-canary', canary=True), target('us'), target('eu'), target('asia')], max_parallel_targets=0)
+    assert commands == [
+        ('echo', {'message': '- Deploying canary web: us-canary'}),
+        ('sh', {'shell': 'deploy us-canary'}),
+        ('parallel', {'background': True}),
+        ('parallel_branch', {'name': 'web: eu'}), ('sh', {'shell': 'deploy eu'}), ('parallel_branch_end', {}),
+        ('parallel_branch', {'name': 'web: us'}), ('sh', {'shell': 'deploy us'}), ('parallel_branch_end', {}),
+        ('parallel_branch', {'name': 'web: eu #3'}), ('sh', {'shell': 'deploy eu'}), ('parallel_branch_end', {}),
+        ('parallel_branch', {'name': 'web: asia'}), ('sh', {'shell': 'deploy asia'}), ('parallel_branch_end', {}),
+        ('parallel_end', {}),
+    ]
+
+
+def test_deploy_targets_limit():
+    commands = []
+    generate_deploy_targets(commands, 'web', [target('eu'), target('us'), target('asia')], max_parallel_targets=2)
+    assert [cmd for cmd, _ in commands] == ['parallel', 'parallel_branch', 'sh', 'parallel_branch_end', 'parallel_branch', 'sh', 'parallel_branch_end', 'parallel_end', 'sh']
+    # a single target is deployed as is
+    commands = []
+    generate_deploy_targets(commands, 'web', [target('eu')], max_parallel_targets=0)
+    assert commands == [('sh', {'shell': 'deploy eu'})]
+
+
+def test_bash_reports_failed_targets(monkeypatch, tmp_path):
+    """all the targets are deployed, then the failed ones are reported together"""
+    monkeypatch.setattr(common, 'parallel_execution', False, raising=False)
+    monkeypatch.setattr(common, 'execution_trace', False)
+    commands = []
+    targets = [(name, False, [('sh', {'shell': 'touch %s; exit %d' % (tmp_path / ('target-%d' % (n)), status)})]) for n, (name, status) in enumerate([('eu', 1), ("us'west", 2), ('asia', 0)])]
+    generate_deploy_targets(commands, 'web', targets, max_parallel_targets=0)
+    append_command(commands, 'sh', shell='touch %s' % (tmp_path / 'not_reached'))
+    script = tmp_path / 'script.sh'
+    with open(str(script), 'w') as f:
+        generate_command_bash(f, commands)
+    process = subprocess.run(['bash', str(script)], stdout=subprocess.PIPE, universal_newlines=True)
+    assert process.returncode != 0
+    assert process.stdout.splitlines()[-3:] == ["Failed parallel branches:", "- web: eu", "- web: us'west"]
+    assert all((tmp_path / ('target-%d' % (n))).exists() for n in range(3))
+    assert not (tmp_path / 'not_reached').exists()
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import dmake.common as common
+from dmake.common import DMakeException
+from dmake.docker_image import DockerBake, ServiceDockerBuildSerializer, validate_bake_file
+
+
+@pytest.fixture(autouse=True)
+def docker_bake(monkeypatch):
+    monkeypatch.setattr(common, 'docker_bake', True, raising=False)
+    monkeypatch.setattr(common, 'root_dir', '/repo/', raising=False)
+    DockerBake.reset()
+    yield
+    DockerBake.reset()
+
+
+def serialize_build(data, image_name, build_args=None):
+    commands = []
+    build = ServiceDockerBuildSerializer()._validate_('test/worker/dmake.yml', [], data, 'build')
+    build._serialize_(commands, 'test/worker', image_name, build_args or {})
+    return commands
+
+
+def test_docker_bake_targets(tmp_path):
+    """build_docker nodes are aggregated as bake targets instead of build commands"""
+    commands = serialize_build({'context': '.', 'dockerfile': 'Dockerfile', 'args': {'FOO': 'bar'}, 'labels': {'vendor': 'deepomatic'}, 'target': 'runtime'},
+                               'dmake-test-worker:master-0-ubuntu-1604', {'BASE_IMAGE': 'base:ubuntu-1604'})
+    commands += serialize_build('.', 'dmake-test-worker:master-0-ubuntu-1804', {'BASE_IMAGE': 'base:ubuntu-1804'})
+    assert commands == []
+
+    with open(DockerBake.write(str(tmp_path))) as f:
+        bake = json.load(f)
+    assert bake == {
+        'group': {'default': {'targets': ['dmake-test-worker-master-0-ubuntu-1604', 'dmake-test-worker-master-0-ubuntu-1804']}},
+        'target': {
+            'dmake-test-worker-master-0-ubuntu-1604': {
+                'context': '/repo/test/worker',
+                'dockerfile': 'Dockerfile',
+                'tags': ['dmake-test-worker:master-0-ubuntu-1604'],
+                'args': {'BASE_IMAGE': 'base:ubuntu-1604', 'FOO': 'bar'},
+                'labels': {'vendor': 'deepomatic'},
+                'target': 'runtime',
+            },
+            'dmake-test-worker-master-0-ubuntu-1804': {
+                'context': '/repo/test/worker',
+                'tags': ['dmake-test-worker:master-0-ubuntu-1804'],
+                'args': {'BASE_IMAGE': 'base:ubuntu-1804'},
+            },
+        },
+    }
+
+
+def test_docker_bake_unique_target_names():
+    first = DockerBake.add_target('.', 'foo/bar:tag')
+    second = DockerBake.add_target('.', 'foo-bar:tag')
+    assert first != second
+    validate_bake_file(DockerBake.generate())
+
+
+@pytest.mark.parametrize("bake,error", [
+    ({'target': {}}, "expecting 'group' and 'target' top-level keys only"),
+    ({'group': {}, 'target': {'a:b': {'context': '.', 'tags': ['a']}}}, "invalid target name 'a:b'"),
+    ({'group': {}, 'target': {'a': {'context': '.'}}}, "target 'a' needs a context and tags"),
+    ({'group': {}, 'target': {'a': {'context': '.', 'tags': ['a'], 'platform': 'arm'}}}, "unexpected field 'platform' in target 'a'"),
+    ({'group': {}, 'target': {'a': {'context': '.', 'tags': ['a'], 'args': {'FOO': 1}}}}, "args of target 'a' must be strings"),
+    ({'group': {'default': {'targets': ['b']}}, 'target': {'a': {'context': '.', 'tags': ['a']}}}, "group 'default' references unknown target 'b'"),
+])
+def test_validate_bake_file(bake, error):
+    with pytest.raises(DMakeException) as excinfo:
+        validate_bake_file(bake)
+    assert excinfo.value.args[0] == "Invalid docker bake file: %s" % error
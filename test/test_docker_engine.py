@@ -0,0 +1,183 @@
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import dmake.common as common
+from dmake.deepobuild import ContainerNames
+from dmake.docker_engine import DockerCLI, DockerEngine, get_engine, main, wait_for_container
+
+
+class FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Fake Docker Engine API: `containers` maps container IDs to their scheduled [(delay, status)] transitions"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, containers, events=True):
+        super(FakeEngine, self).__init__(socket_path, FakeEngineHandler)
+        self.start = time.time()
+        self.containers = containers
+        self.events = events
+        self.requests = []
+
+    def get_status(self, container_id):
+        status = None
+        for delay, transition_status in self.containers[container_id]:
+            if time.time() - self.start >= delay:
+                status = transition_status
+        return status
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'fake'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(url.path)
+        if url.path.startswith('/containers/') and url.path.endswith('/json'):
+            container_id = url.path.split('/')[2]
+            if container_id not in self.server.containers:
+                return self.send_json(404, {'message': 'No such container: %s' % container_id})
+            return self.send_json(200, {'Id': container_id, 'State': {'Status': self.server.get_status(container_id)}})
+        if url.path == '/events' and self.server.events:
+            return self.stream_events(parse_qs(url.query))
+        self.send_json(404, {'message': 'page not found'})
+
+    def stream_events(self, query):
+        until = float(query['until'][0])
+        container_id = json.loads(query['filters'][0])['container'][0]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        sent = 0
+        transitions = self.server.containers[container_id]
+        try:
+            while time.time() < until and sent < len(transitions):
+                delay, status = transitions[sent]
+                if time.time() - self.server.start >= delay:
+                    sent += 1
+                    if status != 'created':
+                        event = {'status': 'start' if status == 'running' else 'die', 'id': container_id, 'Type': 'container'}
+                        chunk = (json.dumps(event) + '\n').encode('utf-8')
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                        self.wfile.flush()
+                time.sleep(0.01)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stops reading once the container settled
+            pass
+
+
+@pytest.fixture
+def engine(tmp_path):
+    servers = []
+
+    def make_engine(containers, events=True):
+        socket_path = str(tmp_path / ('docker-%d.sock' % len(servers)))
+        server = FakeEngine(socket_path, containers, events)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, DockerEngine(socket_path, timeout=5)
+
+    yield make_engine
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_inspect_container(engine):
+    _, client = engine({'abc': [(0, 'running')]})
+    assert client.inspect_container('abc')['State']['Status'] == 'running'
+    assert client.inspect_container('missing') is None
+
+
+def test_wait_for_container_events(engine):
+    """state transitions are received from the events stream, without polling"""
+    server, client = engine({'abc': [(0, 'created'), (0.3, 'running')], 'def': [(0, 'created'), (0.6, 'exited')]})
+    start = time.time()
+    assert wait_for_container(client, 'abc', timeout=5) == 'running'
+    assert wait_for_container(client, 'def', timeout=5) == 'exited'
+    assert time.time() - start < 2
+    assert server.requests.count('/events') == 2
+    assert server.requests.count('/containers/abc/json') == 2
+
+
+def test_wait_for_container_already_running(engine):
+    server, client = engine({'abc': [(0, 'running')]})
+    assert wait_for_container(client, 'abc', timeout=5) == 'running'
+    assert server.requests == ['/containers/abc/json']
+
+
+def test_wait_for_container_backoff(engine):
+    """without events stream, the container is inspected with backoff"""
+    server, client = engine({'abc': [(0, 'created'), (0.3, 'restarting')]}, events=False)
+    assert wait_for_container(client, 'abc', timeout=5) == 'restarting'
+    assert 3 <= server.requests.count('/containers/abc/json') < 15
+
+
+def test_wait_for_container_timeout(engine):
+    _, client = engine({'abc': [(0, 'created')]})
+    start = time.time()
+    assert wait_for_container(client, 'abc', timeout=0.3) == 'created'
+    assert time.time() - start < 2
+
+
+def test_wait_for_many_daemons(engine):
+    """starting many daemons no longer costs seconds of polling each"""
+    containers = {'daemon-%d' % i: [(0, 'created'), (0.1, 'running')] for i in range(15)}
+    _, client = engine(containers)
+    start = time.time()
+    for container in containers:
+        assert wait_for_container(client, container, timeout=5) == 'running'
+    assert time.time() - start < 3
+
+
+def test_wait_for_container_cli(tmp_path, monkeypatch):
+    """without Engine API socket (tcp DOCKER_HOST), the status is polled with `docker inspect`"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    docker = bin_dir / 'docker'
+    # 'abc' runs from the third inspect on
+    docker.write_text('#!/bin/bash\nC="${@: -1}"\ntest "$C" = abc || { echo "Error: No such container: $C" 1>&2; exit 1; }\n'
+                      'echo >> "%s/inspected"\ntest $(wc -l < "%s/inspected") -ge 3 && echo running || echo created\n' % (tmp_path, tmp_path))
+    docker.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+    monkeypatch.setenv('DOCKER_HOST', 'tcp://docker:2375')
+    assert isinstance(get_engine(), DockerCLI)
+    assert main(['abc', 'daemon', '--timeout', '5']) == 0
+    assert (tmp_path / 'inspected').read_text() == '\n' * 3
+    assert main(['missing', 'daemon', '--timeout', '5']) == 1
+
+
+def test_container_names(monkeypatch):
+    """container names are allocated at plan time, unique in the plan and across plans"""
+    monkeypatch.setattr(common, 'name_prefix', 'repo.master.0', raising=False)
+    monkeypatch.setattr(common, 'tmp_dir', '/tmp/dmake_tmp_1', raising=False)
+    ContainerNames.reset()
+    first = ContainerNames.allocate('app/web')
+    assert first.startswith('repo.master.0.app_web.')
+    assert ContainerNames.allocate('app/web') == first + '.1'
+    assert ContainerNames.allocate('app/web') == first + '.2'
+    monkeypatch.setattr(common, 'tmp_dir', '/tmp/dmake_tmp_2', raising=False)
+    ContainerNames.reset()
+    assert ContainerNames.allocate('app/web') != first
+    ContainerNames.reset()
@@ -0,0 +1,102 @@
+import subprocess
+import threading
+import time
+
+import pytest
+
+import dmake.docker_pull as docker_pull
+import dmake.docker_registry as docker_registry
+from dmake.common import DMakeException
+from dmake.docker_pull import DockerPrefetch, pull_images, read_digest_cache, read_images_file
+
+
+def test_images_file(tmp_path):
+    DockerPrefetch.reset()
+    DockerPrefetch.register('deepomatic/base:base-rid-1', mutable=False)
+    DockerPrefetch.register('redis:5')
+    DockerPrefetch.register('ubuntu@sha256:1234')
+    DockerPrefetch.register('redis:5', mutable=False)
+    assert read_images_file(DockerPrefetch.write(str(tmp_path))) == [('deepomatic/base:base-rid-1', False), ('redis:5', True), ('ubuntu@sha256:1234', False)]
+    DockerPrefetch.reset()
+
+
+@pytest.fixture
+def docker(monkeypatch):
+    """Fake registry and docker daemon: `remote` and `local` map images to their digests"""
+    state = {'remote': {}, 'local': {}, 'missing': set(), 'pulled': [], 'registry_checks': [], 'concurrent': 0, 'max_concurrent': 0}
+    lock = threading.Lock()
+
+    def fake_docker_pull(image_name):
+        with lock:
+            state['concurrent'] += 1
+            state['max_concurrent'] = max(state['max_concurrent'], state['concurrent'])
+        time.sleep(0.1)
+        with lock:
+            state['concurrent'] -= 1
+        if image_name in state['missing']:
+            raise subprocess.CalledProcessError(1, ['docker', 'pull', image_name])
+        with lock:
+            state['pulled'].append(image_name)
+            state['local'][image_name] = state['remote'].get(image_name)
+
+    def fake_get_manifest_digest(image_name):
+        state['registry_checks'].append(image_name)
+        return state['remote'].get(image_name)
+
+    monkeypatch.setattr(docker_registry, 'get_manifest_digest', fake_get_manifest_digest)
+    monkeypatch.setattr(docker_pull, 'get_local_repo_digests', lambda image_name: ['%s@%s' % (image_name.split(':')[0], state['local'][image_name])] if image_name in state['local'] else [])
+    monkeypatch.setattr(docker_pull, 'is_image_present', lambda image_name: image_name in state['local'])
+    monkeypatch.setattr(docker_pull, 'docker_pull', fake_docker_pull)
+    return state
+
+
+IMAGES = [('redis:5', True), ('mongo:4', True), ('deepomatic/base:base-rid-1', False)]
+
+
+def test_pull_policy_always(docker):
+    """mutable images are always pulled, immutable ones only if missing"""
+    docker['local'] = {'redis:5': 'sha256:r', 'deepomatic/base:base-rid-1': 'sha256:b'}
+    assert pull_images(IMAGES, 'always', 3600, None, pool_size=4) == ['redis:5', 'mongo:4']
+
+
+def test_pull_policy_if_not_present(docker):
+    docker['local'] = {'redis:5': 'sha256:r'}
+    assert pull_images(IMAGES, 'if-not-present', 3600, None, pool_size=4) == ['mongo:4', 'deepomatic/base:base-rid-1']
+    assert docker['registry_checks'] == []
+
+
+def test_pull_policy_digest_ttl(docker, tmp_path):
+    """the registry is checked at most once per TTL, and only outdated images are pulled"""
+    cache_file = str(tmp_path / 'digests.json')
+    docker['remote'] = {'redis:5': 'sha256:r-new', 'mongo:4': 'sha256:m'}
+    docker['local'] = {'redis:5': 'sha256:r', 'mongo:4': 'sha256:m'}
+    images = IMAGES[:2]
+    assert pull_images(images, 'digest-ttl', 3600, cache_file, pool_size=4) == ['redis:5']
+    assert sorted(docker['registry_checks']) == ['mongo:4', 'redis:5']
+    assert sorted(read_digest_cache(cache_file).keys()) == ['mongo:4', 'redis:5']
+
+    docker['remote']['mongo:4'] = 'sha256:m-new'
+    docker['registry_checks'] = []
+    assert pull_images(images, 'digest-ttl', 3600, cache_file, pool_size=4) == []
+    assert docker['registry_checks'] == []
+    # expired TTL
+    assert pull_images(images, 'digest-ttl', 0, cache_file, pool_size=4) == ['mongo:4']
+
+
+def test_pull_images_bounded_concurrency(docker):
+    images = [('deepomatic/image-%d:1' % i, True) for i in range(8)]
+    start = time.time()
+    assert len(pull_images(images, 'always', 3600, None, pool_size=3)) == 8
+    assert docker['max_concurrent'] == 3
+    assert time.time() - start < 0.8
+
+
+def test_pull_images_failures_tolerated(docker):
+    """images not yet in the registry (like base images to build) are skipped"""
+    docker['missing'] = {'deepomatic/base:base-rid-1'}
+    assert pull_images(IMAGES, 'always', 3600, None, pool_size=4) == ['redis:5', 'mongo:4']
+
+
+def test_pull_images_invalid_policy(docker):
+    with pytest.raises(DMakeException):
+        pull_images(IMAGES, 'never', 3600, None, pool_size=4)
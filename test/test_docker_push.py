@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+import dmake.docker_push as docker_push
+import dmake.docker_registry as docker_registry
+from dmake.common import DMakeException
+from dmake.docker_push import DockerPush, push_images, read_images_file
+
+
+@pytest.mark.parametrize("image,expected", [
+    ('ubuntu', ('https://registry-1.docker.io', 'library/ubuntu', 'latest')),
+    ('deepomatic/foo:1.0', ('https://registry-1.docker.io', 'deepomatic/foo', '1.0')),
+    ('docker.io/deepomatic/foo:1.0', ('https://registry-1.docker.io', 'deepomatic/foo', '1.0')),
+    ('localhost:5000/foo/bar', ('https://localhost:5000', 'foo/bar', 'latest')),
+    ('gcr.io/project/foo/bar@sha256:1234', ('https://gcr.io', 'project/foo/bar', 'sha256:1234')),
+])
+def test_parse_docker_image_reference(image, expected):
+    assert docker_registry.parse_docker_image_reference(image) == expected
+
+
+def test_images_file(tmp_path):
+    DockerPush.reset()
+    DockerPush.register('deepomatic/foo:1', False)
+    DockerPush.register('deepomatic/bar:1', False)
+    DockerPush.register('deepomatic/foo:1', True)
+    assert read_images_file(DockerPush.write(str(tmp_path))) == [('deepomatic/foo:1', True), ('deepomatic/bar:1', False)]
+    DockerPush.reset()
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Fake registry and docker daemon: `remote` and `local` map images to their digests"""
+    state = {'remote': {}, 'local': {}, 'public': set(), 'pushed': [], 'concurrent': 0, 'max_concurrent': 0}
+    lock = threading.Lock()
+
+    def fake_docker_push(image_name):
+        with lock:
+            state['concurrent'] += 1
+            state['max_concurrent'] = max(state['max_concurrent'], state['concurrent'])
+        time.sleep(0.1)
+        with lock:
+            state['concurrent'] -= 1
+            state['pushed'].append(image_name)
+
+    monkeypatch.setattr(docker_registry, 'get_manifest_digest', lambda image_name: state['remote'].get(image_name))
+    monkeypatch.setattr(docker_registry, 'is_docker_hub_repository_public', lambda image_name: image_name in state['public'])
+    monkeypatch.setattr(docker_push, 'get_local_repo_digests', lambda image_name: ['%s@%s' % (image_name.split(':')[0], state['local'][image_name])] if image_name in state['local'] else [])
+    monkeypatch.setattr(docker_push, 'docker_push', fake_docker_push)
+    return state
+
+
+def test_push_images_skip_already_pushed(registry):
+    """images whose tag manifest is the local image one are not pushed"""
+    registry['remote'] = {'deepomatic/a:1': 'sha256:a', 'deepomatic/b:1': 'sha256:b-old'}
+    registry['local'] = {'deepomatic/a:1': 'sha256:a', 'deepomatic/b:1': 'sha256:b'}
+    images = [('deepomatic/a:1', True), ('deepomatic/b:1', True), ('deepomatic/c:1', True)]
+    assert push_images(images, pool_size=4) == ['deepomatic/b:1', 'deepomatic/c:1']
+    assert sorted(registry['pushed']) == ['deepomatic/b:1', 'deepomatic/c:1']
+
+
+def test_push_images_bounded_concurrency(registry):
+    images = [('deepomatic/image-%d:1' % i, False) for i in range(8)]
+    start = time.time()
+    assert len(push_images(images, pool_size=3)) == 8
+    assert registry['max_concurrent'] == 3
+    assert time.time() - start < 0.8
+
+
+def test_push_images_public_repository(registry):
+    """a public repository aborts the push of all images, before any push"""
+    registry['public'] = {'deepomatic/public:1'}
+    images = [('deepomatic/private:1', True), ('deepomatic/public:1', True), ('deepomatic/unchecked:1', False)]
+    with pytest.raises(DMakeException) as excinfo:
+        push_images(images, pool_size=4)
+    assert 'deepomatic/public:1' in excinfo.value.args[0]
+    assert registry['pushed'] == []
@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import pytest
+
+import dmake.common as common
+from dmake.deepobuild import BuildSerializer
+from dmake.docker_image import ServiceDockerV1Serializer
+
+
+DMAKE_FILE = 'test/web/dmake.yml'
+
+
+@pytest.fixture
+def docker_base():
+    return SimpleNamespace(mount_point='/app', get_docker_base_image=lambda variant: 'base-image:tag')
+
+
+@pytest.fixture(autouse=True)
+def release_branch(monkeypatch):
+    monkeypatch.setattr(common, 'is_release_branch', False, raising=False)
+
+
+def generate_dockerfile(tmp_path, docker_base, docker_image, build=None):
+    image = ServiceDockerV1Serializer()._validate_(DMAKE_FILE, [], docker_image)
+    image.set_service(SimpleNamespace(config=SimpleNamespace(ports=[SimpleNamespace(container_port=8000)])))
+    build = BuildSerializer()._validate_(DMAKE_FILE, [], build or {'env': {'BUILD': 'foo'}, 'commands': ['make']})
+    dockerfile = image.generate_dockerfile(str(tmp_path), 'test/web', docker_base, build)
+    with open(dockerfile) as f:
+        return f.read().splitlines()
+
+
+def test_dockerfile_default_layers(tmp_path, docker_base):
+    """without dependency layers, the whole source is added first"""
+    lines = generate_dockerfile(tmp_path, docker_base, {'start_script': 'deploy/start.sh'})
+    assert lines == [
+        'FROM base-image:tag',
+        'ADD app /app',
+        'WORKDIR /app/test/web',
+        'EXPOSE 8000',
+        'ENV BUILD "foo"',
+        'ENV DMAKE_BUILD_TYPE testing',
+        'RUN cd /app/test/web && make',
+        'CMD ["/app/test/web/deploy/start.sh"]',
+    ]
+
+
+def test_dockerfile_dependency_layers(tmp_path, docker_base):
+    """dependency manifests are added and installed before the whole source, and the build environment"""
+    lines = generate_dockerfile(tmp_path, docker_base, {
+        'start_script': 'deploy/start.sh',
+        'install_script': 'deploy/dependencies.sh',
+        'dependency_layers': [
+            {'files': ['requirements.txt'], 'commands': ['pip install -r requirements.txt']},
+            {'files': ['manage.py', 'deploy/dependencies.sh'], 'commands': ['echo a', 'echo b']},
+        ]})
+    assert lines == [
+        'FROM base-image:tag',
+        'COPY app/test/web/requirements.txt /app/test/web/requirements.txt',
+        'RUN mkdir -p /app/test/web && cd /app/test/web && pip install -r requirements.txt',
+        'COPY app/test/web/manage.py /app/test/web/manage.py',
+        'COPY app/test/web/deploy/dependencies.sh /app/test/web/deploy/dependencies.sh',
+        'RUN mkdir -p /app/test/web && cd /app/test/web && echo a && echo b',
+        'ADD app /app',
+        'WORKDIR /app/test/web',
+        'EXPOSE 8000',
+        'ENV BUILD "foo"',
+        'ENV DMAKE_BUILD_TYPE testing',
+        'RUN cd /app/test/web && make',
+        'RUN cd /app/test/web && /app/test/web/deploy/dependencies.sh',
+        'CMD ["/app/test/web/deploy/start.sh"]',
+    ]
+
+
+def test_dockerfile_parallel_build_commands(tmp_path, docker_base):
+    """parallel build commands are run by a generated script"""
+    lines = generate_dockerfile(tmp_path, docker_base, {}, build={'commands': [['make a'], ['make b']]})
+    assert lines[-2:] == [
+        'ADD dmake_build_commands.sh /tmp/dmake_build_commands.sh',
+        'RUN cd /app/test/web && bash /tmp/dmake_build_commands.sh && rm -f /tmp/dmake_build_commands.sh',
+    ]
+    assert (tmp_path / 'dmake_build_commands.sh').exists()
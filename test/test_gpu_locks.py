@@ -0,0 +1,85 @@
+import pytest
+
+from dmake import cli, common, core, deepobuild
+from dmake.core import get_gpu_lock_scope, is_gpu_released_with_node
+from dmake.serializer import ValidationError
+
+
+TEST_CPU = ('test', 'app/cpu', None)
+TEST_GPU = ('test', 'app/gpu', None)
+SHELL_GPU = ('shell', 'app/gpu', None)
+RUN_GPU = ('run', 'app/gpu-server', None)
+RUN_LINK_GPU = ('run_link', 'links/app/gpu-link', None)
+
+
+def test_gpu_released_with_node():
+    assert is_gpu_released_with_node(TEST_GPU)
+    assert is_gpu_released_with_node(SHELL_GPU)
+    assert not is_gpu_released_with_node(RUN_GPU)
+    assert not is_gpu_released_with_node(RUN_LINK_GPU)
+
+
+def test_gpu_lock_scope_without_daemons():
+    """tests lock their own GPUs: no lock held until the end of the plan"""
+    nodes_need_gpu = {TEST_CPU: False, TEST_GPU: 2}
+    assert get_gpu_lock_scope([[TEST_CPU], [TEST_GPU]], nodes_need_gpu) == (None, 0)
+    assert get_gpu_lock_scope([], nodes_need_gpu) == (None, 0)
+
+
+def test_gpu_lock_scope_with_daemons():
+    """the lock starts with the first GPU daemon, sized for all the following nodes"""
+    nodes_need_gpu = {TEST_CPU: False, TEST_GPU: 4, SHELL_GPU: 1, RUN_GPU: 1, RUN_LINK_GPU: 2}
+    assert get_gpu_lock_scope([[TEST_GPU], [TEST_CPU, RUN_LINK_GPU], [RUN_GPU], [SHELL_GPU]], nodes_need_gpu) == (1, 2)
+    assert get_gpu_lock_scope([[RUN_GPU], [TEST_GPU]], nodes_need_gpu) == (0, 4)
+    # a daemon without GPU doesn't lock
+    assert get_gpu_lock_scope([[RUN_GPU], [TEST_GPU]], {RUN_GPU: False, TEST_GPU: 1}) == (None, 0)
+
+
+def generate_plan(monkeypatch, command, service, parallel):
+    """Return: the lock, stage, parallel branch and docker run commands of the plan of the test project."""
+    # build server mode: the plan is only generated
+    monkeypatch.setenv('DMAKE_ON_BUILD_SERVER', '1')
+    monkeypatch.setenv('BRANCH_NAME', 'master')
+    monkeypatch.setenv('DMAKE_PARALLEL_EXECUTION', '1' if parallel else '0')
+    monkeypatch.delenv('DMAKE_NO_GPU', raising=False)
+    plan = []
+    monkeypatch.setattr(core, 'generate_command', lambda file_name, commands: plan.extend(commands))
+    deepobuild.reset()
+    args = cli.argparser.parse_args([command, service])
+    common.init(args)
+    common.sub_dir = 'test'
+    core.make(args)
+    deepobuild.reset()
+    filtered = []
+    for cmd, kwargs in plan:
+        if cmd in ['lock', 'lock_end']:
+            filtered.append((cmd, kwargs.get('label')))
+        elif cmd in ['stage', 'parallel_branch']:
+            filtered.append((cmd, kwargs['name']))
+        elif cmd in ['sh', 'read_sh'] and 'DMAKE_DOCKER_RUN_WITH_GPU=yes' in kwargs['shell']:
+            filtered.append(('sh', 'gpu'))
+    return filtered
+
+
+def test_plan_gpu_test_locks(monkeypatch):
+    """a GPU test locks its GPUs around its own node, outside PARALLEL_BUILDERS"""
+    assert generate_plan(monkeypatch, 'test', 'test-gpu', parallel=False)[-4:] == [
+        ('stage', 'Running App'), ('lock', 'GPUS'), ('sh', 'gpu'), ('lock_end', None)]
+    assert generate_plan(monkeypatch, 'test', 'test-gpu', parallel=True)[-7:] == [
+        ('stage', 'height 1'), ('parallel_branch', 'test @ dmake-test/test-gpu'),
+        ('lock', 'GPUS'), ('lock', 'PARALLEL_BUILDERS'), ('sh', 'gpu'), ('lock_end', None), ('lock_end', None)]
+
+
+def test_plan_gpu_daemon_locks(monkeypatch):
+    """a GPU daemon locks its GPUs from its start until the end of the stage, or of the plan"""
+    assert generate_plan(monkeypatch, 'run', 'test-gpu', parallel=False)[-4:] == [
+        ('stage', 'Running App'), ('lock', 'GPUS'), ('sh', 'gpu'), ('lock_end', None)]
+    assert generate_plan(monkeypatch, 'run', 'test-gpu', parallel=True)[-7:] == [
+        ('lock', 'GPUS'), ('stage', 'height 1'), ('parallel_branch', 'run @ dmake-test/test-gpu'),
+        ('lock', 'PARALLEL_BUILDERS'), ('sh', 'gpu'), ('lock_end', None), ('lock_end', None)]
+
+
+def test_gpu_count_validation():
+    assert deepobuild.DeployConfigSerializer()._validate_('test/gpu/dmake.yml', [], {'need_gpu': True, 'gpu_count': 2}).gpu_count == 2
+    with pytest.raises(ValidationError, match="Invalid `gpu_count` 0"):
+        deepobuild.DeployConfigSerializer()._validate_('test/gpu/dmake.yml', [], {'need_gpu': True, 'gpu_count': 0})
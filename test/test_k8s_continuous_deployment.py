@@ -0,0 +1,235 @@
+import json
+import queue
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import dmake.k8s_continuous_deployment as k8s_cd
+from dmake.common import DMakeException
+
+TOKEN = 'token-from-exec-plugin'
+
+
+def deployment(name, image='web:1', configmap_env_name='web-env-1', version=1, labels=None):
+    return {
+        'metadata': {'name': name, 'namespace': 'prod', 'generation': 1, 'resourceVersion': str(version),
+                     'labels': labels or {'dmake_web': 'web'}},
+        'spec': {'replicas': 2, 'template': {'spec': {'containers': [
+            {'name': 'web', 'image': image, 'envFrom': [{'configMapRef': {'name': configmap_env_name}}]}]}}},
+        'status': {'observedGeneration': 1, 'replicas': 2, 'updatedReplicas': 2, 'availableReplicas': 2},
+    }
+
+
+def apply_json_patch(resource, json_patch):
+    for operation in json_patch:
+        *parents, key = [int(part) if part.isdigit() else part for part in operation['path'].split('/')[1:]]
+        target = resource
+        for part in parents:
+            target = target[part]
+        target[key] = operation['value']
+
+
+class FakeApiServer(object):
+    """
+    Fake Kubernetes API server: ConfigMaps and Deployments of one namespace;
+    patched Deployments are rolled out by a fake controller, after the
+    watchers saw them patched. Requests are logged.
+    """
+    def __init__(self, deployments):
+        self.deployments = {d['metadata']['name']: d for d in deployments}
+        self.config_maps = {}
+        self.version = 100
+        self.requests = []
+        # [(resourceVersion, event)]: watches start from a resourceVersion
+        self.history = []
+        self.watchers = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_body(self):
+                return json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+            def handle_request(self, method):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                server.requests.append((method, url.path, {k: v[0] for k, v in query.items()}))
+                if self.headers.get('Authorization') != 'Bearer %s' % (TOKEN):
+                    return self.send_json(401, {'kind': 'Status', 'code': 401})
+                match = re.match(r'^/apis?/(?:v1|apps/v1)/namespaces/prod/(configmaps|deployments)(?:/([^/]+))?$', url.path)
+                if not match:
+                    return self.send_json(404, {'kind': 'Status', 'code': 404})
+                kind, name = match.groups()
+                if kind == 'configmaps':
+                    if method == 'GET':
+                        if name not in server.config_maps:
+                            return self.send_json(404, {'kind': 'Status', 'code': 404})
+                        return self.send_json(200, server.config_maps[name])
+                    body = self.read_body()
+                    server.config_maps[body['metadata']['name']] = body
+                    return self.send_json(201 if method == 'POST' else 200, body)
+                if method == 'GET' and query.get('watch') == ['True']:
+                    return self.watch(int(query['resourceVersion'][0]))
+                if method == 'GET':
+                    with server.lock:
+                        return self.send_json(200, {'metadata': {'resourceVersion': str(server.version)}, 'items': list(server.deployments.values())})
+                if method == 'PATCH':
+                    assert self.headers['Content-Type'] == 'application/json-patch+json'
+                    with server.lock:
+                        if name not in server.deployments:
+                            return self.send_json(404, {'kind': 'Status', 'code': 404})
+                        resource = server.deployments[name]
+                        apply_json_patch(resource, self.read_body())
+                        resource['metadata']['generation'] += 1
+                        server.notify('MODIFIED', resource)
+                        # the controller rolls out the new generation
+                        resource['status'] = dict(resource['status'], observedGeneration=resource['metadata']['generation'])
+                        server.notify('MODIFIED', resource)
+                        return self.send_json(200, json.loads(json.dumps(resource)))
+
+            def watch(self, resource_version):
+                events = queue.Queue()
+                with server.lock:
+                    for version, event in server.history:
+                        if version > resource_version:
+                            events.put(event)
+                    server.watchers.append(events)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                while True:
+                    try:
+                        event = events.get(timeout=1)
+                    except queue.Empty:
+                        break
+                    line = (json.dumps(event) + '\n').encode('utf-8')
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                    self.wfile.flush()
+                with server.lock:
+                    server.watchers.remove(events)
+                self.wfile.write(b'0\r\n\r\n')
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+            def do_PATCH(self):
+                self.handle_request('PATCH')
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def notify(self, event_type, resource):
+        self.version += 1
+        resource['metadata']['resourceVersion'] = str(self.version)
+        event = {'type': event_type, 'object': json.loads(json.dumps(resource))}
+        self.history.append((self.version, event))
+        for watcher in self.watchers:
+            watcher.put(event)
+
+    def patches(self):
+        return sorted(path.split('/')[-1] for method, path, _ in self.requests if method == 'PATCH')
+
+
+@pytest.fixture
+def api_server(tmp_path, monkeypatch):
+    servers = []
+
+    def start(deployments):
+        server = FakeApiServer(deployments)
+        servers.append(server)
+        # credentials from an exec plugin
+        plugin = tmp_path / 'credentials-plugin'
+        plugin.write_text('#!/bin/sh\necho \'{"apiVersion": "client.authentication.k8s.io/v1beta1", "kind": "ExecCredential", "status": {"token": "%s"}}\'\n' % (TOKEN))
+        plugin.chmod(0o755)
+        kubeconfig = {
+            'apiVersion': 'v1',
+            'kind': 'Config',
+            'clusters': [{'name': 'fake', 'cluster': {'server': 'http://127.0.0.1:%d' % (server.httpd.server_address[1])}}],
+            'users': [{'name': 'fake', 'user': {'exec': {'apiVersion': 'client.authentication.k8s.io/v1beta1', 'command': str(plugin)}}}],
+            'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+            'current-context': 'fake',
+        }
+        (tmp_path / 'kubeconfig').write_text(json.dumps(kubeconfig))
+        monkeypatch.setenv('KUBECONFIG', str(tmp_path / 'kubeconfig'))
+        return server
+
+    yield start
+    for server in servers:
+        server.httpd.shutdown()
+
+
+def run(tmp_path, *options, selectors=''):
+    configmap_env_file = tmp_path / 'kubernetes-configmap-env.yaml'
+    configmap_env_file.write_text("apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: web-env-2\ndata:\n  FOO: bar\n")
+    return k8s_cd.main(list(options) + [str(tmp_path), 'fake', 'prod', 'app', 'web', 'web:2', str(configmap_env_file), selectors])
+
+
+def test_update_deployments(api_server, tmp_path):
+    server = api_server([deployment('web-%d' % (n), version=n) for n in range(6)] +
+                        [deployment('up-to-date', image='web:2', configmap_env_name='web-env-2')])
+    assert run(tmp_path, '--parallel-updates', '2', '--timeout', '10') == 0
+    assert server.patches() == ['web-%d' % (n) for n in range(6)]
+    assert all(d['spec']['template']['spec']['containers'][0]['image'] == 'web:2' for d in server.deployments.values())
+    assert server.config_maps['web-env-2']['data'] == {'FOO': 'bar'}
+    assert server.config_maps['dmake-metadata-web']['data'] == {'ConfigMapEnvName': 'web-env-2', 'Image': 'web:2'}
+    # Deployments progress is followed by watch, not polled
+    gets = [(path, query) for method, path, query in server.requests if method == 'GET' and path.endswith('/deployments')]
+    assert gets[0] == ('/apis/apps/v1/namespaces/prod/deployments', {'labelSelector': 'dmake_web'})
+    assert all(query.get('watch') == 'True' for _, query in gets[1:])
+    assert len(gets) < 6
+
+    # nothing left to update: not patched again
+    server.requests = []
+    assert run(tmp_path) == 0
+    assert server.patches() == []
+
+
+def test_update_timeout(api_server, tmp_path):
+    server = api_server([deployment('web', version=1)])
+    # the controller never rolls out
+    server.deployments['web']['status']['availableReplicas'] = 0
+    assert run(tmp_path, '--timeout', '1') == 1
+    assert server.patches() == ['web']
+
+
+def test_update_selectors(api_server, tmp_path):
+    server = api_server([deployment('web')])
+    assert run(tmp_path, selectors='env=prod') == 0
+    assert server.requests[-1][2]['labelSelector'] == 'dmake_web,env=prod'
+
+
+def test_deployment_patch():
+    assert k8s_cd.get_deployment_patch(deployment('web'), 'web:1', 'web-env-1') == []
+    no_env = deployment('web')
+    del no_env['spec']['template']['spec']['containers'][0]['envFrom']
+    assert k8s_cd.get_deployment_patch(no_env, 'web:2', 'web-env-1') == [
+        {'op': 'replace', 'path': '/spec/template/spec/containers/0/image', 'value': 'web:2'},
+        {'op': 'add', 'path': '/spec/template/spec/containers/0/envFrom', 'value': [{'configMapRef': {'name': 'web-env-1'}}]}]
+    sidecar = deployment('web')
+    sidecar['spec']['template']['spec']['containers'].append({'name': 'sidecar'})
+    with pytest.raises(DMakeException, match='multiple containers'):
+        k8s_cd.get_deployment_patch(sidecar, 'web:2', 'web-env-1')
@@ -0,0 +1,129 @@
+import os
+import subprocess
+
+import pytest
+
+import dmake.common as common
+import dmake.kubernetes as k8s_utils
+from dmake.common import DMakeException
+
+RESOURCES_DIR = os.path.join(os.path.dirname(__file__), 'test-resources', 'kubernetes')
+UTILS_DIR = os.path.join(os.path.dirname(__file__), '..', 'dmake', 'utils')
+
+LABELS = {'dmake.deepomatic.com/service': 'web', 'app': 'web'}
+ANNOTATIONS = {'dmake.deepomatic.com/app': 'dmake-test'}
+
+FILES = {
+    'nginx.conf': b'server {\n    listen 80;\n}\n',
+    'data.json': b'{"foo": true}\n',
+    'logo.bin': b'\x00\xff\x10binary',
+    'empty.txt': b'',
+    'password': b'user:password\n',
+    'key.pem': b'-----BEGIN KEY-----\nabc\n-----END KEY-----\n',
+}
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = {}
+    for name, content in FILES.items():
+        (tmp_path / name).write_bytes(content)
+        paths[name] = str(tmp_path / name)
+    return paths
+
+
+def read_resource(name):
+    with open(os.path.join(RESOURCES_DIR, name), 'r') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('generate, name, keys, kubectl_output, golden', [
+    (k8s_utils.generate_config_map_from_files, 'dmake-test-configmap', ['nginx.conf', 'data.json', 'logo.bin', 'empty.txt'],
+     'kubectl-create-configmap.yaml', 'kubernetes-user-configmaps.yaml'),
+    (k8s_utils.generate_secret_from_files, 'dmake-test-secret', ['password', 'key.pem'],
+     'kubectl-create-secret-generic.yaml', 'kubernetes-user-secrets.yaml'),
+])
+def test_generate_from_files(files, generate, name, keys, kubectl_output, golden):
+    """same output as from the `kubectl create ... --dry-run --output=yaml` output"""
+    resource = generate(name, [(key, files[key]) for key in keys])
+    output = k8s_utils.dump_all_str_and_add_metadata([resource], LABELS, ANNOTATIONS)
+    assert output == read_resource(golden)
+    assert output == k8s_utils.dump_all_str_and_add_metadata([read_resource(kubectl_output)], LABELS, ANNOTATIONS)
+
+
+def test_generate_empty():
+    assert k8s_utils.dump_all_str_and_add_metadata([k8s_utils.generate_config_map_from_files('empty', [])]) == \
+        "---\napiVersion: v1\nkind: ConfigMap\nmetadata:\n  creationTimestamp:\n  name: empty\n"
+
+
+def test_generate_invalid_keys(files):
+    with pytest.raises(DMakeException, match="another key by that name already exists"):
+        k8s_utils.generate_secret_from_files('secret', [('password', files['password']), ('password', files['key.pem'])])
+    with pytest.raises(DMakeException, match="a valid key must consist of"):
+        k8s_utils.generate_config_map_from_files('configmap', [('nginx/conf', files['nginx.conf'])])
+
+
+def test_render_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(common, 'config_dir', str(tmp_path), raising=False)
+    monkeypatch.setattr(common, 'yaml_backend', 'ruamel', raising=False)
+    template = tmp_path / 'deployment.yaml'
+    template.write_text("apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: ${NAME}\n")
+    rendered = []
+
+    def render(timestamp):
+        annotations = dict(ANNOTATIONS, **{k8s_utils.DEPLOY_TIMESTAMP_ANNOTATION: timestamp})
+        direct = k8s_utils.dump_all_str_and_add_metadata("apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: web\n", LABELS, annotations)
+        dump_all_str_and_add_metadata = k8s_utils.dump_all_str_and_add_metadata
+        monkeypatch.setattr(k8s_utils, 'dump_all_str_and_add_metadata', lambda *args: rendered.append(args) or dump_all_str_and_add_metadata(*args))
+        output = k8s_utils.render_manifest_template(str(template), {'NAME': 'web'}, LABELS, annotations)
+        monkeypatch.setattr(k8s_utils, 'dump_all_str_and_add_metadata', dump_all_str_and_add_metadata)
+        assert output == direct
+        return output
+
+    render('2020-01-01T10:00:00Z')
+    assert len(rendered) == 1
+    # the deploy timestamp is not part of the cache key
+    assert '2020-01-02T10:00:00Z' in render('2020-01-02T10:00:00Z')
+    assert len(rendered) == 1
+    template.write_text("apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: ${NAME}\n\n")
+    render('2020-01-02T10:00:00Z')
+    assert len(rendered) == 2
+
+
+def test_manifests_hash():
+    deployment = "apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: web\nspec:\n  template:\n    metadata:\n      labels:\n        app: web\n"
+    data_str = k8s_utils.dump_all_str_and_add_metadata(deployment, LABELS, dict(ANNOTATIONS, **{
+        k8s_utils.DEPLOY_TIMESTAMP_ANNOTATION: '2020-01-01T10:00:00Z', 'kubernetes.io/change-cause': 'deploy 1'}))
+    manifests_hash = k8s_utils.get_manifests_hash([data_str])
+    assert manifests_hash.startswith('sha256:') and len(manifests_hash) == len(k8s_utils.MANIFESTS_HASH_SENTINEL)
+    # volatile annotations are ignored
+    assert k8s_utils.get_manifests_hash([data_str.replace('2020-01-01', '2020-01-02').replace('deploy 1', 'deploy 2')]) == manifests_hash
+    assert k8s_utils.get_manifests_hash([data_str.replace('app: web\n', 'app: api\n')]) != manifests_hash
+
+
+@pytest.fixture
+def kubectl(tmp_path, monkeypatch):
+    """Fake kubectl: logs its calls, `get` outputs the live-hashes file"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'kubectl'
+    script.write_text('#!/bin/bash\necho "$1 $2" >> %s\nif [ "$2" = get ]; then cat %s; fi\n' % (tmp_path / 'kubectl.log', tmp_path / 'live-hashes'))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s:/usr/bin:/bin' % (bin_dir, UTILS_DIR))
+    monkeypatch.delenv('DMAKE_K8S_FORCE_APPLY', raising=False)
+    return tmp_path
+
+
+@pytest.mark.parametrize('live_hashes, applied', [
+    ('sha256:1\nsha256:1\n', False),
+    ('sha256:1\nsha256:2\n', True),
+    ('sha256:1\n<none>\n', True),
+    ('', True),
+])
+def test_deploy_skips_unchanged(kubectl, live_hashes, applied):
+    (kubectl / 'live-hashes').write_text(live_hashes)
+    subprocess.check_call(['dmake_deploy_kubernetes', str(kubectl), 'main', '', 'web', 'sha256:1', 'no-pruning:configmap.yaml', 'deployment.yaml'])
+    calls = (kubectl / 'kubectl.log').read_text().splitlines()
+    assert ('--context=main apply' in calls) == applied
+    # the rollout is waited for, even when unchanged (the fake `get` also lists the live-hashes as deployments)
+    assert ('--context=main rollout' in calls) == bool(live_hashes)
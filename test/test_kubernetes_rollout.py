@@ -0,0 +1,160 @@
+import time
+
+import pytest
+
+import dmake.common as common
+from dmake.common import DMakeException
+from dmake.kubernetes_rollout import KubernetesApiError, main, KubernetesRollouts, RolloutMonitor, get_rollout_status
+
+
+def deployment(name, service, generation=2, observed_generation=2, replicas=2, updated=2, available=2, total=None, conditions=None, version=1):
+    return {
+        'kind': 'Deployment',
+        'metadata': {'name': name, 'generation': generation, 'resourceVersion': str(version),
+                     'labels': {'dmake.deepomatic.com/service': service}},
+        'spec': {'replicas': replicas, 'selector': {'matchLabels': {'app': name}},
+                 'template': {'metadata': {'annotations': {'dmake.deepomatic.com/manifests-hash': 'sha256:2'}}}},
+        'status': {'observedGeneration': observed_generation, 'replicas': updated if total is None else total,
+                   'updatedReplicas': updated, 'availableReplicas': available, 'conditions': conditions or []},
+    }
+
+
+def pod(manifests_hash, reason=None):
+    return {
+        'metadata': {'name': 'web-1234', 'annotations': {'dmake.deepomatic.com/manifests-hash': manifests_hash}},
+        'status': {'containerStatuses': [{'name': 'web', 'state': {'waiting': {'reason': reason}} if reason else {'running': {}}}]},
+    }
+
+
+class FakeApi(object):
+    """Mocked Kubernetes API: Deployments listed, then modified by timed watch events [(delay, resource)]"""
+    deployments = []
+    events = []
+    pods = []
+    # number of failing pods lists
+    pods_errors = 0
+
+    def __init__(self, context, namespace):
+        self.namespace = namespace or 'default'
+        self.selectors = []
+
+    def list(self, kind, label_selector):
+        self.selectors.append(label_selector)
+        if kind != 'Deployment':
+            return [], '1'
+        # list items have no kind
+        return [{key: value for key, value in d.items() if key != 'kind'} for d in FakeApi.deployments], '1'
+
+    def watch(self, kind, label_selector, resource_version, timeout):
+        if kind != 'Deployment':
+            time.sleep(timeout)
+            return
+        start = time.time()
+        for delay, resource in FakeApi.events:
+            time.sleep(max(0, start + delay - time.time()))
+            yield 'MODIFIED', resource
+        time.sleep(max(0, start + timeout - time.time()))
+
+    def list_pods(self, label_selector):
+        if FakeApi.pods_errors > 0:
+            FakeApi.pods_errors -= 1
+            raise KubernetesApiError("failed listing pods '%s': (503) Service Unavailable" % (label_selector))
+        return FakeApi.pods if label_selector == 'app=api' else []
+
+
+@pytest.fixture(autouse=True)
+def fake_api():
+    FakeApi.deployments = []
+    FakeApi.events = []
+    FakeApi.pods = []
+    FakeApi.pods_errors = 0
+
+
+def monitor(timeout=5):
+    targets = [('main', '', 'web'), ('main', '', 'api')]
+    return RolloutMonitor(targets, timeout, api_factory=FakeApi, check_interval=0.05, report_interval=60)
+
+
+def test_rollout_status():
+    assert get_rollout_status(deployment('web', 'web')) == (True, "successfully rolled out")
+    assert get_rollout_status(deployment('web', 'web', observed_generation=1)) == (False, "waiting for the rollout to start")
+    assert get_rollout_status(deployment('web', 'web', updated=1, available=1)) == (False, "1 out of 2 new replicas have been updated")
+    assert get_rollout_status(deployment('web', 'web', total=3)) == (False, "1 old replicas are pending termination")
+    statefulset = {'kind': 'StatefulSet', 'metadata': {'name': 'db', 'generation': 1}, 'spec': {'replicas': 2},
+                   'status': {'observedGeneration': 1, 'readyReplicas': 2, 'updatedReplicas': 1, 'currentRevision': 'db-1', 'updateRevision': 'db-2'}}
+    assert get_rollout_status(statefulset) == (False, "1 of 2 pods are updated")
+    daemonset = {'kind': 'DaemonSet', 'metadata': {'name': 'agent', 'generation': 1}, 'spec': {},
+                 'status': {'observedGeneration': 1, 'desiredNumberScheduled': 3, 'updatedNumberScheduled': 3, 'numberAvailable': 3}}
+    assert get_rollout_status(daemonset) == (True, "successfully rolled out")
+
+
+def test_concurrent_rollouts():
+    """rollouts are waited for concurrently: max(rollouts) instead of sum(rollouts)"""
+    FakeApi.deployments = [deployment('web', 'web', updated=0, available=0), deployment('api', 'api', updated=1, available=0)]
+    FakeApi.events = [(0.2, deployment('api', 'api', version=2)), (0.3, deployment('web', 'web', version=3))]
+    start = time.time()
+    rollout_monitor = monitor()
+    rollout_monitor.run()
+    assert time.time() - start < 1
+    assert sorted(key[3] for key in rollout_monitor.rollouts) == ['api', 'web']
+
+
+def test_stuck_rollout_fails_fast():
+    FakeApi.deployments = [deployment('web', 'web', updated=0, available=0), deployment('api', 'api', updated=1, available=0)]
+    FakeApi.events = [(0.1, deployment('api', 'api', updated=1, available=0, conditions=[
+        {'type': 'Progressing', 'status': 'False', 'reason': 'ProgressDeadlineExceeded', 'message': 'ReplicaSet "api-1234" has timed out progressing.'}]))]
+    start = time.time()
+    with pytest.raises(DMakeException, match='api Deployment/api: Deployment api exceeded its progress deadline'):
+        monitor().run()
+    assert time.time() - start < 1
+
+
+def test_crash_looping_rollout_fails_fast():
+    FakeApi.deployments = [deployment('api', 'api', updated=1, available=0)]
+    # old revision pods don't fail the rollout
+    FakeApi.pods = [pod('sha256:1', 'CrashLoopBackOff'), pod('sha256:2'), pod('sha256:2', 'ImagePullBackOff')]
+    with pytest.raises(DMakeException, match='api Deployment/api: pod web-1234 container web: ImagePullBackOff'):
+        monitor().run()
+
+
+def test_pods_list_errors_retried():
+    """a failing pods list is retried at the next check"""
+    FakeApi.deployments = [deployment('api', 'api', updated=1, available=0)]
+    FakeApi.pods = [pod('sha256:2', 'CrashLoopBackOff')]
+    FakeApi.pods_errors = 2
+    with pytest.raises(DMakeException, match='api Deployment/api: pod web-1234 container web: CrashLoopBackOff'):
+        monitor().run()
+    assert FakeApi.pods_errors == 0
+
+
+def test_invalid_context(monkeypatch, capsys):
+    """kubeconfig errors fail the monitor with a message, without traceback"""
+    kubernetes = pytest.importorskip('kubernetes')
+
+    def new_client_from_config(context=None, **kwargs):
+        raise kubernetes.config.ConfigException("Invalid kube-config file. No configuration found.")
+
+    monkeypatch.setattr(kubernetes.config, 'new_client_from_config', new_client_from_config)
+    assert main(['--target', 'missing', '', 'web']) == 1
+    assert "Rollout failed: Kubernetes context 'missing': Invalid kube-config file" in capsys.readouterr().out
+
+
+def test_deadline():
+    FakeApi.deployments = [deployment('web', 'web'), deployment('api', 'api', updated=1, available=1)]
+    start = time.time()
+    with pytest.raises(DMakeException, match='Rollouts not finished after 0 seconds'):
+        monitor(timeout=0.3).run()
+    assert time.time() - start < 1
+
+
+def test_generate_monitor(monkeypatch):
+    monkeypatch.setattr(common, 'kubernetes_rollout_timeout', 600, raising=False)
+    KubernetesRollouts.reset()
+    commands = []
+    KubernetesRollouts.generate_monitor(commands)
+    assert commands == []
+    KubernetesRollouts.register('main', '', 'web')
+    KubernetesRollouts.register('main', 'foobar', 'api')
+    KubernetesRollouts.generate_monitor(commands)
+    KubernetesRollouts.reset()
+    assert commands == [('sh', {'shell': 'dmake_k8s_rollout_monitor "--timeout" "600" "--target" "main" "" "web" "--target" "main" "foobar" "api"'})]
@@ -0,0 +1,147 @@
+import json
+
+import pytest
+
+import dmake.common as common
+import dmake.kubernetes_validation as kubernetes_validation
+from dmake.common import DMakeException
+from dmake.kubernetes_validation import Schema, get_bundled_schema, load_schema, validate_manifest_data, validate_manifests
+
+DEPLOYMENT = """
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: web
+  labels:
+    app: web
+spec:
+  replicas: 2
+  selector:
+    matchLabels:
+      app: web
+  template:
+    metadata:
+      labels:
+        app: web
+    spec:
+      containers:
+        - name: web
+          image: web:1.0
+          ports:
+            - containerPort: 8000
+          readinessProbe:
+            httpGet:
+              path: /
+              port: http
+"""
+
+OPENAPI = {
+    'definitions': {
+        'io.k8s.api.core.v1.ConfigMap': {
+            'type': 'object',
+            'properties': {
+                'apiVersion': {'type': 'string'},
+                'kind': {'type': 'string'},
+                'metadata': {'$ref': '#/definitions/io.k8s.apimachinery.pkg.apis.meta.v1.ObjectMeta'},
+                'data': {'type': 'object', 'additionalProperties': {'type': 'string'}},
+            },
+            'x-kubernetes-group-version-kind': [{'group': '', 'version': 'v1', 'kind': 'ConfigMap'}],
+        },
+        'io.k8s.apimachinery.pkg.apis.meta.v1.ObjectMeta': {
+            'type': 'object',
+            'properties': {'name': {'type': 'string'}, 'annotations': {'type': 'object', 'additionalProperties': {'type': 'string'}}},
+        },
+    }
+}
+
+
+def test_bundled_schema():
+    schema = get_bundled_schema()
+    assert validate_manifest_data(schema, DEPLOYMENT) == []
+    assert validate_manifest_data(schema, DEPLOYMENT.replace('replicas: 2', 'replicas: two')) == \
+        ["Deployment/web.spec.replicas: expected integer, got str"]
+    assert validate_manifest_data(schema, DEPLOYMENT.replace('image: web:1.0', 'imag: web:1.0')) == \
+        ["Deployment/web.spec.template.spec.containers[0]: unknown field 'imag'"]
+    assert validate_manifest_data(schema, DEPLOYMENT.replace('- name: web\n', '- nam: web\n')) == \
+        ["Deployment/web.spec.template.spec.containers[0]: missing required field 'name'",
+         "Deployment/web.spec.template.spec.containers[0]: unknown field 'nam'"]
+    # groups are matched on the client models prefix
+    ingress = "apiVersion: networking.k8s.io/v1beta1\nkind: Ingress\nmetadata:\n  name: web\nspec:\n  backend:\n    serviceName: web\n    servicePort: 80\n  foo: bar\n"
+    assert validate_manifest_data(schema, ingress) == ["Ingress/web.spec: unknown field 'foo'"]
+    # custom resources are not validated offline
+    assert validate_manifest_data(schema, "apiVersion: example.com/v1\nkind: Foo\nmetadata:\n  name: foo\nspec:\n  bar: 1\n") == []
+
+
+def test_openapi_schema():
+    schema = Schema.from_openapi(json.dumps(OPENAPI))
+    assert validate_manifest_data(schema, "apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: cm\ndata:\n  foo: bar\n---\n") == []
+    assert validate_manifest_data(schema, "apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: cm\ndata:\n  foo: 1\n") == \
+        ["ConfigMap/cm.data.foo: expected string, got int"]
+
+
+@pytest.fixture
+def kubectl(tmp_path, monkeypatch):
+    """Fake `kubectl get --raw /openapi/v2`, logging its calls"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (tmp_path / 'openapi.json').write_text(json.dumps(OPENAPI))
+    script = bin_dir / 'kubectl'
+    script.write_text('#!/bin/bash\necho "$@" >> %s\ncat %s\n' % (tmp_path / 'kubectl.log', tmp_path / 'openapi.json'))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:/usr/bin:/bin' % (bin_dir))
+    monkeypatch.setattr(common, 'config_dir', str(tmp_path / 'config'), raising=False)
+    monkeypatch.delenv('DMAKE_K8S_OPENAPI_SCHEMA', raising=False)
+    return tmp_path
+
+
+def get_kubectl_calls(tmp_path):
+    log_file = tmp_path / 'kubectl.log'
+    return log_file.read_text().splitlines() if log_file.exists() else []
+
+
+def test_load_schema_cache(kubectl):
+    schema = load_schema('main', now=0)
+    assert get_kubectl_calls(kubectl) == ['--context=main get --raw /openapi/v2']
+    assert load_schema('main').id == schema.id
+    assert len(get_kubectl_calls(kubectl)) == 1
+    # unreachable cluster: stale cache, then bundled schema
+    (kubectl / 'openapi.json').write_text('')
+    assert load_schema('main', now=1e12).id == schema.id
+    assert load_schema('other').id.startswith('kubernetes-client-')
+
+
+def test_validate_manifests(kubectl, monkeypatch):
+    valid = kubectl / 'valid.yaml'
+    valid.write_text("apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: ok\n")
+    invalid = kubectl / 'invalid.yaml'
+    invalid.write_text("apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: ko\n  foo: bar\n")
+    manifests = [('web', 'deploy/ok.yaml', str(valid), 'main'),
+                 ('api', 'deploy/ko.yaml', str(invalid), 'main')]
+    with pytest.raises(DMakeException) as e:
+        validate_manifests(manifests, live=False, pool_size=4)
+    assert str(e.value) == "api: Invalid Kubernetes manifest file deploy/ko.yaml (rendered template: %s): ConfigMap/ko.metadata: unknown field 'foo'" % (invalid)
+
+    # valid manifests are cached by content
+    validated = []
+    validate_manifest_data = kubernetes_validation.validate_manifest_data
+    monkeypatch.setattr(kubernetes_validation, 'validate_manifest_data', lambda schema, data: validated.append(data) or validate_manifest_data(schema, data))
+    validate_manifests(manifests[:1], live=False, pool_size=4)
+    assert validated == []
+    valid.write_text("apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: ok2\n")
+    validate_manifests(manifests[:1], live=False, pool_size=4)
+    assert len(validated) == 1
+
+
+def test_validate_manifests_cache_across_deployments(kubectl, monkeypatch):
+    """the deployment annotations (timestamp, git revision) do not invalidate the validation cache"""
+    manifest = kubectl / 'deploy.yaml'
+    content = "apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: ok\n  annotations:\n    dmake.deepomatic.com/deploy-timestamp: '%s'\n"
+    manifests = [('web', 'deploy/ok.yaml', str(manifest), 'main')]
+    validated = []
+    validate_manifest_data = kubernetes_validation.validate_manifest_data
+    monkeypatch.setattr(kubernetes_validation, 'validate_manifest_data', lambda schema, data: validated.append(data) or validate_manifest_data(schema, data))
+    manifest.write_text(content % '2020-01-01T00:00:00Z')
+    validate_manifests(manifests, live=False, pool_size=4)
+    manifest.write_text(content % '2020-01-02T00:00:00Z')
+    validate_manifests(manifests, live=False, pool_size=4)
+    assert len(validated) == 1
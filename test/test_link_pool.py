@@ -0,0 +1,107 @@
+import pytest
+
+import dmake.common as common
+import dmake.link_pool as link_pool
+from dmake.deepobuild import DockerLinkSerializer, LinkNames
+from dmake.link_pool import acquire, add, locked_pool, purge, release
+
+
+@pytest.fixture
+def docker(monkeypatch):
+    """Fake docker daemon: `running` containers, `removed` ones and `reset_failures`"""
+    state = {'running': set(), 'removed': [], 'reset': [], 'reset_failures': set()}
+
+    def fake_remove_container(container_id):
+        state['running'].discard(container_id)
+        state['removed'].append(container_id)
+
+    def fake_exec_in_container(container_id, command):
+        state['reset'].append((container_id, command))
+        return container_id not in state['reset_failures']
+
+    monkeypatch.setattr(link_pool, 'is_container_running', lambda container_id: container_id in state['running'])
+    monkeypatch.setattr(link_pool, 'remove_container', fake_remove_container)
+    monkeypatch.setattr(link_pool, 'exec_in_container', fake_exec_in_container)
+    return state
+
+
+@pytest.fixture
+def executions(tmp_path):
+    """tmp dirs of two concurrent dmake executions"""
+    dirs = []
+    for name in ['exec1', 'exec2']:
+        (tmp_path / name).mkdir()
+        dirs.append(str(tmp_path / name))
+    return dirs
+
+
+def test_acquire_release(docker, executions, tmp_path):
+    exec1, exec2 = executions
+    pool_file = str(tmp_path / 'link_pool.json')
+    docker['running'] = {'redis-1'}
+    with locked_pool(pool_file) as pool:
+        assert acquire(pool, 'key-redis', [], exec1, now=0) is None
+        add(pool, 'key-redis', 'redis-1', 'redis:5', 'redis', exec1, now=0)
+    with locked_pool(pool_file) as pool:
+        # in use by exec1
+        assert acquire(pool, 'key-redis', [], exec2, now=10) is None
+        release(pool, exec1, now=20)
+        assert acquire(pool, 'key-mongo', [], exec2, now=30) is None
+        assert acquire(pool, 'key-redis', ['redis-cli', 'flushall'], exec2, now=30) == 'redis-1'
+    assert docker['reset'] == [('redis-1', ['redis-cli', 'flushall'])]
+    with locked_pool(pool_file) as pool:
+        assert pool['redis-1']['in_use_by'] == exec2
+        assert pool['redis-1']['last_used'] == 30
+
+
+def test_acquire_reset_failure(docker, executions):
+    exec1, exec2 = executions
+    docker['running'] = {'redis-1'}
+    docker['reset_failures'] = {'redis-1'}
+    pool = {}
+    add(pool, 'key-redis', 'redis-1', 'redis:5', 'redis', exec1, now=0)
+    release(pool, exec1, now=0)
+    assert acquire(pool, 'key-redis', ['false'], exec2, now=10) is None
+    assert pool == {}
+    assert docker['removed'] == ['redis-1']
+
+
+def test_killed_execution_releases(docker, executions, tmp_path):
+    """containers of executions which did not clean up are considered idle"""
+    docker['running'] = {'redis-1'}
+    pool = {}
+    add(pool, 'key-redis', 'redis-1', 'redis:5', 'redis', str(tmp_path / 'killed'), now=0)
+    assert acquire(pool, 'key-redis', [], executions[0], now=10) == 'redis-1'
+
+
+def test_purge(docker, executions):
+    exec1, exec2 = executions
+    docker['running'] = {'idle-old', 'idle-1', 'idle-2', 'idle-3', 'in-use-old'}
+    pool = {}
+    add(pool, 'k', 'dead', 'redis:5', 'redis', None, now=0)
+    add(pool, 'k', 'idle-old', 'redis:5', 'redis', None, now=0)
+    add(pool, 'k', 'in-use-old', 'redis:5', 'redis', exec1, now=0)
+    for i in range(1, 4):
+        add(pool, 'k', 'idle-%d' % i, 'redis:5', 'redis', None, now=100 + i)
+    # dead, TTL expired, then least recently used idle above max size: in use containers are kept
+    assert purge(pool, now=200, idle_ttl=150, max_size=3) == ['dead', 'idle-old', 'idle-1']
+    assert sorted(pool.keys()) == ['idle-2', 'idle-3', 'in-use-old']
+    assert purge(pool, now=200, idle_ttl=-1, max_size=3) == ['idle-2', 'idle-3']
+    assert purge(pool, now=200, idle_ttl=-1, max_size=3, purge_all=True) == ['in-use-old']
+    assert pool == {}
+
+
+def test_link_pool_key(monkeypatch):
+    """links started the same way share the same pool key"""
+    monkeypatch.setattr(common, 'link_pool', True, raising=False)
+    LinkNames.reset()
+    link = DockerLinkSerializer()._validate_('test/worker/dmake.yml', [], {'image_name': 'redis:5', 'link_name': 'redis', 'pool_reset_command': ['redis-cli', 'flushall']})
+    prefix = link.get_link_pool_cmd_prefix('redis:5', {'A': '1'}, '')
+    assert prefix.startswith('DMAKE_LINK_POOL_KEY=')
+    assert prefix.endswith(""" DMAKE_LINK_POOL_RESET='["redis-cli", "flushall"]' """)
+    assert prefix == link.get_link_pool_cmd_prefix('redis:5', {'A': '1'}, '')
+    assert prefix != link.get_link_pool_cmd_prefix('redis:5', {'A': '2'}, '')
+    assert prefix != link.get_link_pool_cmd_prefix('redis:6', {'A': '1'}, '')
+    monkeypatch.setattr(common, 'link_pool', False)
+    assert link.get_link_pool_cmd_prefix('redis:5', {'A': '1'}, '') == ''
+    LinkNames.reset()
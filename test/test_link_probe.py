@@ -0,0 +1,129 @@
+import errno
+import socket
+import threading
+import time
+
+import pytest
+
+import dmake.link_probe as link_probe
+from dmake.link_probe import parse_probe_ports, wait_for_links, wait_for_targets
+
+
+def get_free_port(kind=socket.SOCK_STREAM):
+    s = socket.socket(socket.AF_INET, kind)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def listen_later(port, delay, kind=socket.SOCK_STREAM):
+    sockets = []
+
+    def listen():
+        time.sleep(delay)
+        s = socket.socket(socket.AF_INET, kind)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('127.0.0.1', port))
+        if kind == socket.SOCK_STREAM:
+            s.listen(5)
+        sockets.append(s)
+
+    thread = threading.Thread(target=listen)
+    thread.start()
+    return thread, sockets
+
+
+@pytest.mark.parametrize("probe_ports,expected", [
+    ('6379/tcp', [(6379, 'tcp')]),
+    ('53/udp,80/tcp', [(53, 'udp'), (80, 'tcp')]),
+    ('8000-8002/tcp', [(8000, 'tcp'), (8001, 'tcp'), (8002, 'tcp')]),
+    ('', []),
+])
+def test_parse_probe_ports(probe_ports, expected):
+    assert parse_probe_ports(probe_ports) == expected
+
+
+def test_wait_for_targets_concurrently():
+    """all targets are waited for concurrently, within a single deadline"""
+    ports = [get_free_port() for _ in range(4)]
+    listeners = [listen_later(port, 0.5) for port in ports]
+    start = time.time()
+    try:
+        assert wait_for_targets([('127.0.0.1', port, 'tcp') for port in ports], timeout=5) == []
+        assert time.time() - start < 2
+    finally:
+        for thread, sockets in listeners:
+            thread.join()
+            for s in sockets:
+                s.close()
+
+
+def test_wait_for_targets_deadline():
+    ready_port = get_free_port()
+    thread, sockets = listen_later(ready_port, 0)
+    thread.join()
+    closed_port = get_free_port()
+    start = time.time()
+    try:
+        assert wait_for_targets([('127.0.0.1', ready_port, 'tcp'), ('127.0.0.1', closed_port, 'tcp')], timeout=0.5) == [('127.0.0.1', closed_port, 'tcp')]
+        assert time.time() - start < 1.5
+    finally:
+        sockets[0].close()
+
+
+def test_wait_for_targets_udp():
+    open_port = get_free_port(socket.SOCK_DGRAM)
+    thread, sockets = listen_later(open_port, 0, socket.SOCK_DGRAM)
+    thread.join()
+    try:
+        assert wait_for_targets([('127.0.0.1', open_port, 'udp')], timeout=1) == []
+    finally:
+        sockets[0].close()
+
+
+@pytest.mark.parametrize('error', [ConnectionRefusedError(), OSError(errno.EHOSTUNREACH, 'No route to host')])
+def test_wait_for_targets_udp_refused(monkeypatch, error):
+    """a closed UDP port answers with ICMP port unreachable, reported as connection refused; any other ICMP error is not ready either"""
+    class RefusingProtocol(link_probe._UDPProbeProtocol):
+        def __init__(self):
+            super(RefusingProtocol, self).__init__()
+            self.error_received(error)
+
+    monkeypatch.setattr(link_probe, '_UDPProbeProtocol', RefusingProtocol)
+    port = get_free_port(socket.SOCK_DGRAM)
+    assert wait_for_targets([('127.0.0.1', port, 'udp')], timeout=0.3) == [('127.0.0.1', port, 'udp')]
+
+
+def test_wait_for_links(tmp_path, monkeypatch):
+    """links are probed on their container IP, once"""
+    port = get_free_port()
+    thread, sockets = listen_later(port, 0)
+    thread.join()
+    containers = {
+        'id-redis': {'Config': {'ExposedPorts': {'%d/tcp' % port: {}}}, 'NetworkSettings': {'Networks': {'bridge': {'IPAddress': '127.0.0.1'}}}},
+        'id-mongo': {'Config': {'ExposedPorts': {}}, 'NetworkSettings': {'Networks': {}, 'IPAddress': '127.0.0.1'}},
+    }
+    inspected = []
+
+    def fake_docker_inspect(container_ids):
+        inspected.extend(container_ids)
+        return [containers[container_id] for container_id in container_ids]
+
+    monkeypatch.setattr(link_probe, 'docker_inspect', fake_docker_inspect)
+    for link_name, probe_ports in [('redis', 'auto'), ('mongo', '%d/tcp' % port), ('minio', 'none')]:
+        (tmp_path / (link_name + '.id')).write_text('id-%s\n' % link_name)
+        (tmp_path / (link_name + '.probe')).write_text(probe_ports + '\n')
+    try:
+        assert wait_for_links(str(tmp_path), ['redis', 'mongo', 'minio'], 2, 'host') is None
+        assert inspected == ['id-redis', 'id-mongo']
+        assert (tmp_path / 'redis.ready').exists()
+        assert wait_for_links(str(tmp_path), ['redis', 'mongo', 'minio'], 2, 'host') is None
+        assert inspected == ['id-redis', 'id-mongo']
+    finally:
+        sockets[0].close()
+
+    (tmp_path / 'mongo.ready').unlink()
+    error = wait_for_links(str(tmp_path), ['mongo'], 0.3, 'host')
+    assert error == "Links not ready after 0.3 seconds: mongo:%d/tcp" % port
+    assert wait_for_links(str(tmp_path), ['mongo', 'kafka'], 0.3, 'host') == "Unexpected error: missing links: kafka"
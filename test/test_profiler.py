@@ -0,0 +1,39 @@
+import pstats
+import time
+
+import dmake.common as common
+from dmake.profiler import Profiler, get_command_prefix
+
+
+def test_command_prefix():
+    assert get_command_prefix('dmake_find . -name dmake.yml') == 'dmake_find'
+    assert get_command_prefix('git -C /repo rev-parse --abbrev-ref HEAD') == 'git rev-parse'
+    assert get_command_prefix('set -euo pipefail; source env.sh && echo "${FOO}"') == 'echo'
+    assert get_command_prefix('export IMAGE_NAME="web" && FOO=bar dmake_run_docker_daemon web') == 'dmake_run_docker_daemon'
+    assert get_command_prefix(['kubectl', '--context=main', 'get', '--raw', '/openapi/v2']) == 'kubectl get'
+
+
+def test_profile(tmp_path, caplog):
+    caplog.set_level('INFO', logger='dmake')
+    pstats_file = str(tmp_path / 'dmake.pstats')
+    Profiler.start(pstats_file=pstats_file)
+    Profiler.set_phase('command generation')
+    with Profiler.phase('validation'):
+        time.sleep(0.1)
+    for _ in range(2):
+        assert common.eval_str_in_env('${FOO}', {'FOO': 'bar'}) == 'bar'
+    common.run_shell_command('git --version')
+    Profiler.stop()
+    # already reported
+    Profiler.stop()
+
+    assert list(Profiler.phases) == ['init', 'command generation', 'validation', 'env evaluation']
+    assert Profiler.phases['env evaluation'][0] == 2
+    # the nested phases are not counted in the commands generation
+    assert Profiler.phases['validation'][1] >= 0.1
+    assert Profiler.phases['command generation'][1] < 0.1
+    assert {prefix: count for prefix, (count, _) in Profiler.subprocesses.items()} == {'echo': 2, 'git': 1}
+    assert caplog.messages[0].startswith('Plan generation profile: ')
+    assert len([m for m in caplog.messages if m.startswith('Plan generation profile')]) == 1
+    assert 'eval_str_in_env' in str(pstats.Stats(pstats_file).stats)
+    Profiler.reset()
@@ -0,0 +1,95 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+import dmake.common as common
+from dmake.core import generate_readiness_probes
+from dmake.deepobuild import ReadinessProbeSerializer
+
+
+def get_probe_cmd(command, **kwargs):
+    data = {'command': command}
+    data.update(kwargs)
+    return ReadinessProbeSerializer()._validate_('test/web/dmake.yml', [], data, 'readiness_probe').get_cmd()
+
+
+def counter_command(counter_file, ready_after):
+    """probe command succeeding from its `ready_after`-th run"""
+    script = counter_file + '.sh'
+    with open(script, 'w') as f:
+        f.write('echo >> %s\ntest $(wc -l < %s) -ge %d\n' % (counter_file, counter_file, ready_after))
+    return ['bash', script]
+
+
+def run_probe(cmd):
+    start = time.time()
+    returncode = subprocess.call(cmd, shell=True, stdout=subprocess.DEVNULL)
+    return returncode, time.time() - start
+
+
+def test_readiness_probe_fixed_period(tmp_path):
+    counter_file = str(tmp_path / 'counter')
+    returncode, duration = run_probe(get_probe_cmd(counter_command(counter_file, 2), period_seconds=1))
+    assert returncode == 0
+    assert 1 <= duration < 2
+
+
+def test_readiness_probe_integer_sleep():
+    """fixed periods are slept as integers, only the sub-second adaptive steps are fractional"""
+    cmd = get_probe_cmd(['true'], period_seconds=5)
+    assert 'sleep \\$((P/1000));' in cmd
+    assert 'printf' not in cmd
+    assert 'printf' in get_probe_cmd(['true'], period_seconds=5, adaptive_period=True)
+
+
+def test_readiness_probe_adaptive_period(tmp_path):
+    """0.25 + 0.5 + 1 seconds instead of 3 periods"""
+    counter_file = str(tmp_path / 'counter')
+    returncode, duration = run_probe(get_probe_cmd(counter_command(counter_file, 4), period_seconds=1, adaptive_period=True))
+    assert returncode == 0
+    assert 1.75 <= duration < 2.75
+
+
+def test_readiness_probe_max_seconds(tmp_path):
+    counter_file = str(tmp_path / 'counter')
+    returncode, _ = run_probe(get_probe_cmd(counter_command(counter_file, 100), period_seconds=1, max_seconds=1, adaptive_period=True))
+    assert returncode == 1
+    # probes at 0, 0.25 and 0.75 seconds: the next one would be after max_seconds
+    with open(counter_file) as f:
+        assert len(f.readlines()) == 3
+
+
+@pytest.fixture
+def fake_exec_docker(tmp_path, monkeypatch):
+    """dmake_exec_docker running the probe command on the host"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    exec_docker = bin_dir / 'dmake_exec_docker'
+    exec_docker.write_text('#!/bin/bash\nshift\nexec "$@"\n')
+    exec_docker.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+    monkeypatch.setattr(common, 'tmp_dir', str(tmp_path), raising=False)
+
+
+def test_grouped_readiness_probes(tmp_path, fake_exec_docker):
+    """daemons started together are probed concurrently: the slowest one sets the total duration"""
+    probes = [('app/web-%d' % i, 'container-%d' % i, get_probe_cmd(['sleep', '1'])) for i in range(4)]
+    commands = []
+    generate_readiness_probes(commands, probes)
+    assert [cmd for cmd, _ in commands] == ['echo', 'sh']
+    start = time.time()
+    output = subprocess.check_output(commands[1][1]['shell'], shell=True, universal_newlines=True)
+    assert time.time() - start < 2
+    assert '[app/web-3] ... ready' in output
+
+
+def test_grouped_readiness_probes_failure(tmp_path, fake_exec_docker):
+    probes = [('app/ok', 'container-ok', get_probe_cmd(['true'])),
+              ('app/ko', 'container-ko', get_probe_cmd(['false'], period_seconds=1, max_seconds=1))]
+    commands = []
+    generate_readiness_probes(commands, probes)
+    process = subprocess.run(commands[1][1]['shell'], shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+    assert process.returncode == 1
+    assert 'Readiness probe failed for: app/ko' in process.stdout
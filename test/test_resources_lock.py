@@ -0,0 +1,82 @@
+import os
+import subprocess
+
+import dmake.common as common
+import dmake.resources_lock as resources_lock
+from dmake.core import generate_command_bash, generate_resources_locks
+from dmake.deepobuild import ResourcesSerializer
+from dmake.resources_lock import locked_state, release, try_acquire
+
+
+def get_dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+def test_try_acquire_release(tmp_path):
+    state_file = str(tmp_path / 'resources_lock.json')
+    pid = os.getpid()
+    with locked_state(state_file) as state:
+        assert try_acquire(state, 'PARALLEL_BUILDERS', 6, pid, capacity=8)
+        # other labels are counted apart
+        assert try_acquire(state, 'PARALLEL_BUILDERS_MEMORY', 8, pid, capacity=8)
+        assert not try_acquire(state, 'PARALLEL_BUILDERS', 3, pid, capacity=8)
+        assert try_acquire(state, 'PARALLEL_BUILDERS', 2, pid, capacity=8)
+    with locked_state(state_file) as state:
+        release(state, 'PARALLEL_BUILDERS', pid)
+        assert [(entry['label'], entry['quantity']) for entry in state] == [('PARALLEL_BUILDERS', 6), ('PARALLEL_BUILDERS_MEMORY', 8)]
+
+
+def test_try_acquire_oversized():
+    """a quantity above capacity is capped: it runs alone"""
+    pid = os.getpid()
+    state = []
+    assert try_acquire(state, 'PARALLEL_BUILDERS', 32, pid, capacity=8)
+    assert state == [{'label': 'PARALLEL_BUILDERS', 'quantity': 8, 'pid': pid}]
+    assert not try_acquire(state, 'PARALLEL_BUILDERS', 1, pid, capacity=8)
+
+
+def test_dead_execution_releases():
+    state = [{'label': 'PARALLEL_BUILDERS', 'quantity': 8, 'pid': get_dead_pid()}]
+    assert try_acquire(state, 'PARALLEL_BUILDERS', 8, os.getpid(), capacity=8)
+    assert len(state) == 1
+
+
+def test_capacity(monkeypatch):
+    monkeypatch.setenv('DMAKE_PARALLEL_BUILDERS_CAPACITY', '3')
+    assert resources_lock.get_capacity('PARALLEL_BUILDERS') == 3
+    monkeypatch.delenv('DMAKE_PARALLEL_BUILDERS_MEMORY_CAPACITY', raising=False)
+    assert resources_lock.get_capacity('PARALLEL_BUILDERS_MEMORY') >= 1
+
+
+def test_resources_locks(monkeypatch):
+    monkeypatch.setattr(common, 'parallel_builders_capacity', {'PARALLEL_BUILDERS': 16}, raising=False)
+    resources = ResourcesSerializer()._validate_('test/web/dmake.yml', [], {'cpu': 8, 'memory': 4})
+    commands = []
+    assert generate_resources_locks(commands, resources.get_units(factor=3)) == 2
+    assert commands == [('lock', {'label': 'PARALLEL_BUILDERS', 'quantity': 16}),
+                        ('lock', {'label': 'PARALLEL_BUILDERS_MEMORY', 'quantity': 12})]
+    # default: one PARALLEL_BUILDERS unit, no memory lock
+    commands = []
+    assert generate_resources_locks(commands, ResourcesSerializer()._validate_('test/web/dmake.yml', [], {}).get_units()) == 1
+    assert commands == [('lock', {'label': 'PARALLEL_BUILDERS', 'quantity': 1})]
+
+
+def test_bash_runtime_locks(tmp_path, monkeypatch):
+    """with bash, only the parallel builders resources are locked"""
+    monkeypatch.setattr(common, 'parallel_execution', False, raising=False)
+    monkeypatch.setattr(common, 'execution_trace', False)
+    commands = []
+    common.append_command(commands, 'lock', label='GPUS', quantity=1, variable='DMAKE_GPU')
+    common.append_command(commands, 'lock', label='PARALLEL_BUILDERS', quantity=4)
+    common.append_command(commands, 'sh', shell='echo build')
+    common.append_command(commands, 'lock_end')
+    common.append_command(commands, 'lock_end')
+    dmakefile = tmp_path / 'DMakefile'
+    with open(str(dmakefile), 'w') as f:
+        generate_command_bash(f, commands)
+    lines = [line.strip() for line in dmakefile.read_text().splitlines()]
+    start = lines.index('dmake_resources_lock acquire PARALLEL_BUILDERS 4 $$')
+    assert lines[start + 1:start + 3] == ['echo build', 'dmake_resources_lock release PARALLEL_BUILDERS $$']
+    assert not any('GPUS' in line for line in lines)
@@ -0,0 +1,132 @@
+import io
+import os
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import dmake.common as common
+import dmake.deepobuild as deepobuild
+from dmake.common import append_command
+from dmake.core import generate_command_bash, generate_command_pipeline, make_path_unique_per_variant
+from dmake.junit import merge_reports
+from dmake.serializer import ValidationError
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS_DIR = os.path.join(ROOT_DIR, 'dmake', 'utils')
+
+
+def get_tests(**kwargs):
+    data = {'commands': ['pytest'], 'junit_report': 'reports/junit.xml'}
+    data.update(kwargs)
+    return deepobuild.TestSerializer()._validate_('test/web/dmake.yml', [], data)
+
+
+def write_junit(path, name, tests, failures=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('<testsuite name="%s" tests="%d" failures="%d" time="1.5"><testcase name="t"/></testsuite>' % (name, tests, failures))
+
+
+def test_make_path_unique():
+    assert make_path_unique_per_variant('reports/junit.xml', 'app/web') == 'reports/junit.xml'
+    assert make_path_unique_per_variant('reports/junit.xml', 'app/web:v1') == 'reports/v1-junit.xml'
+    assert make_path_unique_per_variant('reports/junit.xml', 'app/web:v1', shard=2) == 'reports/v1-shard-2-junit.xml'
+
+
+def test_merge_reports(tmp_path):
+    write_junit(str(tmp_path / 'shard-0.xml'), 'a', 3, 1)
+    write_junit(str(tmp_path / 'shard-1.xml'), 'b', 2)
+    output = str(tmp_path / 'merged' / 'junit.xml')
+    missing = merge_reports([str(tmp_path / 'shard-0.xml'), str(tmp_path / 'shard-1.xml'), str(tmp_path / 'shard-2.xml')], output)
+    assert missing == [str(tmp_path / 'shard-2.xml')]
+    root = ET.parse(output).getroot()
+    assert root.tag == 'testsuites'
+    assert [suite.get('name') for suite in root] == ['a', 'b']
+    assert (root.get('tests'), root.get('failures'), root.get('time')) == ('5', '1', '3.000')
+    with pytest.raises(common.DMakeException):
+        merge_reports([str(tmp_path / 'missing.xml')], output)
+
+
+def test_generate_shards_commands():
+    tests = get_tests(shards=3, cobertura_report='coverage.xml')
+    assert tests.get_shards() == [0, 1, 2]
+    assert get_tests().get_shards() == [None]
+    with pytest.raises(ValidationError, match="Invalid tests `shards` 0"):
+        get_tests(shards=0)
+    commands = []
+    tests.generate_test(commands, 'web', 'app/web', {shard: [('sh', {'shell': 'run %d' % shard})] for shard in range(3)}, '/app')
+    names = [cmd for cmd, _ in commands]
+    assert names[:12] == ['try', 'parallel',
+                          'parallel_branch', 'sh', 'parallel_branch_end',
+                          'parallel_branch', 'sh', 'parallel_branch_end',
+                          'parallel_branch', 'sh', 'parallel_branch_end',
+                          'parallel_end']
+    assert commands[1][1] == {'background': True}
+    assert commands[8][1]['name'] == 'shard 3/3'
+    # one merged junit report, one coverage report per shard
+    collection = [kwargs['reports'] for cmd, kwargs in commands if cmd == 'tests_results']
+    assert collection[0] == collection[1]
+    assert [kwargs.get('shards', kwargs.get('shard')) for _, kwargs in collection[1]] == [[0, 1, 2], 0, 1, 2]
+
+
+def test_pipeline_merged_junit(monkeypatch):
+    monkeypatch.setattr(common, 'build_description', None, raising=False)
+    monkeypatch.setattr(common, 'relative_cache_dir', '.dmake', raising=False)
+    reports = []
+    append_command(reports, 'junit', report='web/reports/junit.xml', service_name='app/web', mount_point='/app', shards=[0, 1])
+    commands = []
+    append_command(commands, 'tests_results', reports=reports)
+    file = io.StringIO()
+    generate_command_pipeline(file, commands)
+    pipeline = file.getvalue()
+    assert 'dmake_collect_tests_results "app/web.shard-0" "/app/web/reports/junit.xml"' in pipeline
+    assert '"app/web.shard-1" "/app/web/reports/junit.xml"' in pipeline
+    assert pipeline.count("junit keepLongStdio: true") == 1
+
+
+def test_bash_runs_shards_in_parallel(monkeypatch, tmp_path):
+    """shards run as background jobs by the local runtime; their junit reports are merged"""
+    monkeypatch.setattr(common, 'parallel_execution', False, raising=False)
+    monkeypatch.setattr(common, 'execution_trace', False)
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    # fake test results collector: the shards reports are in the `containers` dir
+    collect_results = bin_dir / 'dmake_collect_tests_results'
+    collect_results.write_text('#!/bin/bash\nwhile [ $# -gt 0 ]; do mkdir -p $(dirname "$3"); cp "%s/$1$2" "$3"; shift 3; done\n' % (tmp_path / 'containers'))
+    collect_results.chmod(0o755)
+    for shard in range(3):
+        write_junit(str(tmp_path / 'containers' / ('app/web.shard-%d' % shard) / 'app/web/reports/junit.xml'), 'shard-%d' % shard, 1)
+
+    tests = get_tests(shards=3)
+    commands = []
+    tests.generate_test(commands, 'web', 'app/web', {shard: [('sh', {'shell': 'sleep 1'})] for shard in range(3)}, '/app')
+    script = tmp_path / 'script.sh'
+    with open(str(script), 'w') as f:
+        generate_command_bash(f, commands)
+    env = dict(os.environ, PATH='%s:%s:%s' % (bin_dir, UTILS_DIR, os.environ['PATH']), PYTHONPATH=ROOT_DIR)
+    start = time.time()
+    subprocess.check_call(['bash', str(script)], cwd=str(tmp_path), env=env, stdout=subprocess.DEVNULL)
+    assert time.time() - start < 2.5
+    root = ET.parse(str(tmp_path / 'web/reports/junit.xml')).getroot()
+    assert [suite.get('name') for suite in root] == ['shard-0', 'shard-1', 'shard-2']
+    assert not os.path.exists(str(tmp_path / 'web/reports/shard-0-junit.xml'))
+
+
+def test_bash_shard_failure(monkeypatch, tmp_path):
+    monkeypatch.setattr(common, 'parallel_execution', False, raising=False)
+    monkeypatch.setattr(common, 'execution_trace', False)
+    commands = []
+    append_command(commands, 'parallel', background=True)
+    for shard in range(2):
+        append_command(commands, 'parallel_branch', name='shard %d' % shard)
+        append_command(commands, 'sh', shell='exit %d' % shard)
+        append_command(commands, 'parallel_branch_end')
+    append_command(commands, 'parallel_end')
+    append_command(commands, 'sh', shell='touch %s' % (tmp_path / 'not_reached'))
+    script = tmp_path / 'script.sh'
+    with open(str(script), 'w') as f:
+        generate_command_bash(f, commands)
+    assert subprocess.call(['bash', str(script)], stdout=subprocess.DEVNULL) != 0
+    assert not os.path.exists(str(tmp_path / 'not_reached'))
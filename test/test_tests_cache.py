@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import dmake.common as common
+import dmake.tests_cache as tests_cache
+import dmake.deepobuild as deepobuild
+from dmake.tests_cache import compute_fingerprint, lookup, parse_links, read_inputs, store
+
+UTILS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dmake', 'utils')
+
+
+@pytest.fixture
+def docker(monkeypatch, tmp_path):
+    """Fake docker daemon: `images` and `containers` IDs, `files` of the containers filesystems"""
+    state = {'images': {'app:1': 'sha256:app1', 'redis:5': 'sha256:redis5'},
+             'containers': {'link-redis': 'sha256:redis5'},
+             'root': tmp_path / 'containers'}
+
+    def fake_docker_cp(container_id, src_path, dest_path):
+        src = str(state['root'] / container_id) + src_path
+        if not os.path.exists(src):
+            return False
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(dest_path, os.path.basename(src)))
+        else:
+            shutil.copy(src, dest_path)
+        return True
+
+    monkeypatch.setattr(tests_cache, 'get_image_id', lambda image_name: state['images'].get(image_name))
+    monkeypatch.setattr(tests_cache, 'get_container_image_id', lambda container: state['containers'].get(container))
+    monkeypatch.setattr(tests_cache, 'docker_cp', fake_docker_cp)
+    return state
+
+
+def make_inputs(**kwargs):
+    inputs = {'service_name': 'app/web', 'image_name': 'app:1', 'commands': ['pytest'], 'env': {'A': '1'},
+              'data_volumes': [], 'reports': ['/app/web/reports/junit.xml', '/app/web/htmlcov']}
+    inputs.update(kwargs)
+    return inputs
+
+
+def test_parse_links():
+    assert parse_links(['-p', '80', '--link', 'c1:redis', '--link=c2', '-i', 'app:1']) == [('c1', 'redis'), ('c2', 'c2')]
+
+
+def test_fingerprint(docker, tmp_path):
+    args = ['--link', 'link-redis:redis', '-i', 'app:1', 'pytest']
+    fingerprint = compute_fingerprint(make_inputs(), args)
+    assert fingerprint == compute_fingerprint(make_inputs(), args)
+    assert fingerprint != compute_fingerprint(make_inputs(commands=['pytest -x']), args)
+    assert fingerprint != compute_fingerprint(make_inputs(env={'A': '2'}), args)
+    assert fingerprint != compute_fingerprint(make_inputs(), ['-i', 'app:1', 'pytest'])
+    # rebuilt image, relinked service with a new image
+    docker['images']['app:1'] = 'sha256:app1-bis'
+    assert fingerprint != compute_fingerprint(make_inputs(), args)
+    docker['images']['app:1'] = 'sha256:app1'
+    docker['containers']['link-redis'] = 'sha256:redis6'
+    assert fingerprint != compute_fingerprint(make_inputs(), args)
+    # unresolvable images: no caching
+    assert compute_fingerprint(make_inputs(image_name='missing:1'), args) is None
+
+
+def test_fingerprint_data_volumes(docker, tmp_path):
+    """synced data volumes are fingerprinted by their manifest"""
+    volume = tmp_path / 'volume'
+    volume.mkdir()
+    inputs = make_inputs(data_volumes=[['s3://bucket/data', str(volume)]])
+    fingerprint = compute_fingerprint(inputs, [])
+    (tmp_path / 'volume.dmake_manifest.json').write_text(json.dumps({'source': 's3://bucket/data', 'synced_at': 0, 'objects': {'a': 'etag1'}}))
+    assert compute_fingerprint(inputs, []) != fingerprint
+    fingerprint = compute_fingerprint(inputs, [])
+    (tmp_path / 'volume.dmake_manifest.json').write_text(json.dumps({'source': 's3://bucket/data', 'synced_at': 10, 'objects': {'a': 'etag1'}}))
+    assert compute_fingerprint(inputs, []) == fingerprint
+
+
+def test_fingerprint_host_data_volumes(docker, tmp_path):
+    """host path data volumes are fingerprinted by their files"""
+    volume = tmp_path / 'volume'
+    (volume / 'sub').mkdir(parents=True)
+    (volume / 'sub' / 'a.csv').write_text('1,2')
+    inputs = make_inputs(data_volumes=[[str(volume), str(volume)]])
+    fingerprint = compute_fingerprint(inputs, [])
+    assert compute_fingerprint(inputs, []) == fingerprint
+    (volume / 'sub' / 'a.csv').write_text('1,2,3')
+    assert compute_fingerprint(inputs, []) != fingerprint
+    fingerprint = compute_fingerprint(inputs, [])
+    os.utime(str(volume / 'sub' / 'a.csv'), ns=(0, 0))
+    assert compute_fingerprint(inputs, []) != fingerprint
+    fingerprint = compute_fingerprint(inputs, [])
+    (volume / 'b.csv').write_text('')
+    assert compute_fingerprint(inputs, []) != fingerprint
+
+
+def test_store_lookup(docker, tmp_path):
+    store_dir = str(tmp_path / 'store')
+    container = docker['root'] / 'container-1'
+    (container / 'app/web/reports').mkdir(parents=True)
+    (container / 'app/web/reports/junit.xml').write_text('<testsuite/>')
+    assert lookup(store_dir, 'f00d') is None
+    # the HTML report is missing: the other reports are cached anyway
+    assert store(store_dir, 'f00d', make_inputs(), 'container-1', now=0) == ['/app/web/htmlcov']
+    artifacts_dir = lookup(store_dir, 'f00d')
+    with open(os.path.join(artifacts_dir, 'app/web/reports/junit.xml')) as f:
+        assert f.read() == '<testsuite/>'
+    assert os.listdir(os.path.join(store_dir, 'f0')) == ['f00d']
+
+
+def test_replay_cached_results(tmp_path):
+    """test results are copied from the cache when the tests were not run"""
+    artifacts_dir = tmp_path / 'store' / 'artifacts'
+    (artifacts_dir / 'app/web/reports').mkdir(parents=True)
+    (artifacts_dir / 'app/web/reports/junit.xml').write_text('<testsuite/>')
+    dmake_tmp_dir = tmp_path / 'dmake_tmp'
+    dmake_tmp_dir.mkdir()
+    (dmake_tmp_dir / 'test_ids.txt').write_text('cache:%s app/web\n' % artifacts_dir)
+    env = dict(os.environ, DMAKE_TMP_DIR=str(dmake_tmp_dir), PYTHONPATH=os.path.dirname(os.path.dirname(UTILS_DIR)))
+    dest = tmp_path / 'results' / 'junit.xml'
+    subprocess.check_call([os.path.join(UTILS_DIR, 'dmake_collect_tests_results'), 'app/web', '/app/web/reports/junit.xml', str(dest)], env=env, stdout=subprocess.DEVNULL)
+    assert dest.read_text() == '<testsuite/>'
+
+
+def test_cache_inputs(monkeypatch, tmp_path):
+    monkeypatch.setattr(common, 'tmp_dir', str(tmp_path), raising=False)
+    tests = deepobuild.TestSerializer()._validate_('test/web/dmake.yml', [], {'commands': ['pytest'], 'junit_report': 'reports/junit.xml',
+                                                                   'html_report': {'directory': 'htmlcov'}})
+    monkeypatch.setattr(common, 'test_cache', False, raising=False)
+    assert tests.get_test_cache_cmd_prefix('app/web', 'web', 'app:1', {'A': '1'}, '/app') == ''
+    monkeypatch.setattr(common, 'test_cache', True)
+    prefix = tests.get_test_cache_cmd_prefix('app/web', 'web', 'app:1', {'A': '1'}, '/app')
+    assert prefix.startswith('DMAKE_TEST_CACHE_INPUTS=')
+    inputs = read_inputs(prefix.strip().split('=', 1)[1])
+    assert inputs['reports'] == ['/app/web/reports/junit.xml', '/app/web/htmlcov']
+    assert inputs['env'] == {'A': '1'}
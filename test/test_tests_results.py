@@ -0,0 +1,161 @@
+import io
+import os
+import socketserver
+import subprocess
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import dmake.common as common
+import dmake.deepobuild as deepobuild
+from dmake.core import generate_command_bash
+from dmake.docker_engine import DockerCLI, DockerEngine
+import dmake.tests_results as tests_results
+from dmake.tests_results import collect
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS_DIR = os.path.join(ROOT_DIR, 'dmake', 'utils')
+
+
+class FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Fake Docker Engine API serving the containers archives from the `root` dir: one sub-directory per container"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, root):
+        super(FakeEngine, self).__init__(socket_path, FakeEngineHandler)
+        self.root = root
+        self.requests = []
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'fake'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.split('/')
+        if len(parts) != 4 or parts[3] != 'archive':
+            return self.send_body(404, b'{"message": "page not found"}')
+        container_id = parts[2]
+        path = parse_qs(url.query)['path'][0]
+        self.server.requests.append((container_id, path))
+        local_path = os.path.join(self.server.root, container_id) + path
+        if not os.path.exists(local_path):
+            return self.send_body(404, b'{"message": "Could not find the file"}')
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.add(local_path, arcname=os.path.basename(path.rstrip('/')))
+        self.send_body(200, archive.getvalue())
+
+
+@pytest.fixture
+def containers(tmp_path):
+    """stand-in containers filesystems, served by a fake Docker Engine"""
+    root = tmp_path / 'containers'
+    root.mkdir()
+    socket_path = str(tmp_path / 'docker.sock')
+    server = FakeEngine(socket_path, str(root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield root, server, socket_path
+    server.shutdown()
+    server.server_close()
+
+
+def write_file(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_collect(containers, tmp_path):
+    root, server, socket_path = containers
+    write_file(root / 'c1' / 'app/web/reports/junit.xml', '<testsuite/>')
+    write_file(root / 'c1' / 'app/web/htmlcov/index.html', 'index')
+    write_file(root / 'c1' / 'app/web/htmlcov/js/app.js', 'js')
+    entries = [('app/web', '/app/web/reports/junit.xml', str(tmp_path / 'out/web-junit.xml')),
+               ('app/web', '/app/web/coverage.xml', str(tmp_path / 'out/coverage.xml')),
+               ('app/web', '/app/web/htmlcov', str(tmp_path / 'out/htmlcov'))]
+    missing = collect(DockerEngine(socket_path), {'app/web': 'c1'}, entries)
+    assert missing == [entries[1]]
+    # the files are extracted at their host path, even if their name differs
+    assert (tmp_path / 'out/web-junit.xml').read_text() == '<testsuite/>'
+    assert (tmp_path / 'out/htmlcov/js/app.js').read_text() == 'js'
+    assert len(server.requests) == 3
+
+
+def test_collect_unknown_test_run(containers):
+    _, _, socket_path = containers
+    with pytest.raises(common.DMakeException):
+        collect(DockerEngine(socket_path), {}, [('app/web', '/app/web/junit.xml', 'junit.xml')])
+
+
+def generate_test_script(tmp_path, tests_exit_code):
+    """local runtime script of a test run, with the test container replaced by its test_ids.txt registration"""
+    tests = deepobuild.TestSerializer()._validate_('test/web/dmake.yml', [], {
+        'commands': ['pytest'], 'junit_report': 'reports/junit.xml', 'cobertura_report': 'reports/coverage.xml',
+        'html_report': {'directory': 'htmlcov'}})
+    run_tests = 'echo "c1 app/web" >> ${DMAKE_TMP_DIR}/test_ids.txt; exit %d' % tests_exit_code
+    commands = []
+    tests.generate_test(commands, 'web', 'app/web', {None: [('sh', {'shell': run_tests})]}, '/app')
+    script = tmp_path / 'script.sh'
+    with open(str(script), 'w') as f:
+        generate_command_bash(f, commands)
+    return str(script)
+
+
+@pytest.mark.parametrize('tests_exit_code', [0, 1])
+def test_local_runtime_collection(containers, tmp_path, monkeypatch, tests_exit_code):
+    """all the results are collected in one call; after a tests failure, missing ones are tolerated"""
+    root, server, socket_path = containers
+    monkeypatch.setattr(common, 'parallel_execution', False, raising=False)
+    monkeypatch.setattr(common, 'execution_trace', False)
+    write_file(root / 'c1' / 'app/web/reports/junit.xml', '<testsuite/>')
+    write_file(root / 'c1' / 'app/web/htmlcov/index.html', 'index')
+    (tmp_path / 'dmake_tmp').mkdir()
+    workspace = tmp_path / 'workspace'
+    workspace.mkdir()
+    env = dict(os.environ, DMAKE_TMP_DIR=str(tmp_path / 'dmake_tmp'), DOCKER_HOST='unix://' + socket_path,
+               PATH='%s:%s' % (UTILS_DIR, os.environ['PATH']), PYTHONPATH=ROOT_DIR)
+    process = subprocess.run(['bash', generate_test_script(tmp_path, tests_exit_code)], cwd=str(workspace), env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    # the coverage report is missing: error after a tests success, ignored after a tests failure
+    assert process.returncode == 1
+    assert (workspace / 'web/reports/junit.xml').read_text() == '<testsuite/>'
+    assert (workspace / 'web/htmlcov/index.html').read_text() == 'index'
+    assert "Missing tests results for 'app/web': '/app/web/reports/coverage.xml'" in process.stdout
+    if tests_exit_code:
+        assert 'finished trying to collect existing test results' in process.stdout
+    assert sorted(set(server.requests)) == [('c1', '/app/web/htmlcov'), ('c1', '/app/web/reports/coverage.xml'), ('c1', '/app/web/reports/junit.xml')]
+
+
+def test_collect_docker_cli_fallback(tmp_path, monkeypatch):
+    """without Engine API socket, archives are streamed by `docker cp CONTAINER:PATH -`"""
+    root = tmp_path / 'containers'
+    write_file(root / 'c1' / 'app/web/reports/junit.xml', '<testsuite/>')
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    docker = bin_dir / 'docker'
+    docker.write_text('#!/bin/bash\nCONTAINER=${2%%:*}\nSRC=${2#*:}\nP="%s/${CONTAINER}${SRC}"\n'
+                      'test -e "$P" || exit 1\ntar -C "$(dirname "$P")" -cf - "$(basename "$P")"\n' % root)
+    docker.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+    monkeypatch.setenv('DOCKER_HOST', 'tcp://docker:2375')
+    engine = tests_results.get_engine()
+    assert isinstance(engine, DockerCLI)
+    entries = [('app/web', '/app/web/reports/junit.xml', str(tmp_path / 'out/junit.xml')),
+               ('app/web', '/app/web/missing.xml', str(tmp_path / 'out/missing.xml'))]
+    assert collect(engine, {'app/web': 'c1'}, entries) == [entries[1]]
+    assert (tmp_path / 'out/junit.xml').read_text() == '<testsuite/>'
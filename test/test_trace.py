@@ -0,0 +1,139 @@
+import io
+import json
+import os
+import subprocess
+
+import dmake.common as common
+from dmake.common import append_command
+from dmake.core import generate_command_bash, generate_command_pipeline
+from dmake.trace import get_trace, load_events, main
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS_DIR = os.path.join(ROOT_DIR, 'dmake', 'utils')
+
+
+def event(ts, phase, name, track='main', category='command'):
+    return {'ts': ts, 'ph': phase, 'cat': category, 'tid': track, 'name': name}
+
+
+def get_slices(trace):
+    """Return: {track name: [(name, begin, end, unfinished)]}"""
+    tracks = {e['tid']: e['args']['name'] for e in trace['traceEvents'] if e['name'] == 'thread_name'}
+    slices = {}
+    stacks = {}
+    for e in trace['traceEvents']:
+        if e['ph'] == 'B':
+            stacks.setdefault(e['tid'], []).append(e)
+        elif e['ph'] == 'E':
+            begin = stacks[e['tid']].pop()
+            assert begin['name'] == e['name']
+            slices.setdefault(tracks[e['tid']], []).append((e['name'], begin['ts'], e['ts'], 'args' in e))
+    return slices
+
+
+def test_get_trace():
+    events = [
+        event(0, 'B', 'deploy @ web', category='node'),
+        event(1, 'B', 'lock PARALLEL_BUILDERS x1', track='build', category='lock'),
+        event(2, 'E', 'lock PARALLEL_BUILDERS x1', track='build', category='lock'),
+        event(3, 'B', 'false'),
+        # the failed command is caught by its node
+        event(4, 'E', 'deploy @ web', category='node'),
+        event(5, 'B', 'dmake_build_docker', track='build'),
+        event(6, 'E', 'unknown'),
+    ]
+    slices = get_slices(get_trace(events))
+    assert slices == {
+        'main': [('false', 3, 4, True), ('deploy @ web', 0, 4, False)],
+        'build': [('lock PARALLEL_BUILDERS x1', 1, 2, False), ('dmake_build_docker', 5, 6, True)],
+    }
+    # lines truncated by a killed runtime
+    assert load_events(['{"ts": 1, "ph": "B", "name": "sleep"}', '{"ts": 2, "ph": "E", "na']) == [{'ts': 1, 'ph': 'B', 'name': 'sleep'}]
+
+
+def test_bash_trace(tmp_path, monkeypatch):
+    """the parallel branches are traced on their own tracks, also after a failure"""
+    monkeypatch.setattr(common, 'parallel_execution', False, raising=False)
+    monkeypatch.setattr(common, 'execution_trace', True)
+    monkeypatch.setattr(common, 'cache_dir', str(tmp_path / '.dmake'), raising=False)
+    commands = []
+    append_command(commands, 'stage', name='height 0')
+    append_command(commands, 'parallel', background=True)
+    for name in ["web", "it's api"]:
+        append_command(commands, 'parallel_branch', name=name)
+        append_command(commands, 'trace_begin', name=name, category='node')
+        append_command(commands, 'sh', shell='sleep 0.2')
+        append_command(commands, 'trace_end', name=name, category='node')
+        append_command(commands, 'parallel_branch_end')
+    append_command(commands, 'parallel_end')
+    append_command(commands, 'sh', shell='false')
+    append_command(commands, 'stage_end')
+    script = tmp_path / 'script.sh'
+    with open(str(script), 'w') as f:
+        generate_command_bash(f, commands)
+    env = dict(os.environ, PATH='%s:%s' % (UTILS_DIR, os.environ['PATH']), PYTHONPATH=ROOT_DIR)
+    assert subprocess.call(['bash', str(script)], env=env) == 1
+
+    with open(str(tmp_path / '.dmake' / 'trace.json')) as f:
+        slices = get_slices(json.load(f))
+    assert sorted(slices) == ["it's api", 'main', 'web']
+    assert [name for name, _, _, _ in slices['web']] == ['sleep 0.2', 'web']
+    (_, web_begin, web_end, _), (_, api_begin, api_end, _) = slices['web'][-1], slices["it's api"][-1]
+    # microseconds
+    assert web_end - web_begin >= 200000
+    assert web_begin < api_end and api_begin < web_end
+    # the plan failed: its slices end with the trace
+    assert [(name, unfinished) for name, _, _, unfinished in slices['main']] == [('false', True), ('height 0', True)]
+    assert os.listdir(str(tmp_path / '.dmake' / 'trace')) == []
+
+
+def test_bash_trace_portable_timestamps(tmp_path, monkeypatch):
+    """without EPOCHREALTIME (bash < 5), the events are still timestamped in microseconds"""
+    monkeypatch.setattr(common, 'execution_trace', True)
+    monkeypatch.setattr(common, 'cache_dir', str(tmp_path / '.dmake'), raising=False)
+    commands = []
+    append_command(commands, 'sh', shell='sleep 0.1')
+    script = tmp_path / 'script.sh'
+    with open(str(script), 'w') as f:
+        f.write('unset EPOCHREALTIME\n')
+        generate_command_bash(f, commands)
+    env = dict(os.environ, PATH='%s:%s' % (UTILS_DIR, os.environ['PATH']), PYTHONPATH=ROOT_DIR)
+    assert subprocess.call(['bash', str(script)], env=env) == 0
+
+    with open(str(tmp_path / '.dmake' / 'trace.json')) as f:
+        slices = get_slices(json.load(f))
+    [(name, begin, end, unfinished)] = slices['main']
+    assert name == 'sleep 0.1' and not unfinished
+    assert 100000 <= end - begin < 10000000
+
+
+def test_export_no_events(tmp_path):
+    """no empty trace is exported"""
+    events_file = tmp_path / 'events.jsonl'
+    events_file.write_text('{"ts": , "ph": "B"}\n')
+    trace_file = tmp_path / 'trace.json'
+    assert main([str(events_file), str(trace_file)]) == 1
+    assert not trace_file.exists()
+
+
+def test_pipeline_trace(monkeypatch):
+    """the lock wait is traced apart from the execution; the trace is published"""
+    monkeypatch.setattr(common, 'execution_trace', True)
+    monkeypatch.setattr(common, 'build_description', None, raising=False)
+    monkeypatch.setattr(common, 'relative_cache_dir', '.dmake', raising=False)
+    commands = []
+    append_command(commands, 'parallel')
+    append_command(commands, 'parallel_branch', name='web')
+    append_command(commands, 'lock', label='PARALLEL_BUILDERS', quantity=2)
+    append_command(commands, 'sh', shell="echo 'built'")
+    append_command(commands, 'lock_end')
+    append_command(commands, 'parallel_branch_end')
+    append_command(commands, 'parallel_end')
+    f = io.StringIO()
+    generate_command_pipeline(f, commands)
+    lines = [line.strip() for line in f.getvalue().splitlines()]
+    index = lines.index("lock(label: 'PARALLEL_BUILDERS', quantity: 2, variable: '') {")
+    assert lines[index - 1] == """dmake_trace('"ph": "B", "cat": "lock", "tid": "web", "name": "lock PARALLEL_BUILDERS x2"')"""
+    assert lines[index + 1] == """dmake_trace('"ph": "E", "cat": "lock", "tid": "web", "name": "lock PARALLEL_BUILDERS x2"')"""
+    assert lines[index + 2] == """dmake_trace('"ph": "B", "cat": "command", "tid": "web", "name": "echo \\'built\\'"')"""
+    assert "archiveArtifacts(artifacts: '.dmake/trace.json', allowEmptyArchive: true)" in lines
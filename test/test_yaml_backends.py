@@ -0,0 +1,49 @@
+import glob
+import os
+
+import pytest
+import yaml
+
+import dmake.common as common
+
+pytestmark = pytest.mark.skipif(not yaml.__with_libyaml__, reason="PyYAML built without libyaml")
+
+TEST_DIR = os.path.dirname(__file__)
+
+STRINGS = ['y', 'n', 'yes', 'Off', '~', 'null', '', '1e3', '1.0', '0755', '0x1F', "it's", 'a\nb', "a\nb'c",
+           'foo: bar', '-x', '@x', ' x', 'x ', 'é', '2001-12-14t21:59:43.10-05:00', 'word ' * 40]
+
+
+def load(backend, stream, all=False):
+    common.yaml_backend = backend
+    return common.yaml_ordered_load(stream, all=all)
+
+
+def dump(backend, data, all=False):
+    common.yaml_backend = backend
+    return common.yaml_ordered_dump(data, all=all)
+
+
+@pytest.fixture(autouse=True)
+def restore_backend(monkeypatch):
+    monkeypatch.setattr(common, 'yaml_backend', common.yaml_backend)
+
+
+@pytest.mark.parametrize('path', sorted(glob.glob(os.path.join(TEST_DIR, '**', '*.yaml'), recursive=True) +
+                                        glob.glob(os.path.join(TEST_DIR, '**', 'dmake.yml'), recursive=True)))
+def test_same_data(path):
+    with open(path, 'r') as f:
+        content = f.read()
+    data = load('ruamel', content, all=True)
+    assert load('libyaml', content, all=True) == data
+    assert load('ruamel', dump('libyaml', data, all=True), all=True) == data
+
+
+def test_same_scalars():
+    data = {'strings': STRINGS, 'keys': {s: s for s in STRINGS if s}, 'null': None, 'int': 3, 'bool': True, 'float': 1.5, 'empty': [{}]}
+    output = dump('libyaml', data)
+    assert load('ruamel', output) == data
+    # short scalars are quoted the same way
+    del data['strings'][-1]
+    assert output.startswith('---\n')
+    assert dump('libyaml', data) == dump('ruamel', data)